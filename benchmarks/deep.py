@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+"""Measure the expansion of a synthetic module made of deeply nested
+code, like the one generated by other tools: a long ``elif`` chain, a
+long chain of ``BinOp`` and a big literal table, with some macro
+invocations inside.
+
+Run it from the root of the repository with::
+
+    python benchmarks/deep.py [-n DEPTH] [-r REPEAT]
+
+It prints the size of the module, the number of Python frames created
+and the maximum depth of the stack during the expansion, the peak of
+the memory allocated according to `tracemalloc`:mod: and the best
+expansion time.
+"""
+
+import argparse
+import ast
+import gc
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from expansion import expand  # noqa: E402
+
+
+HEADER = '''from macropy.quick_lambda import macros, f, _
+'''
+
+
+def make_source(depth):
+    chain = ' + '.join(['x'] * depth)
+    table = ',\n'.join('    ({0}, "{0}", [{0}, {0} * 2])'.format(n)
+                       for n in range(depth))
+    branches = ''.join('elif x == {0}:\n    y = f[_ * {0}]\n'.format(n)
+                       for n in range(1, depth))
+    return (HEADER + 'x = 1\ny = {}\nTABLE = [\n{}\n]\nif x == 0:\n'
+            '    y = f[_ + 1]\n{}'.format(chain, table, branches))
+
+
+def count_frames(source):
+    """Return the number of Python frames created during the expansion of
+    *source*, and the maximum depth of the stack."""
+    calls = [0]
+    depth = [0, 0]
+
+    def profile(frame, event, arg):
+        if event == 'call':
+            calls[0] += 1
+            depth[0] += 1
+            depth[1] = max(depth[1], depth[0])
+        elif event == 'return':
+            depth[0] -= 1
+
+    sys.setprofile(profile)
+    try:
+        expand(source)
+    finally:
+        sys.setprofile(None)
+    return calls[0], depth[1]
+
+
+def peak_memory(source):
+    """Return the peak of the memory allocated during the expansion of
+    *source*, in bytes."""
+    tracemalloc.start()
+    try:
+        expand(source)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-n', '--depth', type=int, default=2000)
+    parser.add_argument('-r', '--repeat', type=int, default=5)
+    args = parser.parse_args(argv)
+
+    source = make_source(args.depth)
+    nodes = sum(1 for _ in ast.walk(ast.parse(source)))
+    calls, max_depth = count_frames(source)
+    peak = peak_memory(source)
+
+    times = []
+    for _ in range(args.repeat):
+        gc.collect()
+        gc.disable()
+        try:
+            start = time.perf_counter()
+            expand(source)
+            times.append(time.perf_counter() - start)
+        finally:
+            gc.enable()
+    print('{} lines, {} nodes'.format(source.count('\n'), nodes))
+    print('{} frames, {} deep'.format(calls, max_depth))
+    print('peak memory: {:.1f} KiB'.format(peak / 1024))
+    print('best of {}: {:.1f} ms'.format(args.repeat, min(times) * 1e3))
+
+
+if __name__ == '__main__':
+    main()
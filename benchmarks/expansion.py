@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""Measure the expansion of a large, synthetic module, which contains
+few macro invocations among a lot of ordinary code, as it's usual.
+
+Run it from the root of the repository with::
+
+    python benchmarks/expansion.py [-n FUNCTIONS] [-r REPEAT]
+
+It prints the size of the module, the number of nodes visited by the
+expansion walker and inspected for macro invocations, and the best
+expansion time.
+"""
+
+import argparse
+import ast
+import gc
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+import macropy.activate  # noqa: E402,F401
+from macropy.core import macros, profiling  # noqa: E402
+
+
+TEMPLATE = '''
+def func_{n}(a, b, c=None, *args, **kwargs):
+    """A function with some ordinary code."""
+    total = 0
+    for i in range(a):
+        if i % 2 == 0 and b is not None:
+            total += i * b - len(args) // (c or 1)
+        else:
+            total -= kwargs.get('x', {{}}).get(str(i), [1, 2, 3])[0]
+    values = [x ** 2 for x in args if x > total]
+    with open('/dev/null') as f:
+        f.read()
+    try:
+        result = dict(zip(map(str, values), values))
+    except (TypeError, ValueError) as e:
+        result = {{'error': repr(e), 'total': total}}
+    return sorted(result.items(), key=f[_[0]])
+'''
+
+HEADER = '''from macropy.quick_lambda import macros, f, _
+from macropy.case_classes import macros, case
+
+@case
+class Point(x, y):
+    pass
+'''
+
+
+def make_source(functions):
+    return HEADER + ''.join(TEMPLATE.format(n=n) for n in range(functions))
+
+
+def expand(source):
+    tree = ast.parse(source)
+    bindings = macros.detect_macros(tree, '__bench__')
+    modules = [(sys.modules[mod], bind) for mod, bind in bindings]
+    return macros.ModuleExpansionContext(tree, source,
+                                         modules).expand_macros()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-n', '--functions', type=int, default=500)
+    parser.add_argument('-r', '--repeat', type=int, default=10)
+    args = parser.parse_args(argv)
+
+    source = make_source(args.functions)
+    nodes = sum(1 for _ in ast.walk(ast.parse(source)))
+
+    # count the nodes handed to the macro detection coroutines
+    inspected = [0]
+    macro_expand = macros.ExpansionContext.macro_expand
+
+    def counting_macro_expand(self, tree, *args, **kwargs):
+        inspected[0] += 1
+        return macro_expand(self, tree, *args, **kwargs)
+
+    macros.ExpansionContext.macro_expand = counting_macro_expand
+    profiling.enable()
+    try:
+        expand(source)
+    finally:
+        profiling.disable()
+        macros.ExpansionContext.macro_expand = macro_expand
+
+    # like timeit, keep the collector from adding noise
+    times = []
+    for _ in range(args.repeat):
+        gc.collect()
+        gc.disable()
+        try:
+            start = time.perf_counter()
+            expand(source)
+            times.append(time.perf_counter() - start)
+        finally:
+            gc.enable()
+    print('{} lines, {} nodes'.format(source.count('\n'), nodes))
+    print('{} nodes walked'.format(profiling.macro_stats.walked))
+    print('{} nodes inspected for macros'.format(inspected[0]))
+    print('best of {}: {:.1f} ms'.format(args.repeat, min(times) * 1e3))
+
+
+if __name__ == '__main__':
+    main()
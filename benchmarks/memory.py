@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""Measure the memory kept alive by the import of modules using macros,
+the same synthetic ones measured by ``expansion.py``, once imported
+through the import hook.
+
+Run it from the root of the repository with::
+
+    python benchmarks/memory.py [-m MODULES] [-n FUNCTIONS] [--keep]
+
+It prints the memory still allocated after the imports, once the
+garbage is collected, and the peak during them, according to
+`tracemalloc`:mod:. ``--keep`` makes the loaders keep the expanded
+trees, like ``macropy.activate(keep_expansions=True)``, for
+comparison.
+"""
+
+import argparse
+import gc
+import importlib
+import os
+import shutil
+import sys
+import tempfile
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from expansion import make_source  # noqa: E402
+from macropy.core.import_hooks import MacroFinder  # noqa: E402
+
+
+def import_modules(directory, names):
+    """Import the modules *names* from *directory* and return them, with
+    the memory allocated after collecting the garbage and the peak, in
+    bytes."""
+    sys.path.insert(0, directory)
+    tracemalloc.start()
+    try:
+        modules = [importlib.import_module(name) for name in names]
+        gc.collect()
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+        sys.path.remove(directory)
+    return modules, current, peak
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-m', '--modules', type=int, default=10)
+    parser.add_argument('-n', '--functions', type=int, default=200)
+    parser.add_argument('--keep', action='store_true')
+    args = parser.parse_args(argv)
+
+    MacroFinder.keep_expansions = args.keep
+    sys.dont_write_bytecode = True
+    directory = tempfile.mkdtemp()
+    try:
+        source = make_source(args.functions)
+        names = ['bench_memory_{}'.format(n) for n in range(args.modules)]
+        for name in names:
+            with open(os.path.join(directory, name + '.py'), 'w') as f:
+                f.write(source)
+        modules, current, peak = import_modules(directory, names)
+    finally:
+        shutil.rmtree(directory)
+    print('{} modules of {} lines'.format(len(modules),
+                                          source.count('\n')))
+    print('kept after import: {:.1f} KiB'.format(current / 1024))
+    print('peak: {:.1f} KiB'.format(peak / 1024))
+
+
+if __name__ == '__main__':
+    main()
@@ -5,20 +5,142 @@ import hooks that are required for macros to run properly.
 """
 
 
-def activate():
+def activate(cache_dir=None, include=None, exclude=None, profile=None,
+             keep_expansions=None, expansion_cache=None, archive=None,
+             prefetch=None, expansion_server=None):
+    """Install the import hook that expands macros.
+
+    :param cache_dir: a directory where to keep the persistent caches
+      of the import hook, defaults to the value of the
+      ``MACROPY_CACHE_DIR`` environment variable; if neither is
+      given, no such cache is used
+    :param include: a list of package names or directories containing
+      the only modules where to look for macros, defaults to the
+      value of the ``MACROPY_INCLUDE`` environment variable
+      (separated by ``os.pathsep``)
+    :param exclude: a list of package names or directories containing
+      modules where not to look for macros, defaults to the value of
+      the ``MACROPY_EXCLUDE`` environment variable
+    :param profile: if true, record the time spent in each phase of
+      the import of every module and the cost of each macro, and
+      print a report at exit, see `~.core.profiling`:mod:. Defaults
+      to the presence of the ``MACROPY_PROFILE`` environment variable
+    :param keep_expansions: if true, keep the expanded tree, code and
+      source of each module in its loader after its execution, for
+      debugging, instead of freeing them. Defaults to the presence of
+      the ``MACROPY_KEEP_EXPANSIONS`` environment variable
+    :param expansion_cache: the directory of an expansion cache shared
+      by different projects, or a `~.core.cache.ExpansionCache`:class:,
+      defaults to the value of the ``MACROPY_EXPANSION_CACHE``
+      environment variable; if neither is given, no such cache is used
+    :param archive: the path of an archive written by
+      `~.core.exporters.ArchiveExporter`:class:, or an
+      `~.core.exporters.ExpansionArchive`:class:, whose modules are
+      loaded from it without looking at their source. Defaults to the
+      value of the ``MACROPY_ARCHIVE`` environment variable; a missing
+      or outdated archive is ignored
+    :param prefetch: a list of package names whose modules using macros
+      are expanded in a pool of processes as soon as each package is
+      first imported, see `~.core.prefetch`:mod:, defaults to the
+      value of the ``MACROPY_PREFETCH`` environment variable
+      (separated by ``os.pathsep``)
+    :param expansion_server: the path of the socket of an expansion
+      server started with ``python -m macropy.server``, asked for the
+      expansions not found in the caches, see `~.core.server`:mod:.
+      Defaults to the value of the ``MACROPY_EXPANSION_SERVER``
+      environment variable; when the server isn't running, the
+      modules are expanded locally
+    """
     from .core import macros  # noqa
     from .core import cleanup  # noqa
     from .core import exact_src  # noqa
     from .core import gen_sym  # noqa
 
+    from .core import cache
+    from .core import exporters
     from .core import import_hooks
+    from .core import profiling
+    import atexit
+    import os
     import sys
-    sys.meta_path.insert(0, import_hooks.MacroFinder)
+
+    if profile is None:
+        profile = bool(os.environ.get('MACROPY_PROFILE'))
+    if profile:
+        profiling.enable()
+        # run in reverse order at exit
+        atexit.register(profiling.macro_stats.report)
+        atexit.register(profiling.report)
+
+    if include is None:
+        include = _env_list('MACROPY_INCLUDE')
+    if exclude is None:
+        exclude = _env_list('MACROPY_EXCLUDE')
+    if include or exclude:
+        import_hooks.MacroFinder.import_filter = import_hooks.ImportFilter(
+            include, exclude)
+
+    if keep_expansions is None:
+        keep_expansions = bool(os.environ.get('MACROPY_KEEP_EXPANSIONS'))
+    import_hooks.MacroFinder.keep_expansions = keep_expansions
+
+    cache_dir = cache_dir or cache.cache_dir()
+    if cache_dir is not None:
+        index = cache.UsageIndex(os.path.join(cache_dir, 'usage.index'))
+        import_hooks.MacroFinder.usage_index = index
+        atexit.register(index.save)
+
+    if not isinstance(expansion_cache, cache.ExpansionCache):
+        expansion_cache = cache.expansion_cache_from_env(expansion_cache)
+    if expansion_cache is not None:
+        import_hooks.MacroFinder.expansion_cache = expansion_cache
+        atexit.register(expansion_cache.save_stats)
+
+    if archive is None:
+        archive = os.environ.get('MACROPY_ARCHIVE')
+    if archive is not None and not isinstance(archive,
+                                              exporters.ExpansionArchive):
+        archive = exporters.load_archive(archive)
+    if archive is not None:
+        import_hooks.MacroFinder.archive = archive
+
+    if prefetch is None:
+        prefetch = _env_list('MACROPY_PREFETCH')
+    if prefetch:
+        from .core import prefetch as prefetching
+        prefetcher = prefetching.Prefetcher(prefetch)
+        prefetcher.start()
+        import_hooks.MacroFinder.prefetcher = prefetcher
+        atexit.register(prefetcher.shutdown)
+
+    if expansion_server is None:
+        from .core import server
+        expansion_server = server.server_path()
+    if expansion_server is not None:
+        from .core import server
+        import_hooks.MacroFinder.expansion_server = server.ExpansionClient(
+            expansion_server)
+    if import_hooks.MacroFinder not in sys.meta_path:
+        sys.meta_path.insert(0, import_hooks.MacroFinder)
     import macropy  # noqa
     from .core import hquotes  # noqa
     from .core import failure  # noqa
 
 
+def _env_list(name):
+    """Internal; read a list of values from an environment variable."""
+    import os
+    return [v for v in os.environ.get(name, '').split(os.pathsep) if v]
+
+
+def stats():
+    """Return the statistics about the expansion of each macro, recorded
+    when the import hook is activated with ``profile=True``, see
+    `~.core.profiling.ExpansionStats`:class:."""
+    from .core import profiling
+    return profiling.macro_stats
+
+
 def console():
     from macropy.core.console import MacroConsole
     MacroConsole().interact("0=[]=====> MacroPy Enabled <=====[]=0")
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+"""Inspect and maintain the shared expansion cache, see
+`~.core.cache.ExpansionCache`:class:. Use it like::
+
+    python -m macropy.cache [-d DIR] stats
+    python -m macropy.cache [-d DIR] prune [-s SIZE]
+    python -m macropy.cache [-d DIR] clear
+
+The directory defaults to the value of the ``MACROPY_EXPANSION_CACHE``
+environment variable.
+"""
+
+import argparse
+import os
+import shutil
+import sys
+
+from .core.cache import expansion_cache_from_env, parse_size
+
+
+def format_size(size):
+    """Format *size*, in bytes, for humans."""
+    for unit in ('B', 'KiB', 'MiB'):
+        if size < 1024:
+            return '{:.1f} {}'.format(size, unit)
+        size /= 1024
+    return '{:.1f} GiB'.format(size)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m macropy.cache',
+        description='Inspect and maintain the shared expansion cache.')
+    parser.add_argument('-d', '--dir', default=None,
+                        help='the directory of the cache (default: '
+                        '$MACROPY_EXPANSION_CACHE)')
+    commands = parser.add_subparsers(dest='command')
+    commands.add_parser('stats', help='show the size and the statistics')
+    prune = commands.add_parser(
+        'prune', help='evict the least recently used expansions')
+    prune.add_argument('-s', '--max-size', type=parse_size, default=None,
+                       help='the size to fit in, like 100M (default: '
+                       'the configured one)')
+    commands.add_parser('clear', help='remove all the expansions')
+    args = parser.parse_args(argv)
+
+    cache = expansion_cache_from_env(args.dir)
+    if cache is None:
+        parser.error('no cache directory given')
+    if args.command == 'prune':
+        removed = cache.prune(args.max_size)
+        cache.save_stats()
+        print('{} files removed'.format(removed))
+    elif args.command == 'clear':
+        for kind in ('m', 'r'):
+            shutil.rmtree(os.path.join(cache.path, kind),
+                          ignore_errors=True)
+        print('cleared {}'.format(cache.path))
+    else:
+        files, size = cache.size()
+        stats = cache.load_stats()
+        hits, misses = stats.get('hits', 0), stats.get('misses', 0)
+        lookups = hits + misses
+        print('cache directory: {}'.format(cache.path))
+        if cache.remote is not None:
+            print('remote directory: {}'.format(cache.remote))
+        print('files: {}'.format(files))
+        print('size: {} of {}'.format(format_size(size),
+                                      format_size(cache.max_size)))
+        print('hits: {}'.format(hits))
+        print('misses: {}'.format(misses))
+        print('hit rate: {:.1%}'.format(hits / lookups if lookups else 0))
+        print('evictions: {}'.format(stats.get('evictions', 0)))
+        print('waits for other processes: {} ({} timed out)'.format(
+            stats.get('waits', 0), stats.get('timeouts', 0)))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+"""Ahead-of-time macro expansion of whole source trees.
+
+Walks the given directories looking for modules that use macros, then
+expands and compiles them in a pool of processes, storing the results
+in the cache of `~.core.exporters.PycExporter`:class:, so that the
+following imports find them ready. Use it like the standard
+`compileall` module::
+
+    python -m macropy.compileall [-j WORKERS] [-f] [-q] PATH...
+"""
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import importlib.util
+import os
+import sys
+import time
+
+
+# The outcomes of the expansion of a module.
+EXPANDED = 'expanded'
+UP_TO_DATE = 'up to date'
+NO_MACROS = 'no macros'
+FAILED = 'failed'
+
+
+def module_name_for(file_name):
+    """Return a tuple of the dotted name of the module at *file_name*
+    and the ``sys.path`` entry it has to be imported from, determined by
+    walking up the enclosing packages."""
+    file_name = os.path.abspath(file_name)
+    dirname, basename = os.path.split(file_name)
+    parts = [] if basename == '__init__.py' else [basename[:-3]]
+    while os.path.exists(os.path.join(dirname, '__init__.py')):
+        dirname, package = os.path.split(dirname)
+        parts.insert(0, package)
+    return '.'.join(parts), dirname
+
+
+def find_macro_modules(paths):
+    """Yield the path of each source file under *paths* (files or
+    directories) that looks like it is using macros."""
+    from .core.macros import has_macro_imports
+    for path in paths:
+        if os.path.isdir(path):
+            file_names = (os.path.join(dirpath, fname)
+                          for dirpath, dirnames, filenames in os.walk(path)
+                          for fname in sorted(filenames)
+                          if fname.endswith('.py'))
+        else:
+            file_names = [path]
+        for file_name in file_names:
+            try:
+                with open(file_name, 'rb') as f:
+                    source = importlib.util.decode_source(f.read())
+            except (OSError, SyntaxError, UnicodeDecodeError):
+                continue
+            if has_macro_imports(source):
+                yield file_name
+
+
+def _setup_worker(path_entry):
+    """Internal; prepare the current process to expand modules."""
+    import macropy.activate  # noqa: F401
+    import macropy
+    from .core.exporters import PycExporter
+    if not isinstance(macropy.exporter, PycExporter):
+        macropy.exporter = PycExporter()
+    # this is an explicit request to write the cache
+    sys.dont_write_bytecode = False
+    if path_entry not in sys.path:
+        sys.path.insert(0, path_entry)
+
+
+def compile_module(file_name, force=False):
+    """Expand the module at *file_name* and store the result in the
+    cache, unless it's already there and *force* is false.
+
+    :returns: a tuple of ``(file_name, outcome, seconds, error)``
+    """
+    start = time.perf_counter()
+    module_name, path_entry = module_name_for(file_name)
+    try:
+        _setup_worker(path_entry)
+        import macropy
+        from .core.import_hooks import MacroFinder
+        with open(file_name, 'rb') as f:
+            source = importlib.util.decode_source(f.read())
+        if (not force and
+            macropy.exporter.find(module_name, file_name,
+                                  source) is not None):  # noqa: E129
+            outcome = UP_TO_DATE
+        else:
+            spec = importlib.util.spec_from_file_location(module_name,
+                                                          file_name)
+            code, tree, dependencies = MacroFinder.expand_macros(
+                source, file_name, spec)
+            if code is None:
+                outcome = NO_MACROS
+            else:
+                macropy.exporter.export_transformed(
+                    code, tree, module_name, file_name, source=source,
+                    dependencies=dependencies)
+                outcome = EXPANDED
+        error = None
+    except Exception as e:
+        outcome = FAILED
+        error = '{}: {}'.format(type(e).__name__, e)
+    return file_name, outcome, time.perf_counter() - start, error
+
+
+def compile_paths(paths, workers=None, force=False, report=None):
+    """Expand all the modules using macros under *paths* in a pool of
+    *workers* processes (by default one per CPU).
+
+    :param report: an optional function called with the result of
+      `compile_module`:func: for each module, as soon as it's available
+    :returns: a list of the results, sorted by descending time
+    """
+    file_names = list(find_macro_modules(paths))
+    results = []
+    if not file_names:
+        return results
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(compile_module, file_name, force)
+                   for file_name in file_names]
+        for future in as_completed(futures):
+            result = future.result()
+            results.append(result)
+            if report is not None:
+                report(result)
+    results.sort(key=lambda r: r[2], reverse=True)
+    return results
+
+
+def print_result(result, quiet=False):
+    """Print the result of `compile_module`:func:, only if it failed
+    when *quiet* is true."""
+    file_name, outcome, seconds, error = result
+    if outcome == FAILED:
+        print('{:9.3f}s {:<10} {}\n    {}'.format(
+            seconds, outcome, file_name, error), file=sys.stderr)
+    elif not quiet:
+        print('{:9.3f}s {:<10} {}'.format(seconds, outcome, file_name))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m macropy.compileall',
+        description='Expand the macros of the modules under the given '
+        'paths and store the results in the expansion cache.')
+    parser.add_argument('paths', nargs='+', metavar='PATH',
+                        help='a directory or a file to expand')
+    parser.add_argument('-j', '--workers', type=int, default=None,
+                        help='number of worker processes (default: one '
+                        'per CPU)')
+    parser.add_argument('-f', '--force', action='store_true',
+                        help='expand the modules even if up to date')
+    parser.add_argument('-q', '--quiet', action='store_true',
+                        help='only report the failures')
+    args = parser.parse_args(argv)
+
+    def report(result):
+        print_result(result, args.quiet)
+
+    start = time.perf_counter()
+    results = compile_paths(args.paths, args.workers, args.force, report)
+    outcomes = [outcome for _, outcome, _, _ in results]
+    if not args.quiet:
+        print('{} expanded, {} up to date, {} failed in {:.3f}s'.format(
+            outcomes.count(EXPANDED), outcomes.count(UP_TO_DATE),
+            outcomes.count(FAILED), time.perf_counter() - start))
+    return 1 if FAILED in outcomes else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,14 +1,19 @@
 # -*- coding: utf-8 -*-
-"""Walker that performs simple name-binding analysis as it traverses the AST"""
+"""Walker that performs simple name-binding analysis as it traverses the
+AST, and an index of the names, bindings and positions of a tree built
+in a single traversal."""
 
 import ast
+import collections
+import collections.abc
 
-from .util import merge_dicts
+from .macros import injected_vars
+from .util import register
 from .walkers import Walker
 from . import compat
 
 
-__all__ = ['Scoped']
+__all__ = ['Scoped', 'AnalysisIndex']
 
 
 @Walker
@@ -29,6 +34,271 @@ def find_assignments(tree, collect, stop, **kw):
             collect(x)
 
 
+def node_names(node):
+    """Return a tuple of the names *node* binds or uses by itself, the
+    ones that `~.gen_sym`:func: must avoid."""
+    tnode = type(node)
+    if tnode is ast.Name:
+        return (node.id,)
+    elif tnode is ast.arg:
+        return (node.arg,)
+    elif tnode is ast.Import or tnode is ast.ImportFrom:
+        return tuple(x.asname or x.name for x in node.names)
+    elif tnode in compat.scope_nodes:
+        return (node.name,)
+    return ()
+
+
+def _children(node):
+    if isinstance(node, list):
+        return node
+    return [value for field, value in ast.iter_fields(node)
+            if isinstance(value, (ast.AST, list))]
+
+
+def node_position(node):
+    """Return the ``(lineno, col_offset)`` position of *node* in the
+    source, or ``None`` if it has none. The nodes shared by the parser,
+    like the ``ctx`` of the names and the operators, may get a position
+    from the filters, which is ignored."""
+    if ('lineno' in node._attributes and hasattr(node, 'lineno') and
+        hasattr(node, 'col_offset')):  # noqa: E129
+        return (node.lineno, node.col_offset)
+    return None
+
+
+class AnalysisIndex(object):
+    """An index of *tree* built in a single traversal, the first time it's
+    queried, containing:
+
+    - the parent of each node;
+    - the names bound or used in the tree;
+    - the source positions of its nodes;
+    - the symbol table of each scope, i.e. the names bound directly in
+      the tree and in the body of each function or class, the same
+      found by `find_assignments`.
+
+    When used during the expansion of a module (it's available to the
+    macros as the ``analysis_index`` argument), it's kept up to date
+    with the subtrees replaced by the macros, see
+    `replace_subtree`:meth:. The changes made by the macros in place
+    are not tracked, so the names it knows may be more than those in
+    the tree.
+
+    :param tree: an AST tree or a list of them
+    """
+
+    def __init__(self, tree):
+        self.tree = tree
+        self.built = False
+
+    def _build(self):
+        self.built = True
+        # id(node) -> (node, parent, names, position, owner), where
+        # owner is the id of the scope whose symbol table includes the
+        # bindings of the node
+        self.entries = {}
+        self.names = collections.Counter()
+        self.positions = collections.Counter()
+        # id(scope) -> (scope, symbols), where scope is the tree or the
+        # body of a function or class
+        self.tables = {}
+        self._sorted_positions = None
+        self.add(self.tree, None)
+
+    def add(self, tree, parent, owner=None):
+        """Add *tree*, a new child of *parent*, to the index. Its bindings
+        belong to the scope whose id is *owner*, which is *tree* itself
+        by default."""
+        if not self.built:
+            return
+        if not isinstance(tree, (ast.AST, list)):
+            return
+        entries = self.entries
+        tables = self.tables
+        names = self.names
+        positions = self.positions
+        scope_nodes = compat.scope_nodes
+        if owner is None:
+            owner = id(tree)
+            scope = {}
+            tables[owner] = (tree, scope)
+        else:
+            # the table of the owner will be computed again
+            scope = None
+        # (node, parent, symbol table, its owner, is in the targets of
+        # an Assign)
+        stack = [(tree, parent, scope, owner, False)]
+        pop = stack.pop
+        push = stack.append
+        while stack:
+            node, parent, scope, owner, target = pop()
+            if type(node) is list:
+                for child in reversed(node):
+                    push((child, parent, scope, owner, target))
+                continue
+            if not isinstance(node, ast.AST):
+                continue
+            key = id(node)
+            entry = entries.get(key)
+            tnode = type(node)
+            if entry is None:
+                if tnode is ast.Name:
+                    node_names_ = (node.id,)
+                    names[node.id] += 1
+                else:
+                    node_names_ = node_names(node)
+                    if node_names_:
+                        names.update(node_names_)
+                position = node_position(node)
+                if position is not None:
+                    positions[position] += 1
+                entries[key] = (node, parent, node_names_, position, owner)
+            else:
+                entries[key] = (node, parent) + entry[2:4] + (owner,)
+            if tnode in scope_nodes:
+                if scope is not None:
+                    scope[node.name] = node
+                body = {}
+                tables[id(node.body)] = (node.body, body)
+                for field in node._fields:
+                    value = getattr(node, field, None)
+                    if value is node.body:
+                        push((value, node, body, id(value), False))
+                    elif isinstance(value, (ast.AST, list)):
+                        push((value, node, None, owner, False))
+                continue
+            if tnode is ast.Attribute or tnode is ast.Subscript:
+                target = False
+            elif target and tnode is ast.Name and scope is not None:
+                scope[node.id] = node
+            elif tnode is ast.Assign:
+                push((node.value, node, scope, owner, target))
+                push((node.targets, node, scope, owner, True))
+                continue
+            for field in reversed(node._fields):
+                value = getattr(node, field, None)
+                if isinstance(value, (ast.AST, list)):
+                    push((value, node, scope, owner, target))
+        self._sorted_positions = None
+
+    def remove(self, tree):
+        """Remove *tree* and its subtrees from the index."""
+        if not self.built:
+            return
+        stack = [tree]
+        while stack:
+            node = stack.pop()
+            self.tables.pop(id(node), None)
+            entry = self.entries.get(id(node))
+            if entry is not None and entry[0] is node:
+                del self.entries[id(node)]
+                self.names.subtract(entry[2])
+                if entry[3] is not None:
+                    self.positions[entry[3]] -= 1
+                    self._sorted_positions = None
+            if isinstance(node, (ast.AST, list)):
+                stack.extend(_children(node))
+
+    def replace_subtree(self, old, new):
+        """Update the index after *old* has been replaced by *new*, which
+        can also be a list of trees."""
+        if not self.built:
+            return
+        entry = self.entries.get(id(old))
+        if entry is None or entry[0] is not old:
+            # not part of the indexed tree
+            return
+        parent, owner = entry[1], entry[4]
+        self.remove(old)
+        self.add(new, parent, owner)
+        # the bindings of the enclosing scope may have changed
+        self.tables.pop(owner, None)
+
+    def parent(self, node):
+        """Return the parent node of *node*, ``None`` for the root or for
+        an unknown node."""
+        if not self.built:
+            self._build()
+        entry = self.entries.get(id(node))
+        if entry is not None and entry[0] is node:
+            return entry[1]
+
+    def __contains__(self, name):
+        """Tell if *name* is bound or used in the tree."""
+        if not self.built:
+            self._build()
+        return self.names[name] > 0
+
+    def symbols(self, scope):
+        """Return a dictionary of the names bound directly in *scope*,
+        which is the indexed tree, a subtree of it or the body of a
+        function or class, and of the nodes binding them. It's computed
+        if it's not in the index."""
+        if not self.built:
+            self._build()
+        table = self.tables.get(id(scope))
+        if table is not None and table[0] is scope:
+            return table[1]
+        symbols = dict(find_assignments.collect(scope))
+        self.tables[id(scope)] = (scope, symbols)
+        return symbols
+
+    def sorted_positions(self):
+        """Return a sorted list of the ``(lineno, col_offset)`` positions
+        of the nodes in the tree."""
+        if not self.built:
+            self._build()
+        if self._sorted_positions is None:
+            self._sorted_positions = sorted(
+                pos for pos, count in self.positions.items() if count > 0)
+        return self._sorted_positions
+
+
+@register(injected_vars)
+def analysis_index(tree, **kw):
+    return AnalysisIndex(tree)
+
+
+class ScopeView(collections.abc.Mapping):
+    """The names in scope at some node, as a mapping between each name
+    and the node binding it. It's an overlay on the scope of the
+    enclosing node, so that nested scopes don't copy the whole mapping.
+
+    :param parent: the mapping of the enclosing scope
+    :param names: a mapping of the names added by this scope
+    :param removed: names of the enclosing scope that are hidden
+    """
+
+    def __init__(self, parent, names, removed=()):
+        self.parent = parent
+        self.names = names
+        self.removed = frozenset(removed)
+
+    def __getitem__(self, name):
+        if name in self.names:
+            return self.names[name]
+        if name in self.removed:
+            raise KeyError(name)
+        return self.parent[name]
+
+    def __contains__(self, name):
+        return name in self.names or (name not in self.removed and
+                                      name in self.parent)
+
+    def __iter__(self):
+        for name in self.parent:
+            if name not in self.names and name not in self.removed:
+                yield name
+        yield from self.names
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return repr(dict(self))
+
+
 def extract_arg_names(args):
     return dict(
         ([(args.vararg.arg, args.vararg)] if args.vararg else []) +
@@ -60,18 +330,28 @@ class Scoped(Walker):
         self.walker = walker
 
     def recurse_collect(self, tree, sub_kw=[], **kw):
-
-        kw['scope'] = kw.get('scope', dict(find_assignments.collect(tree)))
+        if 'scope' not in kw:
+            # the bindings of all the scopes are found in one pass
+            kw['scope_index'] = AnalysisIndex(tree)
+            kw['scope'] = kw['scope_index'].symbols(tree)
         return Walker.recurse_collect(self, tree, sub_kw, **kw)
 
     def func(self, tree, set_ctx_for, scope, **kw):
+        index = kw.get('scope_index')
 
-        def extend_scope(tree, *dicts, **kw):
-            new_scope = merge_dicts(*([scope] + list(dicts)))
-            if "remove" in kw:
-                for rem in kw['remove']:
-                    del new_scope[rem]
+        def bindings(tree):
+            if index is None:
+                return dict(find_assignments.collect(tree))
+            return index.symbols(tree)
 
+        def extend_scope(tree, *dicts, **kw):
+            names = {}
+            for d in dicts:
+                names.update(d)
+            removed = kw.get('remove', ())
+            for rem in removed:
+                names.pop(rem, None)
+            new_scope = ScopeView(scope, names, removed)
             set_ctx_for(tree, scope=new_scope)
         if isinstance(tree, ast.Lambda):
             extend_scope(tree.body, extract_arg_names(tree.args))
@@ -98,12 +378,12 @@ class Scoped(Walker):
                 tree.body,
                 {tree.name: tree},
                 extract_arg_names(tree.args),
-                dict(find_assignments.collect(tree.body)),
+                bindings(tree.body),
             )
 
         if isinstance(tree, ast.ClassDef):
             extend_scope(tree.bases, remove=[tree.name])
-            extend_scope(tree.body, dict(find_assignments.collect(tree.body)),
+            extend_scope(tree.body, bindings(tree.body),
                          remove=[tree.name])
 
         if isinstance(tree, ast.ExceptHandler):
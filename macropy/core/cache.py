@@ -0,0 +1,680 @@
+# -*- coding: utf-8 -*-
+"""Persistent, process-wide caches used to speed up the import hooks."""
+
+import hashlib
+import importlib.machinery
+import importlib.util
+import logging
+import marshal
+import os
+import sys
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:  # not on Windows
+    fcntl = None
+
+from . import compat
+from .exporters import _write_atomic, file_hash
+
+
+logger = logging.getLogger(__name__)
+
+
+def cache_dir():
+    """Return the directory configured to hold MacroPy's caches, from the
+    ``MACROPY_CACHE_DIR`` environment variable, or ``None`` if it isn't
+    set."""
+    return os.environ.get('MACROPY_CACHE_DIR') or None
+
+
+def expansion_cache_dir():
+    """Return the directory of the shared `ExpansionCache`:class:, from
+    the ``MACROPY_EXPANSION_CACHE`` environment variable, or ``None``
+    if it isn't set."""
+    return os.environ.get('MACROPY_EXPANSION_CACHE') or None
+
+
+class UsageIndex(object):
+    """An on-disk index that records which source files use macros,
+    keyed by their path, ``mtime`` and size. It allows the import hook
+    to skip reading and scanning the source of modules already known
+    to have no macro imports. It also records the file where each
+    module was found, for a given search path, with the ``mtime`` of
+    the directories looked into, so that the import hook can skip them
+    before looking for them, see `lookup_module`:meth:.
+
+    Lookups and updates happen in memory, `save`:meth: merges them with
+    the content of the file, which may have been updated in the
+    meantime by other processes, and drops the entries of the files
+    that don't exist anymore.
+
+    :param path: the path of the index file
+    """
+
+    # The first bytes of the index file, changed when its format, or the scan
+    # of the sources recorded in it, does.
+    header = b'MPUI\x04'
+
+    def __init__(self, path):
+        self.path = path
+        self._entries = None
+        self._updates = {}
+        self._search_paths = {}
+        self._lock = threading.Lock()
+
+    @property
+    def entries(self):
+        if self._entries is None:
+            with self._lock:
+                if self._entries is None:
+                    self._entries = self._load()
+        return self._entries
+
+    def _load(self):
+        try:
+            with open(self.path, 'rb') as f:
+                data = f.read()
+        except OSError:
+            return {}
+        if not data.startswith(self.header):
+            return {}
+        try:
+            entries = marshal.loads(data[len(self.header):])
+        except (EOFError, ValueError, TypeError):
+            logger.debug('Usage index %r is corrupted', self.path)
+            return {}
+        return entries if isinstance(entries, dict) else {}
+
+    def lookup(self, file_name):
+        """Tell if the file at *file_name* uses macros or ``None`` if it
+        isn't known or has changed since it was recorded."""
+        entry = self.entries.get(file_name)
+        if entry is None:
+            return None
+        try:
+            st = os.stat(file_name)
+        except (OSError, TypeError, ValueError):
+            return None
+        mtime, size, uses_macros = entry
+        if (st.st_mtime_ns, st.st_size) != (mtime, size):
+            return None
+        return uses_macros
+
+    def record(self, file_name, uses_macros):
+        """Record if the file at *file_name* uses macros."""
+        try:
+            st = os.stat(file_name)
+        except (OSError, TypeError, ValueError):
+            return
+        entry = (st.st_mtime_ns, st.st_size, bool(uses_macros))
+        entries = self.entries
+        with self._lock:
+            if entries.get(file_name) != entry:
+                entries[file_name] = entry
+                self._updates[file_name] = entry
+
+    def lookup_module(self, module_name, path=None):
+        """Tell if the module *module_name*, looked for in *path*, uses
+        macros, like `lookup`:meth: does for the file where it was last
+        found there, or ``None`` if it isn't known. It isn't either if
+        any of the directories looked into until that one has changed,
+        as a module with the same name may have been added before it.
+
+        :param path: the ``__path__`` of the package of the module or
+          ``None`` for a top-level one, like in
+          `~importlib.abc.MetaPathFinder.find_spec`:meth:
+        """
+        digest, dirs = self._search_path(path)
+        entry = self.entries.get((module_name, digest))
+        if entry is None:
+            return None
+        file_name, mtimes = entry
+        if _mtimes(dirs[:len(mtimes)]) != mtimes:
+            return None
+        return self.lookup(file_name)
+
+    def record_module(self, module_name, path, file_name):
+        """Record that the module *module_name*, looked for in *path*, was
+        found at *file_name*."""
+        digest, dirs = self._search_path(path)
+        key = module_name, digest
+        # the directory of the module or of its package, the ones after
+        # it don't matter
+        parent = os.path.dirname(os.path.abspath(file_name))
+        found = [n for n, dir_name in enumerate(dirs)
+                 if dir_name in (parent, os.path.dirname(parent))]
+        if found:
+            dirs = dirs[:found[-1] + 1]
+        entry = (file_name, _mtimes(dirs))
+        entries = self.entries
+        with self._lock:
+            if entries.get(key) != entry:
+                entries[key] = entry
+                self._updates[key] = entry
+
+    def _search_path(self, path):
+        """Internal; return a tuple of ``(digest, dirs)`` for the search
+        *path*, or ``sys.path`` if it's ``None``, where *digest* is the
+        hash used in the keys of the entries of the modules and *dirs*
+        the absolute paths of its entries."""
+        if path is None:
+            path = sys.path
+        # the relative entries depend on the current directory
+        path = (os.getcwd(),) + tuple(path)
+        search_path = self._search_paths.get(path)
+        if search_path is None:
+            dirs = tuple(os.path.abspath(str(entry)) for entry in path[1:])
+            digest = compat.source_hash(os.pathsep.join(
+                (path[0],) + dirs).encode('utf-8', 'surrogatepass'))
+            search_path = self._search_paths[path] = digest, dirs
+        return search_path
+
+    def save(self):
+        """Write the updated entries to disk, if any."""
+        with self._lock:
+            if not self._updates:
+                return
+            entries = self._load()
+            entries.update(self._updates)
+            # the modules' entries start with the name of their file
+            entries = {key: entry for key, entry in entries.items()
+                       if os.path.exists(key if isinstance(key, str)
+                                         else entry[0])}
+            try:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                _write_atomic(self.path,
+                              self.header + marshal.dumps(entries))
+            except OSError:
+                logger.debug('Could not write usage index %r', self.path,
+                             exc_info=True)
+                return
+            self._entries = entries
+            self._updates = {}
+
+
+def _mtimes(dirs):
+    """Internal; return a tuple with the ``mtime`` of each of the
+    directories *dirs*, or ``None`` for the missing ones."""
+    mtimes = []
+    for dir_name in dirs:
+        try:
+            mtimes.append(os.stat(dir_name).st_mtime_ns)
+        except OSError:
+            mtimes.append(None)
+    return tuple(mtimes)
+
+
+def parse_size(text):
+    """Parse a size in bytes with an optional ``K``, ``M`` or ``G``
+    suffix, like ``512M``."""
+    text = text.strip().upper().rstrip('B')
+    factor = 1
+    if text and text[-1] in 'KMG':
+        factor = 1024 ** ('KMG'.index(text[-1]) + 1)
+        text = text[:-1]
+    return int(float(text) * factor)
+
+
+def expansion_cache_from_env(path=None):
+    """Return the `ExpansionCache`:class: at *path*, or at the directory
+    given by `expansion_cache_dir`:func:, configured by the
+    ``MACROPY_EXPANSION_CACHE_SIZE``,
+    ``MACROPY_EXPANSION_CACHE_REMOTE`` and
+    ``MACROPY_EXPANSION_CACHE_LOCK_TIMEOUT`` (in seconds) environment
+    variables. Return ``None`` if there's no directory."""
+    path = path or expansion_cache_dir()
+    if path is None:
+        return None
+    kwargs = {}
+    size = os.environ.get('MACROPY_EXPANSION_CACHE_SIZE')
+    if size:
+        kwargs['max_size'] = parse_size(size)
+    remote = os.environ.get('MACROPY_EXPANSION_CACHE_REMOTE')
+    if remote:
+        kwargs['remote'] = remote
+    lock_timeout = os.environ.get('MACROPY_EXPANSION_CACHE_LOCK_TIMEOUT')
+    if lock_timeout:
+        kwargs['lock_timeout'] = float(lock_timeout)
+    return ExpansionCache(path, **kwargs)
+
+
+def _module_file(name):
+    """Internal; return the path of the source of the module *name* in
+    this environment, without importing it or its packages if they
+    aren't already."""
+    mod = sys.modules.get(name)
+    if mod is not None:
+        return getattr(mod, '__file__', None)
+    spec = _find_spec(name)
+    if spec is None or not spec.has_location:
+        return None
+    return spec.origin
+
+
+def _module_hash(name, file_name):
+    """Internal; return the hash of the source of the module *name* at
+    *file_name*, the one it was loaded from if it's already imported,
+    see `~.import_hooks.loaded_hash`:func:."""
+    mod = sys.modules.get(name)
+    if mod is None:
+        return file_hash(file_name)
+    from .import_hooks import loaded_hash
+    return loaded_hash(mod, file_name)
+
+
+def _find_spec(name):
+    """Internal; find the spec of the module *name* with the path based
+    finders, looking for its packages in the same way instead of
+    importing them."""
+    parent, _, _ = name.rpartition('.')
+    path = None
+    if parent:
+        mod = sys.modules.get(parent)
+        if mod is not None:
+            path = getattr(mod, '__path__', None)
+        else:
+            spec = _find_spec(parent)
+            path = spec and spec.submodule_search_locations
+        if path is None:
+            return None
+    try:
+        return importlib.machinery.PathFinder.find_spec(name, path)
+    except (ImportError, ValueError):
+        return None
+
+
+try:
+    from _imp import _fix_co_filename
+except ImportError:
+    def _fix_co_filename(code, file_name):
+        pass
+
+
+class ExpansionLock(object):
+    """An exclusive lock between processes on the expansion of a
+    source, held on the lock file *file_name* with ``flock()``. It's
+    acquired on creation and released by `release`:meth: or at the end
+    of a ``with`` block. The lock file is removed by its owner on
+    release, so the processes that opened it while waiting try again
+    with a new one.
+
+    The lock is given up, without being acquired, if it's still held by
+    another process after *timeout* seconds. A lock file acquired more
+    than twice that ago is considered left behind by a stuck process,
+    or on a filesystem where the locks of the processes that died
+    aren't released, and is removed. Without `fcntl`:mod:, nothing is
+    locked.
+
+    :param file_name: the path of the lock file
+    :param timeout: the time to wait for the lock, in seconds
+    :param poll: the time to wait between two attempts, in seconds
+    :ivar waited: true if the lock was held by another process
+    :ivar acquired: true if the lock is held by this one
+    """
+
+    def __init__(self, file_name, timeout, poll=0.05):
+        self.file_name = file_name
+        self.waited = False
+        self.acquired = False
+        self._fd = None
+        if fcntl is not None:
+            self._acquire(timeout, poll)
+
+    def _acquire(self, timeout, poll):
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                os.makedirs(os.path.dirname(self.file_name), exist_ok=True)
+                fd = os.open(self.file_name, os.O_RDWR | os.O_CREAT, 0o666)
+            except OSError:
+                logger.debug('Could not create lock file %r',
+                             self.file_name, exc_info=True)
+                return
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                os.close(fd)
+            else:
+                if self._owns(fd):
+                    os.ftruncate(fd, 0)
+                    os.write(fd, '{} {!r}'.format(
+                        os.getpid(), time.time()).encode('ascii'))
+                    self._fd = fd
+                    self.acquired = True
+                    return
+                # it was removed by its previous owner meanwhile
+                os.close(fd)
+                continue
+            self.waited = True
+            age = self._age()
+            if age is None:
+                # released meanwhile
+                continue
+            if age > 2 * timeout:
+                logger.warning('Removing stale lock file %r',
+                               self.file_name)
+                try:
+                    os.unlink(self.file_name)
+                except OSError:
+                    pass
+                continue
+            if time.monotonic() >= deadline:
+                logger.warning('Timed out waiting for lock file %r',
+                               self.file_name)
+                return
+            time.sleep(poll)
+
+    def _age(self):
+        """Internal; return the time since the lock file was acquired, as
+        written in it by its owner or, if it isn't there yet, from its
+        modification time, or ``None`` if the file doesn't exist."""
+        try:
+            with open(self.file_name, 'rb') as f:
+                data = f.read(64)
+            return time.time() - float(data.split()[1])
+        except (IndexError, ValueError):
+            pass
+        except OSError:
+            return None
+        try:
+            return time.time() - os.stat(self.file_name).st_mtime
+        except OSError:
+            return None
+
+    def _owns(self, fd):
+        """Internal; tell if *fd* is the file currently at `file_name`."""
+        try:
+            return os.path.samestat(os.fstat(fd), os.stat(self.file_name))
+        except OSError:
+            return False
+
+    def release(self):
+        """Remove the lock file and release the lock, if held."""
+        fd, self._fd = self._fd, None
+        if fd is None:
+            return
+        self.acquired = False
+        try:
+            # unless it was removed as stale
+            if self._owns(fd):
+                os.unlink(self.file_name)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+class ExpansionCache(object):
+    """A content-addressed cache of expanded modules shared by different
+    projects, virtualenvs and machines, in the style of ``ccache``.
+
+    An expansion is found by the name and the hash of the source of the
+    module, together with the versions of Python and MacroPy and the
+    interpreter flags, which leads to a *manifest* listing the hashes
+    of the macro modules used by each of the expansions stored for
+    that source, see `~.import_hooks.macro_dependencies`:func:. The
+    first one whose macro modules have the same contents in this
+    environment, wherever they are, is the result. So the same module
+    checked out in different places shares its expansion.
+
+    The files are written atomically, and the processes expanding the
+    same source at the same time, like the workers of a server started
+    together on an empty cache, can let the first one do it and wait
+    for its result, see `lock`:meth:. The least recently used files
+    are evicted when the size of the cache exceeds *max_size*. The
+    counts of hits, misses and evictions are merged into the
+    ``stats`` file by `save_stats`:meth:.
+
+    :param path: the directory of the cache
+    :param max_size: the maximum size of the cache in bytes
+    :param remote: an optional directory with the same layout, usually
+      on a shared filesystem, looked into when an expansion isn't in
+      *path* and updated with the new ones. It isn't pruned
+    :param lock_timeout: the time to wait for another process
+      expanding the same source, in seconds
+    """
+
+    # The first bytes of each file, changed when its format does.
+    header = b'MPEC\x01'
+
+    # The maximum number of expansions kept for a source.
+    max_variants = 8
+
+    def __init__(self, path, max_size=512 * 1024 ** 2, remote=None,
+                 lock_timeout=60.0):
+        self.path = path
+        self.max_size = max_size
+        self.remote = remote
+        self.lock_timeout = lock_timeout
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+        self._size = None
+        self._lock = threading.Lock()
+
+    def source_key(self, module_name, source):
+        """Return the key of the manifest of *source*, the source of the
+        module *module_name*. The name is part of it because the
+        relative imports of the macros depend on it."""
+        import macropy
+        digest = hashlib.sha1()
+        for part in (importlib.util.MAGIC_NUMBER,
+                     sys.implementation.cache_tag, macropy.__version__,
+                     str(sys.flags.optimize), module_name, source):
+            digest.update(part if isinstance(part, bytes) else
+                          str(part).encode('utf-8', 'surrogatepass'))
+            digest.update(b'\0')
+        return digest.hexdigest()
+
+    def _file(self, root, kind, key):
+        return os.path.join(root, kind, key[:2], key)
+
+    def _read(self, kind, key):
+        """Internal; return the content of the file *key* of *kind*, from
+        the local directory or from the remote one, copying it locally."""
+        for root in (self.path, self.remote):
+            if root is None:
+                continue
+            file_name = self._file(root, kind, key)
+            try:
+                with open(file_name, 'rb') as f:
+                    data = f.read()
+            except OSError:
+                continue
+            if not data.startswith(self.header):
+                continue
+            try:
+                value = marshal.loads(data[len(self.header):])
+            except (EOFError, ValueError, TypeError):
+                logger.debug('Cache file %r is corrupted', file_name)
+                continue
+            if root is self.path:
+                # record the use, for the eviction
+                try:
+                    os.utime(file_name)
+                except OSError:
+                    pass
+            else:
+                self._write(kind, key, value, remote=False)
+            return value
+        return None
+
+    def _write(self, kind, key, value, remote=True):
+        """Internal; store *value* in the file *key* of *kind*."""
+        data = self.header + marshal.dumps(value)
+        for root in (self.path, self.remote if remote else None):
+            if root is None:
+                continue
+            file_name = self._file(root, kind, key)
+            try:
+                os.makedirs(os.path.dirname(file_name), exist_ok=True)
+                _write_atomic(file_name, data)
+            except OSError:
+                logger.debug('Could not write cache file %r', file_name,
+                             exc_info=True)
+                continue
+            if root is self.path:
+                self._grow(len(data))
+
+    def find(self, module_name, file_name, source, retry=False):
+        """Return a tuple of ``(code, dependencies)`` with the expansion
+        of *source*, the source of the module *module_name* at
+        *file_name*, or ``None`` if it isn't in the cache. The
+        dependencies are the manifest of the macro modules used, see
+        `~.import_hooks.macro_dependencies`:func:, and are compared
+        with the modules already imported as it does. *retry* tells
+        that this lookup follows a miss, which isn't counted then."""
+        if retry:
+            self._count('misses', -1)
+        manifest = self._read('m', self.source_key(module_name, source))
+        for hashes, result_key in manifest or ():
+            dependencies = {}
+            for name, digest in hashes.items():
+                dep_file = _module_file(name)
+                if (dep_file is None or
+                        _module_hash(name, dep_file) != digest):
+                    break
+                dependencies[name] = (dep_file, digest)
+            else:
+                code = self._read('r', result_key)
+                if code is not None:
+                    _fix_co_filename(code, file_name)
+                    self._count('hits')
+                    return code, dependencies
+        self._count('misses')
+        return None
+
+    def store(self, code, module_name, file_name, source, dependencies):
+        """Store *code*, the expansion of *source*, the source of the module
+        *module_name* at *file_name*, using the macro modules in
+        *dependencies*."""
+        hashes = {name: digest
+                  for name, (dep_file, digest) in dependencies.items()}
+        key = self.source_key(module_name, source)
+        result_key = hashlib.sha1(
+            (key + repr(sorted(hashes.items()))).encode('utf-8')).hexdigest()
+        self._write('r', result_key, code)
+        manifest = [entry for entry in self._read('m', key) or ()
+                    if entry[1] != result_key]
+        manifest.insert(0, (hashes, result_key))
+        self._write('m', key, manifest[:self.max_variants])
+
+    def lock(self, module_name, source):
+        """Return an `ExpansionLock`:class: on the expansion of *source*,
+        the source of the module *module_name*, once acquired. If its
+        ``waited`` attribute is true, another process was expanding the
+        same source, and its result should be looked for with
+        `find`:meth: before expanding it again."""
+        file_name = self._file(self.path, 'l',
+                               self.source_key(module_name, source))
+        lock = ExpansionLock(file_name, self.lock_timeout)
+        if lock.waited:
+            self._count('waits')
+            if not lock.acquired:
+                self._count('timeouts')
+        return lock
+
+    def _count(self, name, n=1):
+        with self._lock:
+            self.stats[name] = self.stats.get(name, 0) + n
+
+    def _grow(self, size):
+        """Internal; account for a new file of *size* bytes, pruning the
+        cache if it becomes too big."""
+        with self._lock:
+            if self._size is None:
+                # the new file is already written
+                self._size = sum(size for _, size, _ in self._files())
+            else:
+                self._size += size
+            if self._size <= self.max_size:
+                return
+        self.prune()
+
+    def _files(self):
+        """Internal; yield a tuple of ``(mtime, size, path)`` for each file
+        in the local directory."""
+        for kind in ('m', 'r'):
+            for dirpath, dirnames, filenames in os.walk(
+                    os.path.join(self.path, kind)):
+                for fname in filenames:
+                    file_name = os.path.join(dirpath, fname)
+                    try:
+                        st = os.stat(file_name)
+                    except OSError:
+                        continue
+                    yield st.st_mtime, st.st_size, file_name
+
+    def prune(self, max_size=None):
+        """Remove the least recently used files until the size of the
+        cache is at most 90% of *max_size*, which defaults to the
+        configured one. Return the number of files removed."""
+        if max_size is None:
+            max_size = self.max_size
+        files = sorted(self._files())
+        size = sum(size for _, size, _ in files)
+        limit = max_size * 0.9
+        removed = 0
+        for mtime, file_size, file_name in files:
+            if size <= limit:
+                break
+            try:
+                os.unlink(file_name)
+            except OSError:
+                continue
+            size -= file_size
+            removed += 1
+        with self._lock:
+            self._size = size
+            self.stats['evictions'] += removed
+        return removed
+
+    def size(self):
+        """Return a tuple of the number of files and the total size of the
+        cache in bytes."""
+        files = list(self._files())
+        return len(files), sum(size for _, size, _ in files)
+
+    def load_stats(self):
+        """Return the counts saved in the ``stats`` file."""
+        try:
+            with open(os.path.join(self.path, 'stats'), 'rb') as f:
+                data = f.read()
+            stats = marshal.loads(data[len(self.header):])
+        except (OSError, EOFError, ValueError, TypeError):
+            return {}
+        return stats if isinstance(stats, dict) else {}
+
+    def save_stats(self):
+        """Add the counts of this process to the ``stats`` file, and reset
+        them. The file is updated under an `ExpansionLock`:class: on
+        ``stats.lock``, so the counts of the processes saving them at
+        the same time all get in. If it can't be acquired, the counts
+        are kept for the next time."""
+        with self._lock:
+            counts, self.stats = self.stats, dict.fromkeys(self.stats, 0)
+        if not any(counts.values()):
+            return
+        with ExpansionLock(os.path.join(self.path, 'stats.lock'),
+                           self.lock_timeout) as lock:
+            if fcntl is not None and not lock.acquired:
+                for name, count in counts.items():
+                    self._count(name, count)
+                return
+            stats = self.load_stats()
+            for name, count in counts.items():
+                stats[name] = stats.get(name, 0) + count
+            try:
+                os.makedirs(self.path, exist_ok=True)
+                _write_atomic(os.path.join(self.path, 'stats'),
+                              self.header + marshal.dumps(stats))
+            except OSError:
+                logger.debug('Could not write the stats of %r', self.path,
+                             exc_info=True)
@@ -1,7 +1,9 @@
 # -*- coding: utf-8 -*-
 
 import ast
+import hashlib
 import sys
+import threading
 
 PY33 = sys.version_info >= (3, 3)
 PY34 = sys.version_info >= (3, 4)
@@ -20,6 +22,36 @@ else:
 
 scope_nodes = function_nodes + (ast.ClassDef,)
 
+try:
+    from importlib.util import source_hash
+except ImportError:
+    # Python < 3.7 lacks PEP 552, use a truncated digest of the same size
+    def source_hash(source_bytes):
+        return hashlib.sha1(source_bytes).digest()[:8]
+
+try:
+    from contextvars import ContextVar
+except ImportError:
+    # Python < 3.7 lacks PEP 567, keep the values per thread
+    class ContextVar(object):
+        """The subset of `contextvars.ContextVar` used by MacroPy."""
+
+        def __init__(self, name, default=None):
+            self.name = name
+            self.default = default
+            self.local = threading.local()
+
+        def get(self):
+            return getattr(self.local, 'value', self.default)
+
+        def set(self, value):
+            token = self.get()
+            self.local.value = value
+            return token
+
+        def reset(self, token):
+            self.local.value = token
+
 
 def Call(func, args, keywords):
     """A version of ``ast.Call`` that deals with compatibility.
@@ -5,35 +5,31 @@ the source extent of an AST.
 Exposed to each macro as an `exact_src` function."""
 
 import ast
+import bisect
+import itertools
 
 from . import unparse
+from .analysis import AnalysisIndex, node_position
 from .macros import injected_vars
-from .util import Lazy, distinct, register
-from .walkers import Walker
-
-
-def linear_index(line_lengths, lineno, col_offset):
-    prev_length = sum(line_lengths[:lineno-1]) + lineno-2
-    out = prev_length + col_offset + 1
-    return out
-
-
-@Walker
-def indexer(tree, collect, **kw):
-    try:
-        # print('Indexer: %s' % ast.dump(tree), file=sys.stderr)
-        unparse(tree)
-        collect((tree.lineno, tree.col_offset))
-    except (AttributeError, KeyError) as e:
-        # If this handler gets executed it's because unparse() has
-        # failed (it's being used as a poor man's syntax
-        # checker). It's important to remember that unparse cannot
-        # unparse *any* tree fragment. There are certain fragments,
-        # (like an ast.Add without its parent ast.BinOp) that cannot
-        # be unparsed alone
-        pass
-        # print("Failure in exact_src.py", e, file=sys.stderr)
-        # raise
+from .util import Lazy, register
+
+
+def line_offsets(src):
+    """Return the offset in *src* of the start of each line."""
+    return list(itertools.accumulate(
+        [0] + [len(line) + 1 for line in src.split("\n")]))
+
+
+def linear_index(offsets, lineno, col_offset):
+    return offsets[lineno-1] + col_offset
+
+
+def positions(tree):
+    """Return the ``(lineno, col_offset)`` positions of the nodes in
+    *tree*, which can also be a list of trees."""
+    nodes = tree if isinstance(tree, list) else [tree]
+    return [pos for top in nodes if isinstance(top, ast.AST)
+            for pos in map(node_position, ast.walk(top)) if pos is not None]
 
 
 _transforms = {
@@ -45,16 +41,19 @@ _transforms = {
 
 
 @register(injected_vars)
-def exact_src(tree, src, **kw):
+def exact_src(tree, src, analysis_index=None, **kw):
 
-    def exact_src_imp(tree, src, indexes, line_lengths):
-        all_child_pos = sorted(indexer.collect(tree))
-        start_index = linear_index(line_lengths(), *all_child_pos[0])
+    def exact_src_imp(tree, src, indexes, offsets):
+        all_child_pos = sorted(positions(tree))
+        start_index = linear_index(offsets(), *all_child_pos[0])
 
-        last_child_index = linear_index(line_lengths(), *all_child_pos[-1])
+        last_child_index = linear_index(offsets(), *all_child_pos[-1])
 
-        first_successor_index = indexes()[min(indexes().index(last_child_index)+1,
-                                              len(indexes())-1)]
+        successors = indexes()
+        first_successor_index = successors[
+            min(bisect.bisect_right(successors, last_child_index),
+                len(successors)-1)]
+        unparsed = unparse(tree).strip()
 
         for end_index in range(last_child_index, first_successor_index+1):
 
@@ -73,18 +72,20 @@ def exact_src(tree, src, **kw):
                 else:
                     x = prelim
                 parsed = ast.parse(x)
-                if unparse(parsed).strip() == unparse(tree).strip():
+                if unparse(parsed).strip() == unparsed:
                     return prelim
 
             except SyntaxError as e:
                 pass
         raise ExactSrcException()
 
-    positions = Lazy(lambda: indexer.collect(tree))
-    line_lengths = Lazy(lambda: list(map(len, src.split("\n"))))
-    indexes = Lazy(lambda: distinct([linear_index(line_lengths(), l, c)
-                                for (l, c) in positions()] + [len(src)]))
-    return lambda t: exact_src_imp(t, src, indexes, line_lengths)
+    if analysis_index is None:
+        analysis_index = AnalysisIndex(tree)
+    offsets = Lazy(lambda: line_offsets(src))
+    indexes = Lazy(lambda: sorted(
+        {linear_index(offsets(), l, c)
+         for (l, c) in analysis_index.sorted_positions()} | {len(src)}))
+    return lambda t: exact_src_imp(t, src, indexes, offsets)
 
 
 class ExactSrcException(Exception):
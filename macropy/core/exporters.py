@@ -2,32 +2,28 @@
 """Ways of dealing with macro-expanded code, e.g. caching or
 re-serializing it."""
 
-import imp
+import collections
+import importlib.machinery
+import importlib.util
 import logging
 import marshal
+import mmap
 import os
 import shutil
+import sys
 
-from . import unparse
+from . import compat, unparse
 
 
 logger = logging.getLogger(__name__)
 
 
-def wr_long(f, x):
-    """Internal; write a 32-bit int to a file in little-endian order."""
-    f.write(chr( x        & 0xff))
-    f.write(chr((x >> 8)  & 0xff))
-    f.write(chr((x >> 16) & 0xff))
-    f.write(chr((x >> 24) & 0xff))
-
-
 class NullExporter(object):
-    def export_transformed(self, code, tree, module_name, file_name):
+    def export_transformed(self, code, tree, module_name, file_name,
+                           source=None, dependencies=None):
         pass
 
-    def find(self, file_path, pathname, description, module_name,
-             package_path):
+    def find(self, module_name, file_name, source):
         pass
 
 
@@ -38,7 +34,8 @@ class SaveExporter(object):
         shutil.rmtree(self.directory, ignore_errors=True)
         shutil.copytree(self.root, directory)
 
-    def export_transformed(self, code, tree, module_name, file_name):
+    def export_transformed(self, code, tree, module_name, file_name,
+                           source=None, dependencies=None):
 
         # do the export only if module's file_name is a subpath of the
         # root
@@ -50,44 +47,345 @@ class SaveExporter(object):
                 os.path.relpath(file_name, self.root)
             )
 
+            if tree is None:
+                # loaded from a cache, there's nothing to unparse
+                return
             with open(new_path, "w") as f:
                 f.write(unparse(tree))
             logger.debug('Exported module %r to %r', file_name, new_path)
 
-    def find(self, file_path, pathname, description, module_name, package_path):
+    def find(self, module_name, file_name, source):
         pass
 
 
-suffix = __debug__ and 'c' or 'o'
+_file_hashes = {}
+
+
+def file_hash(file_name):
+    """Return the `~.compat.source_hash` of the contents of *file_name* or
+    ``None`` if it cannot be read. The result is memoized by the file's
+    ``mtime`` and size, so checking an unchanged file costs only a
+    ``stat()``."""
+    try:
+        st = os.stat(file_name)
+    except OSError:
+        return None
+    key = (st.st_mtime_ns, st.st_size)
+    cached = _file_hashes.get(file_name)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+    try:
+        with open(file_name, 'rb') as f:
+            digest = compat.source_hash(f.read())
+    except OSError:
+        return None
+    _file_hashes[file_name] = (key, digest)
+    return digest
+
+
+def dependencies_changed(dependencies):
+    """Tell if any file recorded in a manifest, as returned by
+    `~.import_hooks.MacroFinder.expand_macros`:meth:, has changed since
+    the manifest was created."""
+    return any(file_hash(file_name) != digest
+               for file_name, digest in dependencies.values())
+
+
+# The flags of a PEP 552 hash-based pyc that must be checked against its
+# source.
+PYC_FLAGS = 0b11
+
+
+def _pack_uint32(x):
+    """Internal; convert a 32-bit int to 4 bytes in little-endian order."""
+    return (int(x) & 0xFFFFFFFF).to_bytes(4, 'little')
+
+
+def _write_atomic(path, data):
+    """Write *data* to *path* by way of a temporary file, so that
+    concurrent readers never see a partially written file."""
+    path_tmp = '{}.{}.{}'.format(path, os.getpid(), id(path))
+    try:
+        with open(path_tmp, 'wb') as f:
+            f.write(data)
+        os.replace(path_tmp, path)
+    except OSError:
+        try:
+            os.unlink(path_tmp)
+        except OSError:
+            pass
+        raise
 
 
 class PycExporter(object):
+    """Caches the macro-expanded code of each module in the
+    ``__pycache__`` directory next to its source, using PEP 552
+    hash-based ``.pyc`` files. They are stored with a ``macropy``
+    optimization tag so that they never clash with the ones written by
+    the standard import machinery for the unexpanded source.
+
+    Beside the code, each file records the name of the module and the
+    manifest of the macro modules used to expand it, so that a cached
+    expansion is discarded when any of them changes.
+    """
+
+    optimization = 'macropy'
+
     def __init__(self, root=os.getcwd()):
         self.root = root
 
-    def export_transformed(self, code, tree, module_name, file_name):
-        """TODO: this needs to be updated, look into py_compile.compile, the
-        following code was copied verbatim from there on python2"""
-        f = open(file_name + suffix , 'wb')
-        f.write('\0\0\0\0')
-        timestamp = long(os.fstat(f.fileno()).st_mtime)
-        wr_long(f, timestamp)
-        marshal.dump(code, f)
-        f.flush()
-        f.seek(0, 0)
-        f.write(imp.get_magic())
-
-    def find(self, file_path, pathname, description, module_name, package_path):
+    def cache_path(self, file_name):
+        """Return the path of the cached ``.pyc`` for *file_name* or
+        ``None`` if caching isn't supported."""
+        try:
+            return importlib.util.cache_from_source(
+                file_name, optimization=self.optimization)
+        except (NotImplementedError, ValueError):
+            return None
+
+    def export_transformed(self, code, tree, module_name, file_name,
+                           source=None, dependencies=None):
+        if source is None or sys.dont_write_bytecode:
+            return
+        cache_path = self.cache_path(file_name)
+        if cache_path is None:
+            return
+        data = bytearray(importlib.util.MAGIC_NUMBER)
+        data.extend(_pack_uint32(PYC_FLAGS))
+        data.extend(compat.source_hash(source.encode('utf-8')))
+        data.extend(marshal.dumps((module_name, dependencies or {}, code)))
+        try:
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            _write_atomic(cache_path, data)
+        except OSError:
+            logger.debug('Could not write cache file %r', cache_path,
+                         exc_info=True)
+            return
+        logger.debug('Cached expansion of %r in %r', module_name, cache_path)
+
+    def _read(self, cache_path, source=None):
+        """Internal; read a cache file, returning a tuple of ``(module_name,
+        dependencies, code)`` or ``None`` if it's invalid. If *source*
+        is given, it must match the hash recorded in the file."""
+        try:
+            with open(cache_path, 'rb') as f:
+                data = f.read()
+        except OSError:
+            return None
+        if (data[:4] != importlib.util.MAGIC_NUMBER or
+            data[4:8] != _pack_uint32(PYC_FLAGS)):  # noqa: E129
+            return None
+        if (source is not None and
+            data[8:16] != compat.source_hash(source.encode('utf-8'))):  # noqa: E129
+            logger.debug('Cache file %r is stale', cache_path)
+            return None
         try:
-            file = open(file_path, 'rb')
-            f = open(file.name + suffix, 'rb')
-            py_time = os.fstat(file.fileno()).st_mtime
-            pyc_time = os.fstat(f.fileno()).st_mtime
-
-            if py_time > pyc_time:
-                return None
-            x = imp.load_compiled(module_name, pathname + suffix, f)
-            return x
-        except Exception as e:
-            # print(e)
-            raise
+            return marshal.loads(data[16:])
+        except (EOFError, ValueError, TypeError):
+            logger.debug('Cache file %r is corrupted', cache_path)
+            return None
+
+    def find(self, module_name, file_name, source):
+        cache_path = self.cache_path(file_name)
+        if cache_path is None:
+            return None
+        entry = self._read(cache_path, source)
+        if entry is None:
+            return None
+        _, dependencies, code = entry
+        if dependencies_changed(dependencies):
+            logger.debug('Dependencies of cache file %r have changed',
+                         cache_path)
+            return None
+        return code, dependencies
+
+    def cached(self, roots=None):
+        """Iterate over the expansions cached under *roots* (defaults to
+        the exporter's ``root``), yielding a tuple of ``(module_name,
+        file_name, dependencies)`` for each of them."""
+        suffix = '.{}.opt-{}{}'.format(
+            sys.implementation.cache_tag, self.optimization,
+            importlib.machinery.BYTECODE_SUFFIXES[0])
+        for root in roots or [self.root]:
+            for dirpath, dirnames, filenames in os.walk(root):
+                if os.path.basename(dirpath) != '__pycache__':
+                    continue
+                for fname in filenames:
+                    if not fname.endswith(suffix):
+                        continue
+                    cache_path = os.path.join(dirpath, fname)
+                    entry = self._read(cache_path)
+                    if entry is None:
+                        continue
+                    module_name, dependencies, _ = entry
+                    yield (module_name,
+                           importlib.util.source_from_cache(cache_path),
+                           dependencies)
+
+    def dependents(self, module_name, roots=None):
+        """Return the sorted names of the modules cached under *roots*
+        whose expansion used the macro module *module_name*, either
+        directly or through another macro module."""
+        return sorted(name for name, _, dependencies in self.cached(roots)
+                      if module_name in dependencies)
+
+
+# The leading bytes of an archive written by ArchiveExporter, followed by the
+# magic number of the Python that compiled the code.
+ARCHIVE_HEADER = b'MPAR\x01'
+
+
+class ArchiveExporter(object):
+    """Collects the expanded code of the modules imported by an
+    application into a single archive file, to be served by
+    `ExpansionArchive`:class:. Install it as ``macropy.exporter``, import
+    the application as it happens at startup and call `save`:meth:::
+
+        macropy.exporter = ArchiveExporter('app.mpar')
+        import myapp.wsgi
+        macropy.exporter.save()
+
+    The modules are recorded in the order their import completes, and
+    their code laid out in that order after the index, so that a cold
+    start reads the archive sequentially.
+
+    :param path: the path of the archive
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = collections.OrderedDict()
+
+    def export_transformed(self, code, tree, module_name, file_name,
+                           source=None, dependencies=None):
+        try:
+            st = os.stat(file_name)
+            stamp = (st.st_mtime_ns, st.st_size)
+        except OSError:
+            stamp = None
+        is_package = os.path.splitext(
+            os.path.basename(file_name))[0] == '__init__'
+        self.entries.pop(module_name, None)
+        self.entries[module_name] = (file_name, is_package, stamp,
+                                     dependencies or {}, marshal.dumps(code))
+
+    def find(self, module_name, file_name, source):
+        pass
+
+    def save(self):
+        """Write the archive with the modules recorded so far, replacing
+        any previous one atomically. Returns the number of modules."""
+        index = []
+        blobs = []
+        offset = 0
+        for module_name, entry in self.entries.items():
+            file_name, is_package, stamp, dependencies, blob = entry
+            index.append((module_name, file_name, is_package, stamp,
+                          dependencies, offset, len(blob)))
+            blobs.append(blob)
+            offset += len(blob)
+        index = marshal.dumps(tuple(index))
+        data = bytearray(ARCHIVE_HEADER)
+        data.extend(importlib.util.MAGIC_NUMBER)
+        data.extend(_pack_uint32(len(index)))
+        data.extend(index)
+        for blob in blobs:
+            data.extend(blob)
+        _write_atomic(self.path, data)
+        logger.debug('Archived %d modules in %r', len(self.entries), self.path)
+        return len(self.entries)
+
+
+ArchiveEntry = collections.namedtuple('ArchiveEntry', [
+    'module_name', 'file_name', 'is_package', 'stamp', 'dependencies',
+    'offset', 'length'])
+
+
+class ExpansionArchive(object):
+    """Read-only access to an archive written by `ArchiveExporter`:class:.
+    The file is mapped in memory, so that opening it costs a single
+    read of its index and the pages holding the code are shared by all
+    the processes using the same archive, like the workers forked by a
+    server.
+
+    By default, the archive is trusted to be in sync with the sources,
+    which aren't looked at. With *check*, a module is served from it
+    only if its source and the macro modules used to expand it are
+    unchanged, at the cost of a ``stat()`` of each of them.
+
+    :param path: the path of the archive
+    :param check: if true, check each module against its source
+    :raises ValueError: if the file isn't an archive written by this
+      version of Python
+    """
+
+    def __init__(self, path, check=False):
+        self.path = path
+        self.check = check
+        with open(path, 'rb') as f:
+            try:
+                self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                raise ValueError('Empty archive {!r}'.format(path))
+        header = len(ARCHIVE_HEADER)
+        start = header + 8
+        if (self.data[:header] != ARCHIVE_HEADER or
+            self.data[header:header + 4] != importlib.util.MAGIC_NUMBER):  # noqa: E129
+            self.close()
+            raise ValueError('Invalid or outdated archive {!r}'.format(path))
+        length = int.from_bytes(self.data[header + 4:start], 'little')
+        try:
+            index = marshal.loads(self.data[start:start + length])
+        except (EOFError, ValueError, TypeError):
+            self.close()
+            raise ValueError('Corrupted archive {!r}'.format(path))
+        self.base = start + length
+        self.entries = collections.OrderedDict(
+            (entry[0], ArchiveEntry(*entry)) for entry in index)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, module_name):
+        return module_name in self.entries
+
+    def lookup(self, module_name):
+        """Return the `ArchiveEntry` of the module *module_name*, or
+        ``None`` if it isn't archived, or it's stale and `check` is
+        true."""
+        entry = self.entries.get(module_name)
+        if entry is None or not self.check:
+            return entry
+        try:
+            st = os.stat(entry.file_name)
+        except OSError:
+            return None
+        if ((st.st_mtime_ns, st.st_size) != entry.stamp or
+            dependencies_changed(entry.dependencies)):  # noqa: E129
+            logger.debug('Archived module %r is stale', module_name)
+            return None
+        return entry
+
+    def code(self, entry):
+        """Return the code object of the module recorded in *entry*,
+        loaded straight from the mapped pages."""
+        start = self.base + entry.offset
+        with memoryview(self.data) as view:
+            return marshal.loads(view[start:start + entry.length])
+
+    def close(self):
+        """Unmap the archive."""
+        self.data.close()
+
+
+def load_archive(path, check=False):
+    """Return an `ExpansionArchive`:class: for *path*, or ``None`` if
+    it's missing or unusable, for instance because it was written by
+    another version of Python."""
+    if not os.path.exists(path):
+        return None
+    try:
+        return ExpansionArchive(path, check)
+    except (OSError, ValueError):
+        logger.warning('Could not load the archive %r', path, exc_info=True)
+        return None
@@ -5,47 +5,38 @@ use.
 Exposes this functionality as the `gen_sym` function.
 """
 
-import ast
-
-from . import compat, macros, util, walkers
+from . import macros, util
+from .analysis import AnalysisIndex
 
 
 @util.register(macros.injected_vars)
-def gen_sym(tree, **kw):
+def gen_sym(tree, analysis_index=None, **kw):
     """Create a generator that creates symbols which are not used in the
     given `tree`. This means they will be hygienic, i.e. it guarantees
     that they will not cause accidental shadowing, as long as the
     scope of the new symbol is limited to `tree` e.g. by a lambda
-    expression or a function body
+    expression or a function body. The names used in `tree` are looked
+    up in its `~.analysis.AnalysisIndex`:class:, which is built the
+    first time a symbol is requested, so that the modules whose macros
+    don't need any don't pay for it.
     """
-    @walkers.Walker
-    def name_finder(tree, collect, **kw):
-        ttree = type(tree)
-        if ttree is ast.Name:
-            collect(tree.id)
-        elif ttree is ast.arg:
-            collect(tree.arg)
-        elif ttree is ast.Import:
-            names = [x.asname or x.name for x in tree.names]
-            for name in names:
-                collect(name)
-        elif ttree is ast.ImportFrom:
-            names = [x.asname or x.name for x in tree.names]
-            for name in names:
-                collect(name)
-        elif ttree in compat.scope_nodes:
-            collect(tree.name)
+    if analysis_index is None:
+        analysis_index = AnalysisIndex(tree)
+    generated = set()
+    # the next suffix to try for each name
+    offsets = {}
 
-    found_names = set(name_finder.collect(tree))
+    def used(name):
+        return name in generated or name in analysis_index
 
     def name_for(name="sym"):
-
-        if name not in found_names:
-            found_names.add(name)
+        if name not in offsets and not used(name):
+            generated.add(name)
             return name
-        offset = 1
-        while name + str(offset) in found_names:
+        offset = offsets.get(name, 1)
+        while used(name + str(offset)):
             offset += 1
-        found_names.add(name + str(offset))
+        offsets[name] = offset + 1
+        generated.add(name + str(offset))
         return name + str(offset)
     return name_for
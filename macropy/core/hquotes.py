@@ -6,8 +6,8 @@ scope rather than their expansion scope.
 import ast
 import pickle
 
-from .macros import (Macros, check_annotated, filters, injected_vars,
-                     macro_stub, post_processing)
+from .macros import (Macros, NodeFilter, check_annotated, filters,
+                     injected_vars, macro_stub, post_processing)
 
 from .quotes import (macros, q, unquote_search, u, ast_list,   # noqa: F401
                      name, ast_literal)
@@ -68,22 +68,17 @@ def post_proc(tree, captured_registry, gen_sym, **kw):
 
 
 @register(filters)
+@NodeFilter
 def hygienate(tree, captured_registry, gen_sym, **kw):
-    # print('Hygienate %s' % ast.dump(tree) if isinstance(tree, ast.AST)
-    #       else tree, file=sys.stderr)
-    @Walker
-    def hygienator(tree, stop, **kw):
-        if type(tree) is Captured:
-            new_sym = [sym for val, sym in captured_registry
-                       if val is tree.val]
-            if not new_sym:
-                new_sym = gen_sym(tree.name)
-                captured_registry.append((tree.val, new_sym))
-            else:
-                new_sym = new_sym[0]
-            return ast.Name(new_sym, ast.Load())
-
-    return hygienator.recurse(tree)
+    if type(tree) is Captured:
+        new_sym = [sym for val, sym in captured_registry
+                   if val is tree.val]
+        if not new_sym:
+            new_sym = gen_sym(tree.name)
+            captured_registry.append((tree.val, new_sym))
+        else:
+            new_sym = new_sym[0]
+        return ast.Name(new_sym, ast.Load())
 
 
 @macros.block
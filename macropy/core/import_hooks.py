@@ -4,20 +4,80 @@ MacroPy"""
 
 import ast
 import importlib
-from importlib.util import spec_from_loader
+import importlib.machinery
+from importlib.util import (decode_source, spec_from_file_location,
+                            spec_from_loader)
 import logging
+import os
 import sys
+import weakref
 
-import macropy.activate
+import macropy
 
 from . import macros  # noqa: F401
+from . import compat
 from . import exporters  # noqa: F401
+from .profiling import phase
 from .util import singleton
 
 
 logger = logging.getLogger(__name__)
 
 
+def macro_dependencies(module_names):
+    """Build the manifest of the given macro modules, which is a mapping
+    between the name of each module and a tuple of ``(file_name, hash)``.
+    It also includes the macro modules used to expand them, the
+    modules that hook into every expansion (the providers of
+    `~.macros.filters`, `~.macros.injected_vars` and
+    `~.macros.post_processing`) and `~.macros` itself.
+    """
+    hooks = (macropy.core.macros.filters +
+             macropy.core.macros.injected_vars +
+             macropy.core.macros.post_processing)
+    names = (list(module_names) + [f.__module__ for f in hooks] +
+             [macropy.core.macros.__name__])
+    dependencies = {}
+    for name in names:
+        if name in dependencies:
+            continue
+        mod = sys.modules.get(name)
+        file_name = getattr(mod, '__file__', None)
+        if file_name is None:
+            continue
+        dependencies[name] = (file_name, loaded_hash(mod, file_name))
+        loader = getattr(getattr(mod, '__spec__', None), 'loader', None)
+        if isinstance(loader, (MacroLoader, MacroSourceLoader,
+                               ArchiveLoader)):
+            # a macro module that uses macros itself
+            for dep_name, dep in loader.dependencies.items():
+                dependencies.setdefault(dep_name, dep)
+    return dependencies
+
+
+_loaded_hashes = weakref.WeakKeyDictionary()
+
+
+def loaded_hash(mod, file_name):
+    """Return the hash of the source that the module *mod* was loaded
+    from, which is *file_name*. The source may have been changed since
+    then, while the module in memory, that expands the macros, hasn't.
+    It's recorded by `MacroSourceLoader`:class: when it reads the
+    source, otherwise the file is hashed the first time it's asked for
+    and the result kept until the module is reloaded."""
+    spec = getattr(mod, '__spec__', None)
+    source_hash = getattr(getattr(spec, 'loader', None), 'source_hash',
+                          None)
+    if source_hash is not None:
+        return source_hash
+    entry = _loaded_hashes.get(mod)
+    if entry is not None and entry[0] is spec:
+        return entry[1]
+    source_hash = macropy.core.exporters.file_hash(file_name)
+    _loaded_hashes[mod] = (spec, source_hash)
+    return source_hash
+
+
 class _MacroLoader(object):
     """Performs the loading of a module with macro expansion."""
 
@@ -34,25 +94,41 @@ class MacroLoader:
     there until the export stuff is fixed.
     """
 
-    def __init__(self, nomacro_spec, code, tree):
+    def __init__(self, nomacro_spec, code, tree, source=None,
+                 dependencies=None):
         self.nomacro_spec = nomacro_spec
         self.code = code
         self.tree = tree
+        self.source = source
+        self.dependencies = dependencies or {}
 
     def create_module(self, spec):
         pass
 
     def exec_module(self, module):
-        exec(self.code, module.__dict__)
+        with phase('exec', self.nomacro_spec.name):
+            exec(self.code, module.__dict__)
         self.export()
+        self.release()
+
+    def release(self):
+        """Drop the code, the tree and the source of the module, which
+        are kept alive by its spec, unless
+        `MacroFinder.keep_expansions` is true. The dependencies are
+        kept, see `macro_dependencies`:func:."""
+        if not MacroFinder.keep_expansions:
+            self.code = self.tree = self.source = None
 
     def export(self):
-        try:
+        # a code loaded from a cache has no tree, the exporters that
+        # need it skip it
+        if self.code is None:
+            return
+        with phase('export', self.nomacro_spec.name):
             macropy.exporter.export_transformed(
                 self.code, self.tree, self.nomacro_spec.name,
-                self.nomacro_spec.origin)
-        except Exception as e:
-            raise
+                self.nomacro_spec.origin, source=self.source,
+                dependencies=self.dependencies)
 
     def get_filename(self, fullname):
         return self.nomacro_spec.loader.get_filename(fullname)
@@ -61,12 +137,244 @@ class MacroLoader:
         return self.nomacro_spec.loader.is_package(fullname)
 
 
+class MacroSourceLoader(importlib.machinery.SourceFileLoader):
+    """A `~importlib.machinery.SourceFileLoader`:class: that expands the
+    macros while compiling the source of a module, so that each file is
+    read only once. The modules without macros are compiled and their
+    bytecode cached in ``__pycache__`` as usual, and a fresh ``.pyc``
+    is loaded without opening the source at all. The expanded code is
+    never written there, it's given to the exporter instead.
+
+    :param fullname: the name of the module
+    :param path: the path of its source
+    :param finder: the `MacroFinder`:class: that found it
+    :param spec: the spec of the module, as found by the standard
+      machinery
+    """
+
+    def __init__(self, fullname, path, finder, spec):
+        super().__init__(fullname, path)
+        self.finder = finder
+        self.spec = spec
+        self._reset()
+
+    def _reset(self):
+        self.code = None
+        self.tree = None
+        self.source = None
+        self.dependencies = {}
+        self.expanded = False
+        self.source_hash = None
+
+    def get_code(self, fullname):
+        self._reset()
+        code = super().get_code(fullname)
+        if self.expanded:
+            return code
+        if 'macros' in code.co_names:
+            # a fresh .pyc of a module that imports macros was written
+            # without the import hook, expand its source
+            code = self.source_to_code(self.get_data(self.path), self.path)
+        elif self.finder.usage_index is not None:
+            # without the name it has no macro imports
+            self.finder.usage_index.record(self.path, False)
+        return code
+
+    def get_data(self, path):
+        if path == self.path:
+            with phase('read', self.name):
+                return super().get_data(path)
+        return super().get_data(path)
+
+    def source_to_code(self, data, path, *, _optimize=-1):
+        source = decode_source(data)
+        self.source_hash = compat.source_hash(data)
+        index = self.finder.usage_index
+        code = None
+        if macropy.core.macros.has_macro_imports(source):
+            code, tree, dependencies = self.finder.find_or_expand(
+                self.name, path, source, self.spec)
+            if code is not None:
+                self.dependencies = dependencies
+                if tree is not None:
+                    self.tree = tree
+                    self.source = source
+        if index is not None:
+            index.record(path, code is not None)
+        if code is None:
+            return super().source_to_code(data, path, _optimize=_optimize)
+        self.code = code
+        self.expanded = True
+        return code
+
+    def set_data(self, path, data, *, _mode=0o666):
+        # the expanded code depends on the macro modules too, it's
+        # cached by the exporter
+        if not self.expanded:
+            super().set_data(path, data, _mode=_mode)
+
+    def exec_module(self, module):
+        code = self.get_code(module.__name__)
+        with phase('exec', self.name):
+            exec(code, module.__dict__)
+        del code
+        self.export()
+        self.release()
+
+    def release(self):
+        """The same as `MacroLoader.release`:meth:."""
+        if not self.finder.keep_expansions:
+            self.code = self.tree = self.source = None
+
+    def export(self):
+        if self.code is None:
+            return
+        with phase('export', self.name):
+            macropy.exporter.export_transformed(
+                self.code, self.tree, self.name, self.path,
+                source=self.source, dependencies=self.dependencies)
+
+
+class ArchiveLoader(object):
+    """Loads a module from an `~.exporters.ExpansionArchive`:class:,
+    without looking at its source.
+
+    :param archive: the archive
+    :param entry: the `~.exporters.ArchiveEntry` of the module
+    """
+
+    def __init__(self, archive, entry):
+        self.archive = archive
+        self.entry = entry
+        self.dependencies = entry.dependencies
+
+    def create_module(self, spec):
+        pass
+
+    def exec_module(self, module):
+        name = self.entry.module_name
+        with phase('cache', name):
+            code = self.archive.code(self.entry)
+        with phase('exec', name):
+            exec(code, module.__dict__)
+
+    def get_filename(self, fullname):
+        return self.entry.file_name
+
+    def is_package(self, fullname):
+        return self.entry.is_package
+
+    def get_source(self, fullname):
+        try:
+            with open(self.entry.file_name, 'rb') as f:
+                return decode_source(f.read())
+        except OSError:
+            return None
+
+
+class ImportFilter(object):
+    """Decides which modules the import hook should look into, using
+    rules that are either dotted package prefixes (like ``myapp`` or
+    ``myapp.models``) or filesystem roots (like ``/srv/myapp``), to
+    include or exclude. Package rules are checked first, then the
+    filesystem ones, and in each group the most specific matching rule
+    wins. When any rule to include modules is given, the modules that
+    match no rule are excluded, with the exception of ``macropy``
+    itself.
+
+    :param include: an iterable of rules selecting modules to look into
+    :param exclude: an iterable of rules selecting modules to skip
+    """
+
+    def __init__(self, include=(), exclude=()):
+        self.names = {}
+        self.roots = {}
+        rules = ([(rule, True) for rule in include] +
+                 [(rule, False) for rule in exclude])
+        for rule, value in rules:
+            if self.is_path(rule):
+                path = os.path.abspath(os.path.expanduser(rule))
+                self.roots[os.path.normcase(path)] = value
+            else:
+                self.names[rule] = value
+        self.default = not any(value for rule, value in rules)
+
+    @staticmethod
+    def is_path(rule):
+        """Tell if *rule* is a filesystem path rather than a package
+        name."""
+        return (os.sep in rule or (os.altsep and os.altsep in rule) or
+                rule in (os.curdir, os.pardir) or rule.startswith('~'))
+
+    def match_default(self, fullname):
+        """Tell if the module named *fullname*, matching no rule, is in
+        scope."""
+        return (self.default or fullname == 'macropy' or
+                fullname.startswith('macropy.'))
+
+    def match_name(self, fullname):
+        """Tell if the module named *fullname* is in scope, using the
+        package rules only. Returns ``None`` if that cannot be decided
+        without knowing where the module is."""
+        name = fullname
+        while name:
+            value = self.names.get(name)
+            if value is not None:
+                return value
+            name = name.rpartition('.')[0]
+        if not self.roots:
+            return self.match_default(fullname)
+        return None
+
+    def match_path(self, fullname, file_name):
+        """Tell if the module named *fullname*, whose source is at
+        *file_name*, is in scope, using the filesystem rules only."""
+        if file_name:
+            path = os.path.normcase(os.path.dirname(file_name))
+            while True:
+                value = self.roots.get(path)
+                if value is not None:
+                    return value
+                parent = os.path.dirname(path)
+                if parent == path:
+                    break
+                path = parent
+        return self.match_default(fullname)
+
+
 @singleton
 class MacroFinder(object):
     """Loads a module and looks for macros inside, only providing a loader
     if it finds some.
     """
 
+    # An optional UsageIndex used to skip the modules known to have no macro
+    # imports.
+    usage_index = None
+
+    # An optional ImportFilter used to skip the modules out of scope.
+    import_filter = None
+
+    # If true, the loaders keep the expanded tree, code and source of each
+    # module after its execution, as ``code``, ``tree`` and ``source``, for
+    # debugging.
+    keep_expansions = False
+
+    # An optional ExpansionCache shared with other projects.
+    expansion_cache = None
+
+    # An optional ExpansionArchive serving the modules it contains before any
+    # lookup on the filesystem.
+    archive = None
+
+    # An optional ExpansionClient asking a server for the expansions not found
+    # in the caches.
+    expansion_server = None
+
+    # An optional Prefetcher expanding the modules of some packages in the
+    # background.
+    prefetcher = None
+
     def _find_spec_nomacro(self, fullname, path, target=None):
         """Try to find the original, non macro-expanded module using all the
         remaining meta_path finders. This one is installed by
@@ -89,34 +397,125 @@ class MacroFinder(object):
 
     def expand_macros(self, source_code, filename, spec):
         """ Parses the source_code and expands the resulting ast.
-        Returns both the compiled ast and new ast.
-        If no macros are found, returns None, None."""
-        if not source_code or "macros" not in source_code:
-            return None, None
+        Returns the compiled ast, the new ast and the manifest of the
+        macro modules used (see `macro_dependencies`:func:).
+        If no macros are found, returns None, None, None."""
+        if not macropy.core.macros.has_macro_imports(source_code):
+            return None, None, None
 
         logger.info('Expand macros in %s', filename)
 
-        tree = ast.parse(source_code)
-        bindings = macropy.core.macros.detect_macros(tree, spec.name,
-                                                     spec.parent,
-                                                     spec.name)
+        with phase('parse', spec.name):
+            tree = ast.parse(source_code)
+        with phase('detect', spec.name):
+            bindings = macropy.core.macros.detect_macros(tree, spec.name,
+                                                         spec.parent,
+                                                         spec.name)
 
         if not bindings:
-            return None, None
+            return None, None, None
 
         modules = []
-        for mod, bind in bindings:
-            modules.append((importlib.import_module(mod), bind))
-        new_tree = macropy.core.macros.ModuleExpansionContext(
-            tree, source_code, modules).expand_macros()
+        with phase('import', spec.name):
+            for mod, bind in bindings:
+                modules.append((importlib.import_module(mod), bind))
+        with phase('expand', spec.name):
+            ctx = macropy.core.macros.ModuleExpansionContext(
+                tree, source_code, modules)
+            new_tree = ctx.expand_macros()
+            ctx.release()
         try:
-            return compile(tree, filename, "exec"), new_tree
+            with phase('compile', spec.name):
+                code = compile(tree, filename, "exec")
         except Exception:
             logger.exception("Error while compiling file %s", filename)
             raise
+        dependencies = macro_dependencies([mod for mod, bind in bindings])
+        if self.expansion_cache is not None:
+            with phase('cache', spec.name):
+                self.expansion_cache.store(code, spec.name, filename,
+                                           source_code, dependencies)
+        return code, new_tree, dependencies
+
+    def find_expansion(self, fullname, file_name, source, ask_server=True):
+        """Try to find an already expanded module before doing any
+        expansion work, first in the exporter, then in the
+        `expansion_cache` and finally from the `expansion_server`,
+        unless *ask_server* is false. Return a tuple of ``(code,
+        dependencies)`` or ``None``."""
+        with phase('cache', fullname):
+            cached = macropy.exporter.find(fullname, file_name, source)
+            if cached is None and self.expansion_cache is not None:
+                cached = self.expansion_cache.find(fullname, file_name,
+                                                   source)
+            if (cached is None and ask_server and
+                self.expansion_server is not None):  # noqa: E129
+                cached = self.expansion_server.find(fullname, file_name,
+                                                    source)
+        return cached
+
+    def find_or_expand(self, fullname, file_name, source, spec,
+                       ask_server=True):
+        """Return the expansion of the module *fullname*, found with
+        `find_expansion`:meth: or made with `expand_macros`:meth:, as a
+        tuple of ``(code, tree, dependencies)``. The tree is ``None``
+        when the code comes from a cache. *ask_server* is passed to
+        `find_expansion`:meth:.
+
+        The expansions made in the background by the `prefetcher` are
+        used first. With an `expansion_cache`, only one process at a
+        time expands the same source, the others wait for it and use
+        its result, see `~.cache.ExpansionCache.lock`:meth:."""
+        cached = None
+        prefetcher = self.prefetcher
+        if prefetcher is not None:
+            with phase('cache', fullname):
+                cached = prefetcher.take(fullname, file_name, source)
+        if cached is None:
+            cached = self.find_expansion(fullname, file_name, source,
+                                         ask_server)
+        cache = self.expansion_cache
+        if cached is None and cache is not None:
+            with phase('cache', fullname):
+                lock = cache.lock(fullname, source)
+            with lock:
+                if lock.waited:
+                    with phase('cache', fullname):
+                        cached = cache.find(fullname, file_name, source,
+                                            retry=True)
+                if cached is None:
+                    return self.expand_macros(source, file_name, spec)
+        if cached is None:
+            return self.expand_macros(source, file_name, spec)
+        logger.info('Loaded cached expansion of %s', file_name)
+        code, dependencies = cached
+        return code, None, dependencies
 
     def find_spec(self, fullname, path, target=None):
-        spec = self._find_spec_nomacro(fullname, path, target)
+        import_filter = self.import_filter
+        in_scope = None
+        if import_filter is not None:
+            in_scope = import_filter.match_name(fullname)
+            if in_scope is False:
+                return
+        archive = self.archive
+        if archive is not None:
+            entry = archive.lookup(fullname)
+            if entry is not None:
+                return spec_from_file_location(
+                    fullname, entry.file_name,
+                    loader=ArchiveLoader(archive, entry),
+                    submodule_search_locations=[] if entry.is_package
+                    else None)
+        index = self.usage_index
+        if index is not None and index.lookup_module(fullname,
+                                                     path) is False:
+            return
+        with phase('find', fullname):
+            spec = self._find_spec_nomacro(fullname, path, target)
+        prefetcher = self.prefetcher
+        if prefetcher is not None and spec is not None:
+            prefetcher.package_found(fullname, spec, self.usage_index)
         if spec is None or not (hasattr(spec.loader, 'get_source') and
             callable(spec.loader.get_source)):  # noqa: E128
             if fullname != 'org':
@@ -128,15 +527,22 @@ class MacroFinder(object):
         origin = spec.origin
         if origin == 'builtin':
             return
-        # # try to find already exported module
-        # # TODO: are these the right arguments?
-        # # NOTE: This is a noop
-        # module = macropy.core.exporters.NullExporter().find(
-        #     file_path, file_path, "", module_name, package_path)
-        # if module:
-        #     return _MacroLoader(ast.mod)
+        if in_scope is None and import_filter is not None:
+            if not import_filter.match_path(fullname, origin):
+                return
+        if index is not None and spec.has_location:
+            index.record_module(fullname, path, origin)
+            if index.lookup(origin) is False:
+                return
+        if type(spec.loader) is importlib.machinery.SourceFileLoader:
+            # the source is read, and the macros detected, only if
+            # there's no fresh bytecode
+            spec.loader = MacroSourceLoader(fullname, origin, self, spec)
+            return spec
         try:
-            source = spec.loader.get_source(fullname)
+            with phase('read', fullname):
+                source = spec.loader.get_source(fullname)
+                has_macros = macropy.core.macros.has_macro_imports(source)
         except ImportError:
             logging.debug('Loader for %s was unable to find the sources',
                           fullname)
@@ -144,8 +550,18 @@ class MacroFinder(object):
         except Exception:
             logging.exception('Loader for %s raised an error', fullname)
             return
-        code, tree = self.expand_macros(source, origin, spec)
+        if not has_macros:
+            if index is not None:
+                index.record(origin, False)
+            return
+        code, tree, dependencies = self.find_or_expand(fullname, origin,
+                                                       source, spec)
+        if index is not None:
+            index.record(origin, code is not None)
+        if tree is None and code is not None:
+            return spec_from_loader(fullname, MacroLoader(
+                spec, code, None, dependencies=dependencies))
         if not code:  # no macros!
             return
-        loader = MacroLoader(spec, code, tree)
+        loader = MacroLoader(spec, code, tree, source, dependencies)
         return spec_from_loader(fullname, loader)
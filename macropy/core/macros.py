@@ -4,24 +4,37 @@
 from abc import ABC, abstractmethod
 import ast
 import collections
+import collections.abc
 import functools
 import importlib
 import inspect
 import logging
+import re
 import sys
+import threading
+import weakref
 
 from . import compat, real_repr, Captured, Literal
+from . import profiling
+from .memo import expansion_memo
+from .walkers import _SPLICE, _SPLICED, _place
 
 logger = logging.getLogger(__name__)
 
-"""Contains the current running expansion contexes."""
-EXPANSION_CONTEXES = []
+# Contains the current running expansion contexes, as a tuple. It's a context
+# variable so that each thread expanding a module sees its own.
+EXPANSION_CONTEXES = compat.ContextVar('EXPANSION_CONTEXES', default=())
+
+# Serializes the registration of macros and of the functions in the registries
+# below, which may happen in concurrent imports.
+registry_lock = threading.RLock()
 
 
 def get_current_context():
     """Returns the current expansion context."""
-    if len(EXPANSION_CONTEXES):
-        return EXPANSION_CONTEXES[-1]
+    contexts = EXPANSION_CONTEXES.get()
+    if contexts:
+        return contexts[-1]
     return None
 
 
@@ -91,11 +104,16 @@ Contains a macro's detailed informations needed to expand it.
 class MacroType(ABC):
     """Base class for the macro types. Each macro type has a name that
     will be used as the name of its registry (lowered). Each type
-    should implement `detect_macro`:meth:.
+    should implement `detect_macro`:meth: and declare in `node_types`
+    the classes of the nodes it can match.
 
     :param registry: A `Macros.Registry`:class: instance
     """
 
+    # The classes of the AST nodes that can be macro invocations of this type.
+    # The walker doesn't try this type on other nodes.
+    node_types = (object,)
+
     def __init__(self, registry):
         self.registry = registry
 
@@ -146,6 +164,8 @@ class Expr(MacroType):
     """Handles macros of the expression type, defined by using square
     brackets, like ``amacro[foo]``."""
 
+    node_types = (ast.Subscript,)
+
     def detect_macro(self, in_tree):
         if (isinstance(in_tree, ast.Subscript) and
             type(in_tree.slice) is ast.Index):  # noqa: E129
@@ -169,6 +189,8 @@ class Block(MacroType):
 
     """
 
+    node_types = (ast.With,)
+
     def detect_macro(self, in_tree):
         if isinstance(in_tree, ast.With):
             assert isinstance(in_tree.body, list), real_repr(in_tree.body)
@@ -205,6 +227,8 @@ class Decorator(MacroType):
     executing ``anothermacro`` first and then ``amacro``.
     """
 
+    node_types = compat.scope_nodes
+
     def detect_macro(self, in_tree):
         if (isinstance(in_tree, compat.scope_nodes) and
             len(in_tree.decorator_list)):  # noqa: E129
@@ -249,6 +273,19 @@ class Decorator(MacroType):
                 return [tree] + additions
 
 
+# The orders in which a macro and the nested ones can be expanded, see
+# Macros.Registry.
+INSIDE_OUT = 'inside-out'
+OUTSIDE_IN = 'outside-in'
+
+# The expansion order of the macros registered with an order other than
+# INSIDE_OUT.
+macro_orders = weakref.WeakKeyDictionary()
+
+# The macros registered with ``pure=True``.
+pure_macros = weakref.WeakSet()
+
+
 class Macros:
     """A registry of macros belonging to a module; used via
 
@@ -276,14 +313,47 @@ class Macros:
             self.registry = {}
             self.wrap = wrap
 
-        def __call__(self, f, name=None):
-            if name is not None:
-                self.registry[name] = f
-            else:
+        def __call__(self, f=None, name=None, order=INSIDE_OUT,
+                     pure=False):
+            """Register *f* as a macro, named *name* or as the function
+            itself. When called without *f*, return a decorator, like
+            in:
+
+            .. code:: python
+
+              @macros.expr(order=OUTSIDE_IN)
+              def my_macro(tree, **kw):
+                  ...
+
+            :param order: either `INSIDE_OUT`:data:, the default, to
+              receive the body of the invocation with the nested macros
+              already expanded, or `OUTSIDE_IN`:data: to receive it
+              as it is and have the nested macros expanded in the
+              result only
+            :param pure: ``True`` if the output of the macro depends only
+              on its body and arguments, so that the identical
+              invocations can share it, see `~.memo`:mod:
+            """
+            if order not in (INSIDE_OUT, OUTSIDE_IN):
+                raise ValueError("Unknown expansion order %r" % (order,))
+            if f is None:
+                return functools.partial(self, name=name, order=order,
+                                         pure=pure)
+            if pure and inspect.isgeneratorfunction(f):
+                raise ValueError("A generator macro can't be pure")
+            if name is None:
                 if hasattr(f, "__name__"):
-                    self.registry[f.__name__] = f
+                    name = f.__name__
                 else:
                     raise ValueError("You should specify a name")
+            with registry_lock:
+                if order != INSIDE_OUT:
+                    macro_orders[f] = order
+                if pure:
+                    pure_macros.add(f)
+                self.registry[name] = f
+            # inspect the signature once and for all
+            signature_keywords(f)
             return self.wrap(f)
 
     """The types of macros that will be handled by the registry."""
@@ -303,20 +373,261 @@ class Macros:
         (lowercased)."""
         assert issubclass(macrotype_cls, MacroType), "Invalid macro type class"
         reg = Macros.Registry(wrap_func)
-        setattr(self, macrotype_cls.__name__.lower(), reg)
-        self.macro_registries.append(reg.registry)
+        with registry_lock:
+            setattr(self, macrotype_cls.__name__.lower(), reg)
+            self.macro_registries.append(reg.registry)
 
 
 # For other modules to hook into MacroPy's workflow while
 # keeping this module itself unaware of their presence.
 """Functions to inject values throughout each files macros."""
 injected_vars = []
-"""Functions to call on every macro-expanded snippet."""
+"""Functions to call on every macro-expanded snippet, either plain
+functions or `NodeFilter`:class: instances."""
 filters = []
 """Functions to call on every macro-expanded file."""
 post_processing = []
 
 
+@functools.lru_cache(maxsize=None)
+def signature_keywords(func):
+    """Return the names of the arguments that can be passed to *func* as
+    keywords, or ``None`` if it accepts any keyword argument.
+    """
+    try:
+        params = inspect.signature(func).parameters.values()
+    except (TypeError, ValueError):
+        return None
+    if any(p.kind is p.VAR_KEYWORD for p in params):
+        return None
+    return frozenset(p.name for p in params
+                     if p.kind in (p.POSITIONAL_OR_KEYWORD, p.KEYWORD_ONLY))
+
+
+class InjectedVars(collections.abc.Mapping):
+    """A mapping between the names of the `injected_vars` and their values
+    for a module, computing each value the first time it's requested.
+    Each function gets the given keyword arguments together with the
+    values of the injected vars registered before it that it asks for.
+
+    :param providers: a list of functions, like `injected_vars`
+    :param kw: keyword arguments to pass to each function, like ``tree``
+      and ``src``
+    """
+
+    def __init__(self, providers, **kw):
+        self.providers = collections.OrderedDict()
+        for provider in providers:
+            self.providers.pop(provider.__name__, None)
+            self.providers[provider.__name__] = provider
+        self.computed = {}
+        self.kw = kw
+
+    def __getitem__(self, name):
+        try:
+            return self.computed[name]
+        except KeyError:
+            pass
+        provider = self.providers[name]
+        wanted = signature_keywords(provider)
+        kwargs = dict(self.kw)
+        for previous in self.providers:
+            if previous == name:
+                break
+            if wanted is None or previous in wanted:
+                kwargs[previous] = self[previous]
+        value = self.computed[name] = provider(**kwargs)
+        return value
+
+    def __contains__(self, name):
+        return name in self.providers
+
+    def __iter__(self):
+        return iter(self.providers)
+
+    def __len__(self):
+        return len(self.providers)
+
+
+class NodeFilter(object):
+    """@NodeFilter decorates a function of the form:
+
+    .. code:: python
+
+      @register(filters)
+      @NodeFilter
+      def transform(tree, state, set_state, set_state_for, **kw):
+          ...
+          return new_tree
+
+    which is called on every node of the tree produced by a macro,
+    top-down, and can return a replacement for it. The consecutive
+    node filters in `filters` are applied together, in a single
+    traversal of the tree, calling each of them on a node before
+    moving to its children. An instance can still be called like a
+    plain filter function, in which case it does a traversal of its
+    own.
+
+    Each filter has a *state* that is passed down the tree: it starts as
+    the value returned by the function decorated with
+    `initial_state`:meth: (``None`` if there is none) and can be
+    changed for the children of the current node with
+    ``set_state(value)`` or for a particular child with
+    ``set_state_for(child, value)``. A function decorated with
+    `sibling_state`:meth: computes the state of each item of a list
+    from the state of the previous one. The other keyword arguments are
+    the same given to the plain filter functions.
+    """
+
+    def __init__(self, func):
+        self.func = func
+        self.initial_state_func = None
+        self.sibling_state_func = None
+        functools.update_wrapper(self, func)
+
+    def initial_state(self, func):
+        """Decorate the function computing the initial state from the
+        keyword arguments of the filter."""
+        self.initial_state_func = func
+        return func
+
+    def sibling_state(self, func):
+        """Decorate a ``func(tree, state)`` returning the state of the list
+        item *tree* and of the following ones, given the state of the
+        previous one."""
+        self.sibling_state_func = func
+        return func
+
+    def __call__(self, tree, **kw):
+        return FusedFilters([self])(tree, **kw)
+
+
+class FusedFilters(object):
+    """Applies multiple `NodeFilter`:class: instances, in order, with a
+    single traversal of the tree.
+
+    :param node_filters: a list of `NodeFilter`:class: instances
+    """
+
+    def __init__(self, node_filters):
+        self.node_filters = node_filters
+        self.__name__ = '+'.join(f.__name__ for f in node_filters)
+
+    def __call__(self, tree, **kw):
+        overrides = {}
+        # the states for the children of the node being visited
+        child_states = [None]
+        calls = []
+        siblings = []
+        for ix, node_filter in enumerate(self.node_filters):
+
+            def set_state(state, ix=ix):
+                child_states[0][ix] = state
+
+            def set_state_for(child, state, ix=ix):
+                # keep a reference to *child* so that its id stays
+                # unique
+                overrides.setdefault(id(child), (child, []))[1].append(
+                    (ix, state))
+
+            func = profiling.timed_filter(node_filter.func,
+                                          node_filter.__name__)
+            calls.append((ix, func, set_state, set_state_for))
+            if node_filter.sibling_state_func is not None:
+                siblings.append((ix, node_filter.sibling_state_func))
+
+        result = [tree]
+        stack = [(_VISIT, tree, [None if f.initial_state_func is None
+                                 else f.initial_state_func(**kw)
+                                 for f in self.node_filters], result, 0)]
+        push = stack.append
+        pop = stack.pop
+        # like in `ExpansionContext._walk`:meth:, an explicit stack
+        while stack:
+            entry = pop()
+            action = entry[0]
+            if action is _VISIT:
+                _, tree, states, parent, key = entry
+                changed = overrides.pop(id(tree), None)
+                if changed is not None and changed[0] is tree:
+                    states = list(states)
+                    for ix, state in changed[1]:
+                        states[ix] = state
+                if isinstance(tree, list):
+                    push((_PLACE, tree, parent, key))
+                    if tree:
+                        push((_ITEM, tree, 0, [], list(states)))
+                    continue
+                if not (isinstance(tree, ast.AST) or type(tree) is Literal or
+                        type(tree) is Captured):
+                    _place(tree, parent, key)
+                    continue
+                new_states = child_states[0] = list(states)
+                for ix, func, set_state, set_state_for in calls:
+                    new_tree = func(tree=tree, state=states[ix],
+                                    set_state=set_state,
+                                    set_state_for=set_state_for, **kw)
+                    if new_tree is not None:
+                        tree = new_tree
+                push((_PLACE, tree, parent, key))
+                if isinstance(tree, ast.AST) and tree._fields:
+                    push((_FIELD, tree, tree._fields, 0, new_states))
+            elif action is _FIELD:
+                _, tree, fields, ix, states = entry
+                if ix + 1 < len(fields):
+                    push((_FIELD, tree, fields, ix + 1, states))
+                field = fields[ix]
+                if hasattr(tree, field):
+                    push((_VISIT, getattr(tree, field), states, tree, field))
+            elif action is _ITEM:
+                _, tree, ix, new_tree, states = entry
+                if ix + 1 < len(tree):
+                    push((_ITEM, tree, ix + 1, new_tree, states))
+                else:
+                    push((_PLACE, new_tree, tree, _SPLICED))
+                t = tree[ix]
+                for sibling_ix, sibling_state in siblings:
+                    states[sibling_ix] = sibling_state(t, states[sibling_ix])
+                push((_VISIT, t, states, new_tree, _SPLICE))
+            else:
+                _place(*entry[1:])
+        return result[0]
+
+
+def filter_stages(filters):
+    """Return the functions to call, in order, to apply the given
+    *filters* to the tree produced by a macro. They are applied in
+    reverse order of registration, and the consecutive
+    `NodeFilter`:class: instances are fused together with
+    `FusedFilters`:class:."""
+    stages = []
+    for function in reversed(filters):
+        if isinstance(function, NodeFilter):
+            if stages and isinstance(stages[-1], FusedFilters):
+                stages[-1] = FusedFilters(stages[-1].node_filters +
+                                          [function])
+            else:
+                stages.append(FusedFilters([function]))
+        else:
+            stages.append(function)
+    return stages
+
+
+_filter_stages = ((), [])
+
+
+def current_filter_stages():
+    """Return the result of `filter_stages`:func: for the current
+    content of `filters`, caching it."""
+    global _filter_stages
+    key = tuple(filters)
+    # read it once, another thread may replace it
+    cached = _filter_stages
+    if cached[0] != key:
+        cached = _filter_stages = (key, filter_stages(key))
+    return cached[1]
+
+
 def preserve_line_numbers(tree, new_tree):
     """Stick the original line numbers onto the transformed tree."""
     pos = ((tree.lineno, tree.col_offset)
@@ -368,20 +679,69 @@ class ExpansionContext:
     parent = None
 
     """A mapping containing the *realization* of the `~.injected_vars`,
-    which are calculated per-module."""
+    which are calculated per-module, see `InjectedVars`:class:."""
     file_vars = {}
 
     """A list containing one or more instances of `MacroType`:class:
     subclasses, usually defined as per-module level."""
     macro_types = []
 
+    """A mapping between the ``id()`` of the subtrees known to contain no
+    macro invocation and the subtrees themselves, which the walker
+    skips. See `find_cold_subtrees`:func:."""
+    cold_subtrees = {}
+
     def __init__(self, tree, parent=None):
         self.tree = tree
+        self._candidates = {}
         if parent is not None:
             assert isinstance(parent, ExpansionContext)
             self.parent = parent
             self.file_vars = parent.file_vars
             self.macro_types = parent.macro_types
+            self.cold_subtrees = parent.cold_subtrees
+            self._candidates = parent._candidates
+        else:
+            self.cold_subtrees = {}
+
+    def candidate_macro_types(self, node_class):
+        """Return the macro types that may find a macro invocation in a
+        node of class *node_class*, in the order of `macro_types`. Those
+        without any registered macro are left out.
+
+        :param node_class: a class, usually a subclass of ``ast.AST``
+        :returns: a tuple of `MacroType`:class: instances
+        """
+        try:
+            return self._candidates[node_class]
+        except KeyError:
+            candidates = self._candidates[node_class] = tuple(
+                mtype for mtype in self.macro_types
+                if issubclass(node_class, mtype.node_types) and
+                len(mtype.registry))
+            return candidates
+
+    def keywords_for(self, func, extra=None):
+        """Return the keyword arguments to pass to *func*, made of the
+        *extra* ones and of the `file_vars`, limited to those accepted
+        by its signature. This way the values of the `file_vars` that
+        no function asks for are never computed.
+
+        :param func: a macro, filter or post-processing function
+        :param extra: an optional mapping of other keyword arguments
+        :returns: a dictionary
+        """
+        wanted = signature_keywords(func)
+        if wanted is None:
+            kwargs = dict(extra) if extra else {}
+            kwargs.update(self.file_vars)
+        else:
+            kwargs = {name: extra[name] for name in extra
+                      if name in wanted} if extra else {}
+            for name in wanted:
+                if name in self.file_vars:
+                    kwargs[name] = self.file_vars[name]
+        return kwargs
 
     def create_std_tree_expand_generator(self, tree):
         """Create the standard tree expansion generator, one that will employ
@@ -389,11 +749,11 @@ class ExpansionContext:
         `walk_tree`:meth:.
 
         :returns: a generator that will look up macros in the given tree or
-           ``None``
+           ``None`` if it cannot contain a macro invocation
         """
-        if (isinstance(tree, ast.AST) or type(tree) is Literal or
-            type(tree) is Captured):  # noqa: #E129
-            return self.macro_expand(tree)
+        macro_types = self.candidate_macro_types(type(tree))
+        if macro_types:
+            return self.macro_expand(tree, macro_types)
 
     def create_single_macro_expand_generator(self, mfunc, *args, **kwargs):
         """The purpose is the same of `create_std_tree_expand_generator`:meth:,
@@ -413,8 +773,8 @@ class ExpansionContext:
         :param tree: an AST tree
         :returns: an AST tree
         """
+        token = EXPANSION_CONTEXES.set(EXPANSION_CONTEXES.get() + (self,))
         try:
-            EXPANSION_CONTEXES.append(self)
             if tree is None:
                 tree = self.tree
             gen_creator = self.create_single_macro_expand_generator(
@@ -422,7 +782,7 @@ class ExpansionContext:
 
             return self.walk_tree(tree, fcreate_expand_gen=gen_creator)
         finally:
-            EXPANSION_CONTEXES.pop()
+            EXPANSION_CONTEXES.reset(token)
 
     def expand_macros(self, tree=None):
         """Basic expansion function, It just calls `~.walk_tree`:meth: with
@@ -432,25 +792,29 @@ class ExpansionContext:
         :param tree: an AST tree
         :returns: an AST tree
         """
+        token = EXPANSION_CONTEXES.set(EXPANSION_CONTEXES.get() + (self,))
         try:
-            EXPANSION_CONTEXES.append(self)
             if tree is None:
                 tree = self.tree
             return self.walk_tree(tree)
         finally:
-            EXPANSION_CONTEXES.pop()
+            EXPANSION_CONTEXES.reset(token)
 
-    def macro_expand(self, tree):
+    def macro_expand(self, tree, macro_types=None):
         """This is a coroutine that expands found macros, and yields back
         transformed AST tree for the calling "walking" logic to transform.
 
         :param tree: an AST tree
+        :param macro_types: the macro types to try, defaults to
+          `macro_types`
         :returns: an AST tree or ``None``
         """
+        if macro_types is None:
+            macro_types = self.macro_types
         new_tree = None
         found_macro = False
         # for every macro type
-        for mtype in self.macro_types:
+        for mtype in macro_types:
             # its ``detect_macro()`` is a coro, start a pull/send cycle
             type_gen = mtype.detect_macro(tree)
             try:
@@ -490,22 +854,46 @@ class ExpansionContext:
         # if the macro function is itself a coro, give  it
         # control about when expand its body, if before or
         # after its own expansion, it's similar in spirit
-        # to ``contextlib.contexmanager()`` decorator
-        if inspect.isgeneratorfunction(mfunc):
+        # to ``contextlib.contexmanager()`` decorator. The same
+        # goes for the macros that want their body as it is
+        if (inspect.isgeneratorfunction(mfunc) or
+            macro_orders.get(mfunc) == OUTSIDE_IN):  # noqa: E129
             new_tree = macro_data.body_tree
+            expanded = None
         else:
             # if not yield it for a pre-execution walking
-            new_tree = yield macro_data.body_tree
+            new_tree = expanded = yield macro_data.body_tree
+            expanded_snapshot = _snapshot(expanded)
+        # the macro may change its body, so the parts of it that had no
+        # macro invocation may have one afterwards
+        if self.cold_subtrees:
+            forget_subtrees(self.cold_subtrees, new_tree)
+        record = profiling.invocation(mfunc, new_tree)
+        memo_key = memo_tree = None
+        if mfunc in pure_macros:
+            lineno = getattr(macro_data.macro_tree, 'lineno', None)
+            memo_key = expansion_memo.key(
+                mfunc, new_tree, macro_data.call_args,
+                macro_data.call_kwargs, macro_data.extrakws)
+            if memo_key is not None:
+                memo_tree = expansion_memo.get(memo_key, lineno)
+                record.memoized(memo_tree is not None)
         try:
-            new_tree = mfunc(
-                tree=new_tree,
-                args=macro_data.call_args,
-                kwargs=macro_data.call_kwargs,
-                src=self.src,
-                expand_macros=self.expand_macros,
-                **dict(tuple(macro_data.extrakws.items()) +
-                       tuple(self.file_vars.items()))
-            )
+            if memo_tree is not None:
+                new_tree = memo_tree
+            else:
+                with record:
+                    new_tree = mfunc(
+                        tree=new_tree,
+                        args=macro_data.call_args,
+                        kwargs=macro_data.call_kwargs,
+                        src=self.src,
+                        expand_macros=self.expand_macros,
+                        **self.keywords_for(mfunc, macro_data.extrakws)
+                    )
+                if memo_key is not None and not inspect.isgenerator(
+                        new_tree):
+                    expansion_memo.put(memo_key, new_tree, lineno)
             # the result is a generator, treat it like a
             # context manager
             if inspect.isgenerator(new_tree):
@@ -513,7 +901,11 @@ class ExpansionContext:
                 new_tree = None
                 try:
                     while True:
-                        new_tree = yield m_gen.send(new_tree)
+                        with record:
+                            out_tree = m_gen.send(new_tree)
+                        record.yielded()
+                        new_tree = yield out_tree
+                        record.resumed()
                 except StopIteration as final:
                     if final.value is not None:
                         new_tree = final.value
@@ -527,20 +919,32 @@ class ExpansionContext:
             new_tree = e
 
         # apply the filters
-        for function in reversed(filters):
-            new_tree = function(
-                tree=new_tree,
-                args=macro_data.call_args,
-                kwargs=macro_data.call_kwargs,
-                src=self.src,
-                expand_macros=self.expand_macros,
-                lineno=macro_data.macro_tree.lineno,
-                col_offset=macro_data.macro_tree.col_offset,
-                **dict(tuple(macro_data.extrakws.items()) +
-                       tuple(self.file_vars.items()))
-            )
+        for function in current_filter_stages():
+            with record.filter(function.__name__):
+                new_tree = function(
+                    tree=new_tree,
+                    args=macro_data.call_args,
+                    kwargs=macro_data.call_kwargs,
+                    src=self.src,
+                    expand_macros=self.expand_macros,
+                    lineno=macro_data.macro_tree.lineno,
+                    col_offset=macro_data.macro_tree.col_offset,
+                    **self.keywords_for(function, macro_data.extrakws)
+                )
+        record.output(new_tree)
+        # the expanded body, already walked, doesn't need to be walked
+        # again if all of it is left unchanged
+        if expanded is not None and _snapshot(expanded) == \
+           expanded_snapshot:
+            cold = self.cold_subtrees
+            cold[id(expanded)] = expanded
+            if type(expanded) is list:
+                for item in expanded:
+                    cold[id(item)] = item
         # yield it for one more walking
+        record.yielded()
         new_tree = yield new_tree
+        record.resumed()
 
     def walk_children(self, tree):
         """Walks each field of an AST instance or a list containing AST
@@ -549,20 +953,7 @@ class ExpansionContext:
         :param tree: an AST tree
         :returns: None
         """
-        if isinstance(tree, ast.AST):
-            for field, old_value in ast.iter_fields(tree):
-                old_value = getattr(tree, field, None)
-                new_value = self.walk_tree(old_value)
-                setattr(tree, field, new_value)
-        elif isinstance(tree, list) and len(tree) > 0:
-            new_tree = []
-            for t in tree:
-                new_t = self.walk_tree(t)
-                if type(new_t) is list:
-                    new_tree.extend(new_t)
-                else:
-                    new_tree.append(new_t)
-            tree[:] = new_tree
+        self._walk(tree, None, False)
 
     def walk_tree(self, tree, fcreate_expand_gen=None):
         """Calls `~.macro_expand`:meth: and walks each tree yielded by it,
@@ -572,24 +963,217 @@ class ExpansionContext:
         :param tree: an AST tree
         :returns: an AST tree
         """
-        if fcreate_expand_gen is None:
-            fcreate_expand_gen = self.create_std_tree_expand_generator
-        expand_gen = fcreate_expand_gen(tree)
-        if expand_gen is not None:
-            new_tree = None
-            try:
-                while True:
-                    new_tree = self.walk_tree(expand_gen.send(new_tree))
-            except StopIteration as final:
-                # accept the return value from ``macro_expand`` only
-                # if at least one macro was found
-                if final.value is not None and new_tree is not None:
-                    new_tree = self.walk_tree(final.value)
-            if new_tree is not None:
-                preserve_line_numbers(tree, new_tree)
-                tree = new_tree
-        self.walk_children(tree)
-        return tree
+        return self._walk(tree, fcreate_expand_gen, True)
+
+    def _walk(self, tree, fcreate_expand_gen, walk_root):
+        """Internal; the implementation of `walk_tree`:meth: and
+        `walk_children`:meth:, which uses an explicit stack instead of
+        recursion, so that it isn't limited by the depth of the tree.
+
+        Each entry in the stack is a tuple whose first item tells what
+        to do with the rest:
+
+        - ``_WALK``: start the expansion of a tree, which either has no
+          macros and only needs the walk of its children, or gets an
+          expansion frame;
+        - ``_SEND``: send the last tree walked to the expansion generator
+          of a frame, and walk the tree it yields;
+        - ``_REPLACE``: replace the tree of a frame with the result of
+          its expansion, then walk its children;
+        - ``_FIELD`` and ``_ITEM``: walk the field of a node, or the
+          item of a list, at the given index and schedule the following
+          one;
+        - ``_PLACE``: put the new value of a tree in its parent, now that
+          its children are walked.
+
+        An expansion frame is a list of the tree, the expansion
+        generator, the last tree walked, the parent and the key of the
+        tree in it.
+        """
+        result = [tree]
+        stack = []
+        push = stack.append
+        pop = stack.pop
+        cold_subtrees = self.cold_subtrees
+        if walk_root:
+            push((_WALK, tree, fcreate_expand_gen, result, 0))
+        else:
+            push((_PLACE, tree, result, 0))
+            _push_children(push, tree)
+        while stack:
+            entry = pop()
+            action = entry[0]
+            if action is _WALK:
+                _, tree, fcreate_expand_gen, parent, key = entry
+                if fcreate_expand_gen is None:
+                    if cold_subtrees.get(id(tree)) is tree:
+                        push((_PLACE, tree, parent, key))
+                        continue
+                    fcreate_expand_gen = self.create_std_tree_expand_generator
+                if profiling.enabled:
+                    profiling.macro_stats.walked += 1
+                expand_gen = fcreate_expand_gen(tree)
+                if expand_gen is None:
+                    push((_PLACE, tree, parent, key))
+                    _push_children(push, tree)
+                else:
+                    push((_SEND, [tree, expand_gen, None, parent, key]))
+            elif action is _SEND:
+                frame = entry[1]
+                try:
+                    yielded = frame[1].send(frame[2])
+                except StopIteration as final:
+                    push((_REPLACE, frame))
+                    # accept the return value from ``macro_expand`` only
+                    # if at least one macro was found
+                    if final.value is not None and frame[2] is not None:
+                        push((_WALK, final.value, None, frame, 2))
+                    continue
+                push((_SEND, frame))
+                push((_WALK, yielded, None, frame, 2))
+            elif action is _REPLACE:
+                tree, expand_gen, new_tree, parent, key = entry[1]
+                if new_tree is not None:
+                    preserve_line_numbers(tree, new_tree)
+                    self.subtree_replaced(tree, new_tree)
+                    tree = new_tree
+                push((_PLACE, tree, parent, key))
+                _push_children(push, tree)
+            elif action is _FIELD:
+                _, tree, fields, ix = entry
+                if ix + 1 < len(fields):
+                    push((_FIELD, tree, fields, ix + 1))
+                field = fields[ix]
+                if hasattr(tree, field):
+                    push((_WALK, getattr(tree, field), None, tree, field))
+            elif action is _ITEM:
+                _, tree, ix, new_tree = entry
+                if ix + 1 < len(tree):
+                    push((_ITEM, tree, ix + 1, new_tree))
+                else:
+                    push((_PLACE, new_tree, tree, _SPLICED))
+                push((_WALK, tree[ix], None, new_tree, _SPLICE))
+            else:
+                _place(*entry[1:])
+        return result[0]
+
+    def subtree_replaced(self, old, new):
+        """Called by `walk_tree`:meth: when the expansion of the macros in
+        *old* has produced *new*, which will take its place. It
+        notifies the values of the `file_vars` already computed that
+        keep track of the tree, those having a ``replace_subtree(old,
+        new)`` method.
+        """
+        for value in getattr(self.file_vars, 'computed', {}).values():
+            replace_subtree = getattr(value, 'replace_subtree', None)
+            if replace_subtree is not None:
+                replace_subtree(old, new)
+
+
+# the actions of `ExpansionContext._walk`:meth: and
+# `FusedFilters.__call__`:meth:
+_VISIT = 'visit'
+_WALK = 'walk'
+_SEND = 'send'
+_REPLACE = 'replace'
+_FIELD = 'field'
+_ITEM = 'item'
+_PLACE = 'place'
+
+
+def _push_children(push, tree):
+    if isinstance(tree, ast.AST):
+        if tree._fields:
+            push((_FIELD, tree, tree._fields, 0))
+    elif isinstance(tree, list) and len(tree) > 0:
+        push((_ITEM, tree, 0, []))
+
+
+def find_cold_subtrees(tree, names):
+    """Find the largest subtrees of *tree* where none of the given macro
+    *names* appears as an ``ast.Name``, which therefore cannot contain
+    a macro invocation.
+
+    :param tree: an AST tree or a list of them
+    :param names: a set of the names bound to macros
+    :returns: a mapping between the ``id()`` of each subtree (an AST
+      node or a list of them) and the subtree itself
+    """
+    cold = {}
+    # the nodes and lists in pre-order, each with its children
+    nodes = []
+    stack = [tree]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, ast.AST):
+            if type(node) is ast.Name and node.id in names:
+                children = None
+            else:
+                children = [value for field, value in ast.iter_fields(node)
+                            if isinstance(value, (ast.AST, list))]
+        elif isinstance(node, list):
+            children = [value for value in node
+                        if isinstance(value, (ast.AST, list))]
+        else:
+            continue
+        nodes.append((node, children))
+        if children:
+            stack.extend(children)
+    # the children come before their parents in reverse pre-order
+    hot = {}
+    for node, children in reversed(nodes):
+        if children is None:
+            hot[id(node)] = True
+        elif any(hot[id(child)] for child in children):
+            hot[id(node)] = True
+            for child in children:
+                if not hot[id(child)]:
+                    cold[id(child)] = child
+        else:
+            hot[id(node)] = False
+    if not hot.get(id(tree)):
+        cold[id(tree)] = tree
+    return cold
+
+
+def _snapshot(tree):
+    """Internal; return a list of the nodes and lists in *tree*, in
+    pre-order, each followed by the length of the list or by the
+    values of the fields that aren't nodes. Two snapshots of the same
+    tree are equal only if none of its parts has been changed in place
+    since the first, as the nodes and lists compare by identity."""
+    snapshot = []
+    add = snapshot.append
+    stack = [tree]
+    push = stack.append
+    pop = stack.pop
+    while stack:
+        value = pop()
+        if isinstance(value, ast.AST):
+            add(value)
+            for field in reversed(value._fields):
+                push(getattr(value, field, None))
+        elif type(value) is list:
+            add(value)
+            add(len(value))
+            stack.extend(reversed(value))
+        else:
+            add(value)
+    return snapshot
+
+
+def forget_subtrees(cold, tree):
+    """Remove *tree* and all its subtrees from the *cold* mapping built by
+    `find_cold_subtrees`:func:."""
+    stack = [tree]
+    while stack:
+        tree = stack.pop()
+        cold.pop(id(tree), None)
+        if isinstance(tree, ast.AST):
+            stack.extend(value for field, value in ast.iter_fields(tree)
+                         if isinstance(value, (ast.AST, list)))
+        elif isinstance(tree, list):
+            stack.extend(tree)
 
 
 class ModuleExpansionContext(ExpansionContext):
@@ -606,11 +1190,8 @@ class ModuleExpansionContext(ExpansionContext):
     def __init__(self, tree, src, bindings):
         super().__init__(tree)
         self.src = src
-        self.file_vars = {}
-        for v in injected_vars:
-            self.file_vars[v.__name__] = v(tree=tree, src=src,
-                                           expand_macros=self.expand_macros,
-                                           **self.file_vars)
+        self.file_vars = InjectedVars(injected_vars, tree=tree, src=src,
+                                      expand_macros=self.expand_macros)
 
         allnames = [
             (mod, name, asname)
@@ -625,6 +1206,9 @@ class ModuleExpansionContext(ExpansionContext):
             if name in registry.keys()
         }) for ix, cls in enumerate(Macros.macro_types)]
 
+        self.cold_subtrees = find_cold_subtrees(tree, {
+            asname for mtype in self.macro_types for asname in mtype.registry})
+
     def expand_macros(self, tree=None):
         if tree is None:
             tree = self.tree
@@ -633,13 +1217,24 @@ class ModuleExpansionContext(ExpansionContext):
 
         preamble = self.pre_process(tree)
         tree = super().expand_macros(tree)
-        tree = self.post_process(tree)
+        with profiling.phase('post-process'):
+            tree = self.post_process(tree)
 
         if preamble:
             tree.body = preamble + tree.body
 
         return tree
 
+    def release(self):
+        """Drop the references to the tree, the source and the values of
+        the injected vars of the module, which aren't needed after its
+        expansion. This also breaks the reference cycles between them
+        and the context, so that they're freed right away."""
+        self.tree = self.src = None
+        self.file_vars = {}
+        self.cold_subtrees = {}
+        self._candidates = {}
+
     def pre_process(self, tree):
         """Removes ``from __future__`` imports from the tree's body and
         returns them.
@@ -678,11 +1273,30 @@ class ModuleExpansionContext(ExpansionContext):
                 tree=tree,
                 src=self.src,
                 expand_macros=self.expand_macros,
-                **self.file_vars
+                **self.keywords_for(post)
             )
         return tree
 
 
+_ws = r'(?:[ \t]|\\\r?\n)'
+# a "#" before a ";" may be inside a string, so it doesn't end the
+# match; the statement after it is matched even if that's a comment
+_macro_import_re = re.compile(
+    r'^(?:[^\n]*;{ws}*)?from(?={ws}|\.)(?:{ws}|\.)*\w+(?:{ws}*\.{ws}*\w+)*'
+    r'{ws}+import(?:{ws}+|{ws}*\((?:\s|#[^\n]*)*)macros\b'.format(ws=_ws),
+    re.MULTILINE)
+
+
+def has_macro_imports(source):
+    """Quickly tell if the given source may contain a top-level ``from
+    ... import macros, ...`` statement, the only form recognized by
+    `detect_macros`:func:, without parsing it. It may give false
+    positives (e.g. when such a statement is inside a docstring) but
+    never false negatives."""
+    return bool(source and "macros" in source and
+                _macro_import_re.search(source))
+
+
 def detect_macros(tree, from_fullname, from_package=None, from_module=None, reload=False):
     """Look for macros imports within an AST, transforming them and extracting
     the list of macro modules."""
@@ -702,7 +1316,8 @@ def detect_macros(tree, from_fullname, from_package=None, from_module=None, relo
 
             logger.info("Importing macros from %r into %r", fullname,
                         from_module)
-            mod = importlib.import_module(fullname)
+            with profiling.phase('import'):
+                mod = importlib.import_module(fullname)
             if reload:  # for REPL: always load the latest definitions
                 logger.info("Reloading module %r", fullname)
                 mod = importlib.reload(mod)
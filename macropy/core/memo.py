@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+"""Memoization of the expansion of the *pure* macros, those whose output
+depends only on their body and arguments, registered with
+``pure=True``. Identical invocations, found by the structural hash of
+their trees, get a clone of the output of the first one."""
+
+import ast
+import collections
+import hashlib
+import threading
+
+from . import Literal
+
+
+__all__ = ['structural_hash', 'clone', 'ExpansionMemo', 'expansion_memo']
+
+
+_ATOMS = (str, bytes, int, float, complex, bool, type(None),
+          type(Ellipsis))
+
+
+def structural_hash(*trees):
+    """Return a digest of the structure of *trees*, which are AST nodes,
+    lists, tuples or dictionaries of them and plain values. The
+    positions of the nodes in the source don't count, so the same code
+    written in two places has the same hash. Return ``None`` if the trees contain other
+    objects, like the values captured by the hygienic quasiquotes, which
+    can't be compared by their structure."""
+    tokens = []
+    add = tokens.append
+    stack = [list(trees)]
+    pop = stack.pop
+    push = stack.append
+    while stack:
+        value = pop()
+        tvalue = type(value)
+        if isinstance(value, ast.AST):
+            add(tvalue.__name__)
+            for field in reversed(value._fields):
+                push(getattr(value, field, None))
+        elif tvalue is list or tvalue is tuple:
+            add('%s%d' % ('[' if tvalue is list else '(', len(value)))
+            stack.extend(reversed(value))
+        elif tvalue is dict:
+            add('{%d' % len(value))
+            for key in sorted(value, reverse=True):
+                push(value[key])
+                push(key)
+        elif tvalue is Literal:
+            add('Literal')
+            push(value.body)
+        elif tvalue in _ATOMS:
+            add(tvalue.__name__ + repr(value))
+        else:
+            return None
+    return hashlib.sha1(
+        '\0'.join(tokens).encode('utf-8', 'replace')).digest()
+
+
+def clone(tree, line_delta=0):
+    """Return a deep copy of *tree*, an AST node or a list of them, whose
+    line numbers are moved by *line_delta*. The values that aren't nodes
+    or lists are shared with the original, and the copy is made without
+    recursion."""
+    result = [None]
+    # (value, parent, key)
+    stack = [(tree, result, 0)]
+    pop = stack.pop
+    push = stack.append
+    while stack:
+        value, parent, key = pop()
+        tvalue = type(value)
+        if isinstance(value, ast.AST):
+            new = tvalue()
+            for name in value._attributes:
+                if hasattr(value, name):
+                    attr = getattr(value, name)
+                    if line_delta and name in ('lineno', 'end_lineno') \
+                       and attr is not None:
+                        attr += line_delta
+                    setattr(new, name, attr)
+            for field in value._fields:
+                if hasattr(value, field):
+                    push((getattr(value, field), new, field))
+        elif tvalue is list:
+            new = [None] * len(value)
+            for ix, item in enumerate(value):
+                push((item, new, ix))
+        elif tvalue is Literal:
+            new = Literal(None)
+            push((value.body, new, 'body'))
+        else:
+            new = value
+        if type(key) is str:
+            setattr(parent, key, new)
+        else:
+            parent[key] = new
+    return result[0]
+
+
+class ExpansionMemo(object):
+    """A bounded mapping, evicting the least recently used entries,
+    between the key of a macro invocation and its output.
+
+    :param maxsize: the maximum number of outputs kept
+    :ivar hits: the number of lookups that found an output
+    :ivar misses: the number of lookups that didn't
+    """
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def key(self, func, tree, args, kwargs, extrakws):
+        """Return the key of the invocation of the macro *func*, or ``None``
+        if it can't be memoized."""
+        digest = structural_hash(tree, args, kwargs, extrakws)
+        if digest is None:
+            return None
+        return (func, digest)
+
+    def get(self, key, lineno=None):
+        """Return a clone of the output stored under *key*, with its line
+        numbers moved to the invocation at line *lineno*, or ``None``."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(key)
+        tree, stored_lineno = entry
+        if lineno is None or stored_lineno is None:
+            return clone(tree)
+        return clone(tree, lineno - stored_lineno)
+
+    def put(self, key, tree, lineno=None):
+        """Store a clone of *tree*, the output of the invocation at line
+        *lineno*, under *key*."""
+        if self.maxsize <= 0:
+            return
+        entry = (clone(tree), lineno)
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    @property
+    def hit_rate(self):
+        """The fraction of the lookups that found an output."""
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def clear(self):
+        """Forget the outputs and the counts."""
+        with self.lock:
+            self.entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+
+# The process-wide memo of the pure macros.
+expansion_memo = ExpansionMemo()
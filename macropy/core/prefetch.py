@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+"""Expansion of the modules of a package in the background, while the
+rest of the application starts.
+
+When a package configured with ``macropy.activate(prefetch=[...])`` is
+imported for the first time, the `Prefetcher`:class: lists its
+submodules that use macros in a background thread and expands them in
+a pool of processes, started beforehand.
+When each of them is actually imported, its code is taken from there
+instead of being expanded in the importing process.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from importlib.util import decode_source, spec_from_file_location
+import logging
+import marshal
+import os
+import sys
+import threading
+
+from . import compat
+from .exporters import dependencies_changed
+
+
+logger = logging.getLogger(__name__)
+
+
+def _setup_worker(path):
+    """Internal; prepare the current process to expand modules."""
+    import macropy.activate  # noqa: F401
+    from .import_hooks import MacroFinder
+    # the workers don't prefetch themselves
+    MacroFinder.prefetcher = None
+    for entry in path:
+        if entry not in sys.path:
+            sys.path.append(entry)
+
+
+def expand_module(module_name, file_name, path=()):
+    """Expand the module *module_name* at *file_name* like the import
+    hook does, in a worker process whose ``sys.path`` is extended with
+    *path*.
+
+    :returns: ``None`` if it doesn't use macros, or a tuple of
+      ``(source_hash, code, dependencies)`` where the code is
+      marshalled
+    """
+    _setup_worker(path)
+    from .import_hooks import MacroFinder
+    with open(file_name, 'rb') as f:
+        source = decode_source(f.read())
+    spec = spec_from_file_location(module_name, file_name)
+    code, tree, dependencies = MacroFinder.find_or_expand(
+        module_name, file_name, source, spec)
+    if code is None:
+        return None
+    return (compat.source_hash(source.encode('utf-8')), marshal.dumps(code),
+            dependencies)
+
+
+class Prefetcher(object):
+    """Expands the submodules using macros of the *packages* in a pool
+    of processes as soon as each package is found by the import hook,
+    see `package_found`:meth:, and hands their code over when they are
+    imported, see `take`:meth:. The pool is started by `start`:meth:.
+
+    The modules known to have no macros by the `~.cache.UsageIndex`
+    are skipped, and the source of the others is scanned with
+    `~.macros.has_macro_imports`:func:.
+
+    :param packages: the names of the packages
+    :param workers: the number of worker processes, defaults to one
+      per CPU
+    """
+
+    def __init__(self, packages, workers=None):
+        self.packages = set(packages)
+        self.workers = workers
+        self._executor = None
+        self._futures = {}
+        self._started = set()
+        self._scans = {}
+        self._imported = set()
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Start the worker processes, unless they are running. It must
+        be done outside of the imports of the `packages`, before them,
+        as forking a process while another thread holds the lock of a
+        module being imported leaves it locked in the child, and to
+        keep the imports from waiting for it."""
+        with self._lock:
+            if self._executor is not None:
+                return
+            self._executor = ProcessPoolExecutor(self.workers)
+            # the workers are forked on the first submission
+            self._executor.submit(_setup_worker, list(sys.path))
+
+    def candidates(self, package, locations, index=None):
+        """Yield a tuple of ``(module_name, file_name)`` for each module
+        in the package named *package*, whose directories are
+        *locations*, and in its subpackages, which may use macros."""
+        from .macros import has_macro_imports
+        for location in locations:
+            for dirpath, dirnames, filenames in os.walk(location):
+                rel = os.path.relpath(dirpath, location)
+                prefix = package if rel == os.curdir else '.'.join(
+                    [package] + rel.split(os.sep))
+                dirnames[:] = sorted(
+                    d for d in dirnames
+                    if os.path.exists(os.path.join(dirpath, d,
+                                                   '__init__.py')))
+                for fname in sorted(filenames):
+                    name, ext = os.path.splitext(fname)
+                    if ext != '.py' or (name == '__init__' and
+                                        rel == os.curdir):
+                        continue
+                    file_name = os.path.join(dirpath, fname)
+                    uses_macros = (index.lookup(file_name)
+                                   if index is not None else None)
+                    if uses_macros is None:
+                        try:
+                            with open(file_name, 'rb') as f:
+                                source = decode_source(f.read())
+                        except (OSError, SyntaxError, UnicodeDecodeError):
+                            continue
+                        uses_macros = has_macro_imports(source)
+                    if uses_macros:
+                        yield (prefix if name == '__init__' else
+                               prefix + '.' + name), file_name
+
+    def package_found(self, fullname, spec, index=None):
+        """Start expanding the submodules of the package *fullname*,
+        found with *spec*, if it's one of the `packages` and this is
+        the first time it's found. They are listed in a background
+        thread, to let the import of the package go on meanwhile, and
+        those imported before that are skipped."""
+        if fullname not in self.packages or not \
+           spec.submodule_search_locations:
+            return
+        with self._lock:
+            if fullname in self._started:
+                return
+            self._started.add(fullname)
+            scan = threading.Thread(
+                target=self._prefetch, name='macropy-prefetch',
+                args=(fullname, list(spec.submodule_search_locations),
+                      index, list(sys.path)))
+            scan.daemon = True
+            self._scans[fullname] = scan
+        scan.start()
+
+    def _prefetch(self, package, locations, index, path):
+        """Internal; submit the expansion of the submodules of *package*
+        to the workers, run in a background thread."""
+        try:
+            modules = list(self.candidates(package, locations, index))
+        except Exception:
+            logger.exception('Listing the modules of %s failed', package)
+            modules = []
+        with self._lock:
+            if self._executor is None and modules:
+                logger.debug('No workers to prefetch %s', package)
+                modules = []
+            for module_name, file_name in modules:
+                if (module_name in self._imported or
+                    module_name in sys.modules):  # noqa: E129
+                    continue
+                logger.info('Prefetching %s', module_name)
+                future = self._executor.submit(expand_module, module_name,
+                                               file_name, path)
+                self._futures[module_name] = (file_name, future)
+            del self._scans[package]
+        self._stop_if_idle()
+
+    def take(self, fullname, file_name, source):
+        """Return a tuple of ``(code, dependencies)`` with the expansion of
+        the module *fullname* at *file_name*, waiting for it if needed,
+        or ``None`` if it wasn't prefetched or its *source* or the macro
+        modules used have changed meanwhile. The workers are stopped
+        when the last expansion is taken, once all the `packages` have
+        been found."""
+        with self._lock:
+            entry = self._futures.pop(fullname, None)
+            if entry is None:
+                # not to be prefetched if it's still being looked for
+                self._imported.add(fullname)
+                return None
+        try:
+            return self._result(fullname, file_name, source, entry)
+        finally:
+            self._stop_if_idle()
+
+    def _stop_if_idle(self):
+        """Internal; stop the workers once all the `packages` have been
+        found and all their expansions taken."""
+        with self._lock:
+            idle = (not self._futures and not self._scans and
+                    self._started >= self.packages)
+        if idle:
+            self.shutdown()
+
+    def _result(self, fullname, file_name, source, entry):
+        """Internal; return the result of `take`:meth: for the *entry* of
+        the module *fullname* in ``_futures``."""
+        prefetched_file, future = entry
+        if prefetched_file != file_name:
+            future.cancel()
+            return None
+        try:
+            result = future.result()
+        except Exception:
+            # the import expands it again and reports the error
+            logger.debug('Prefetching %s failed', fullname, exc_info=True)
+            return None
+        if result is None:
+            return None
+        digest, code, dependencies = result
+        if (digest != compat.source_hash(source.encode('utf-8')) or
+            dependencies_changed(dependencies)):  # noqa: E129
+            logger.debug('Prefetched expansion of %s is stale', fullname)
+            return None
+        return marshal.loads(code), dependencies
+
+    def shutdown(self):
+        """Stop the worker processes, discarding the expansions not yet
+        started and waiting for the others."""
+        with self._lock:
+            executor, self._executor = self._executor, None
+            if executor is None:
+                return
+            for file_name, future in self._futures.values():
+                future.cancel()
+        executor.shutdown(wait=True)
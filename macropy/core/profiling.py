@@ -0,0 +1,477 @@
+# -*- coding: utf-8 -*-
+"""Opt-in instrumentation of the import hook, used to find out where
+the time goes when importing modules that use macros.
+
+It is enabled by ``macropy.activate(profile=True)`` or by setting the
+``MACROPY_PROFILE`` environment variable, in which case a report is
+printed at exit. Otherwise the instrumented code pays only for a
+function call per phase.
+
+Besides the phases of the import of each module, it records the cost
+of the expansion of each macro in `macro_stats`:data:. All the times
+are taken with `time.perf_counter`:func: without installing any
+profiling or tracing hook, so that it can be used together with
+`cProfile`:mod:.
+"""
+
+import ast
+import collections
+import sys
+import threading
+import time
+
+
+# The phases of the import of a module, in pipeline order.
+PHASES = ('find', 'read', 'cache', 'parse', 'detect', 'import', 'expand',
+          'post-process', 'compile', 'export', 'exec')
+
+enabled = False
+
+_import_times = collections.OrderedDict()
+_state = threading.local()
+
+
+def enable():
+    """Start recording the time spent in each phase."""
+    global enabled
+    enabled = True
+
+
+def disable():
+    """Stop recording."""
+    global enabled
+    enabled = False
+
+
+def reset():
+    """Forget the times recorded so far."""
+    _import_times.clear()
+    macro_stats.reset()
+
+
+def import_times():
+    """Return a mapping between the name of each module that went through
+    the import hook and another mapping containing the wall time, in
+    seconds, spent in each phase of its import. The time spent in a
+    phase doesn't include the time spent in the nested phases of the
+    same module, but includes the phases of other modules, e.g. the
+    ``import`` phase includes the import of the macro modules."""
+    return collections.OrderedDict((module, dict(times)) for module, times
+                                   in _import_times.items())
+
+
+class _NullPhase(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+_null_phase = _NullPhase()
+
+
+class _Phase(object):
+
+    __slots__ = ('name', 'module', 'start', 'nested')
+
+    def __init__(self, name, module):
+        self.name = name
+        self.module = module
+
+    def __enter__(self):
+        stack = _stack()
+        if self.module is None:
+            self.module = stack[-1].module if stack else '<unknown>'
+        stack.append(self)
+        self.nested = 0.0
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        elapsed = time.perf_counter() - self.start
+        stack = _stack()
+        stack.pop()
+        if stack and stack[-1].module == self.module:
+            stack[-1].nested += elapsed
+        times = _import_times.get(self.module)
+        if times is None:
+            times = _import_times[self.module] = {}
+        times[self.name] = times.get(self.name, 0.0) + elapsed - self.nested
+
+
+def _stack():
+    try:
+        return _state.stack
+    except AttributeError:
+        _state.stack = []
+        return _state.stack
+
+
+def phase(name, module=None):
+    """Return a context manager timing the phase *name* of the import of
+    *module*, which defaults to the module of the enclosing phase.
+
+    .. code:: python
+
+      with profiling.phase('parse', fullname):
+          tree = ast.parse(source)
+    """
+    if not enabled:
+        return _null_phase
+    return _Phase(name, module)
+
+
+def report(file=None, limit=None):
+    """Print the recorded times as a table sorted by total time, slowest
+    modules first, similar to the output of ``python -X importtime``.
+
+    :param file: a file-like object, defaults to ``sys.stderr``
+    :param limit: the maximum number of modules to print
+    """
+    file = sys.stderr if file is None else file
+    rows = sorted(_import_times.items(),
+                  key=lambda item: sum(item[1].values()), reverse=True)
+    if limit is not None:
+        rows = rows[:limit]
+    widths = [max(len(p), 9) for p in PHASES]
+    print('macropy import time [us]:', file=file)
+    print(' | '.join(p.rjust(w) for p, w in zip(PHASES + ('total',),
+                                                widths + [9])) +
+          ' | module', file=file)
+    for module, times in rows:
+        cells = [str(int(times[p] * 1e6)) if p in times else ''
+                 for p in PHASES]
+        cells.append(str(int(sum(times.values()) * 1e6)))
+        print(' | '.join(c.rjust(w) for c, w in zip(cells, widths + [9])) +
+              ' | ' + module, file=file)
+
+
+def count_nodes(tree):
+    """Count the AST nodes in *tree*, which can also be a list of trees
+    or something else, like the exception raised by a failing macro,
+    which counts as zero."""
+    if isinstance(tree, list):
+        return sum(count_nodes(t) for t in tree)
+    if isinstance(tree, ast.AST):
+        return sum(1 for _ in ast.walk(tree))
+    return 0
+
+
+class MacroStats(object):
+    """The statistics about the expansions of a single macro.
+
+    :ivar module: the name of the module defining the macro
+    :ivar name: the name of the macro function
+    :ivar calls: the number of invocations
+    :ivar cumulative: the time spent in the macro function and in the
+      filters applied to its output, in seconds
+    :ivar self_time: the part of *cumulative* that isn't spent in the
+      filters and in the expansion of other macros
+    :ivar nodes_in: the number of AST nodes received
+    :ivar nodes_out: the number of AST nodes returned, after the filters
+    :ivar rewalks: the number of trees given back to the walker to
+      look for more macros
+    :ivar rewalked: the number of nodes visited walking them
+    :ivar filters: a mapping between the name of each filter and the
+      time spent in it. The node filters applied together each have
+      their own entry, the one of their fused name has the time of
+      the traversal
+    :ivar hits: the number of invocations of a pure macro whose output
+      was found in the memo
+    :ivar misses: the number of those that weren't
+    """
+
+    __slots__ = ('module', 'name', 'file_name', 'lineno', 'calls',
+                 'cumulative', 'self_time', 'nodes_in', 'nodes_out',
+                 'rewalks', 'rewalked', 'filters', 'hits', 'misses')
+
+    def __init__(self, module, name, file_name='~', lineno=0):
+        self.module = module
+        self.name = name
+        self.file_name = file_name
+        self.lineno = lineno
+        self.calls = 0
+        self.cumulative = 0.0
+        self.self_time = 0.0
+        self.nodes_in = 0
+        self.nodes_out = 0
+        self.rewalks = 0
+        self.rewalked = 0
+        self.filters = {}
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def hit_rate(self):
+        """The fraction of the invocations found in the memo."""
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def __repr__(self):
+        return ('<MacroStats {}.{}: {} calls, {:.6f}s cumulative, {:.6f}s '
+                'self>'.format(self.module, self.name, self.calls,
+                               self.cumulative, self.self_time))
+
+
+class ExpansionStats(object):
+    """The statistics about the expansion of every macro, keyed by
+    ``(module, name)``. It can be loaded into `pstats.Stats`:class:,
+    alone or together with the output of `cProfile`:mod:, to use its
+    sorting and printing facilities:
+
+    .. code:: python
+
+      pstats.Stats(macropy.stats()).sort_stats('tottime').print_stats()
+
+    :ivar walked: the number of nodes visited by the expansion walker
+    """
+
+    def __init__(self):
+        self.macros = collections.OrderedDict()
+        self.walked = 0
+
+    def reset(self):
+        """Forget the statistics recorded so far."""
+        self.macros.clear()
+        self.walked = 0
+
+    def __getitem__(self, key):
+        return self.macros[key]
+
+    def __contains__(self, key):
+        return key in self.macros
+
+    def __iter__(self):
+        return iter(self.macros.values())
+
+    def __len__(self):
+        return len(self.macros)
+
+    def get(self, func):
+        """Return the `MacroStats`:class: of the macro function *func*,
+        creating it if needed."""
+        name = func.__name__
+        key = (func.__module__, name)
+        stats = self.macros.get(key)
+        if stats is None:
+            code = getattr(func, '__code__', None)
+            stats = self.macros[key] = MacroStats(
+                func.__module__, name,
+                getattr(code, 'co_filename', '~'),
+                getattr(code, 'co_firstlineno', 0))
+        return stats
+
+    def hit_rate(self):
+        """Return the fraction of the invocations of the pure macros whose
+        output was found in the memo."""
+        hits = sum(s.hits for s in self.macros.values())
+        lookups = hits + sum(s.misses for s in self.macros.values())
+        return hits / lookups if lookups else 0.0
+
+    def filter_times(self):
+        """Return a mapping between the name of each filter and the total
+        time spent in it."""
+        totals = {}
+        for stats in self.macros.values():
+            for name, seconds in stats.filters.items():
+                totals[name] = totals.get(name, 0.0) + seconds
+        return totals
+
+    def create_stats(self):
+        """Fill the ``stats`` member in the format used by
+        `pstats`:mod:. It's called by `pstats.Stats`:class:."""
+        self.stats = {
+            (s.file_name, s.lineno, '{}.{}'.format(s.module, s.name)):
+            (s.calls, s.calls, s.self_time, s.cumulative, {})
+            for s in self.macros.values()}
+
+    def report(self, file=None, limit=None):
+        """Print the statistics as a table sorted by cumulative time.
+
+        :param file: a file-like object, defaults to ``sys.stderr``
+        :param limit: the maximum number of macros to print
+        """
+        file = sys.stderr if file is None else file
+        rows = sorted(self.macros.values(), key=lambda s: s.cumulative,
+                      reverse=True)
+        if limit is not None:
+            rows = rows[:limit]
+        headers = ('calls', 'cumulative', 'self', 'nodes in', 'nodes out',
+                   'rewalks', 'rewalked')
+        print('macropy expansion time [us]:', file=file)
+        print(' | '.join(h.rjust(10) for h in headers) + ' | macro',
+              file=file)
+        for s in rows:
+            cells = (s.calls, int(s.cumulative * 1e6), int(s.self_time * 1e6),
+                     s.nodes_in, s.nodes_out, s.rewalks, s.rewalked)
+            print(' | '.join(str(c).rjust(10) for c in cells) +
+                  ' | {}.{}'.format(s.module, s.name), file=file)
+        filter_times = self.filter_times()
+        if filter_times:
+            print('filters: ' + ', '.join(
+                '{} {}'.format(name, int(seconds * 1e6)) for name, seconds
+                in sorted(filter_times.items(), key=lambda i: -i[1])),
+                  file=file)
+        memoized = [s for s in self.macros.values() if s.hits or s.misses]
+        if memoized:
+            print('memo hit rate: {:.1%} ({})'.format(
+                self.hit_rate(), ', '.join(
+                    '{}.{} {}/{}'.format(s.module, s.name, s.hits,
+                                         s.hits + s.misses)
+                    for s in memoized)), file=file)
+
+
+# The statistics about the expansion of each macro, see ExpansionStats.
+macro_stats = ExpansionStats()
+
+
+class _NullInvocation(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def filter(self, name):
+        return self
+
+    def output(self, tree):
+        pass
+
+    def yielded(self):
+        pass
+
+    def resumed(self):
+        pass
+
+    def memoized(self, hit):
+        pass
+
+
+_null_invocation = _NullInvocation()
+
+
+class _Invocation(object):
+    """Internal; times a macro invocation, which happens in multiple
+    segments when the macro is a generator or its result is walked
+    again. Each segment is entered as a context manager."""
+
+    __slots__ = ('stats', 'start', 'nested', 'walked')
+
+    def __init__(self, stats, tree):
+        self.stats = stats
+        self.nested = 0.0
+        stats.calls += 1
+        stats.nodes_in += count_nodes(tree)
+
+    def __enter__(self):
+        _macro_stack().append(self)
+        self.nested = 0.0
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        elapsed = time.perf_counter() - self.start
+        stack = _macro_stack()
+        stack.pop()
+        if stack:
+            stack[-1].nested += elapsed
+        self.stats.cumulative += elapsed
+        self.stats.self_time += elapsed - self.nested
+
+    def filter(self, name):
+        return _Filter(self.stats, name)
+
+    def output(self, tree):
+        self.stats.nodes_out += count_nodes(tree)
+
+    def yielded(self):
+        self.stats.rewalks += 1
+        self.walked = macro_stats.walked
+
+    def resumed(self):
+        self.stats.rewalked += macro_stats.walked - self.walked
+
+    def memoized(self, hit):
+        if hit:
+            self.stats.hits += 1
+        else:
+            self.stats.misses += 1
+
+
+class _Filter(object):
+    """Internal; times the application of a filter, or of fused filters
+    whose parts are timed separately, see `timed_filter`:func:."""
+
+    __slots__ = ('stats', 'name', 'start', 'parts', 'outer')
+
+    def __init__(self, stats, name):
+        self.stats = stats
+        self.name = name
+
+    def __enter__(self):
+        self.parts = 0.0
+        self.outer = getattr(_state, 'filter', None)
+        _state.filter = self
+        self.start = time.perf_counter()
+        return self
+
+    def add(self, name, seconds):
+        """Record *seconds* spent in the filter *name*, part of this one."""
+        filters = self.stats.filters
+        filters[name] = filters.get(name, 0.0) + seconds
+        self.parts += seconds
+
+    def __exit__(self, *exc_info):
+        elapsed = time.perf_counter() - self.start
+        _state.filter = self.outer
+        filters = self.stats.filters
+        filters[self.name] = (filters.get(self.name, 0.0) + elapsed -
+                              self.parts)
+        self.stats.cumulative += elapsed
+        stack = _macro_stack()
+        if stack:
+            stack[-1].nested += elapsed
+
+
+def _macro_stack():
+    try:
+        return _state.macro_stack
+    except AttributeError:
+        _state.macro_stack = []
+        return _state.macro_stack
+
+
+def timed_filter(func, name):
+    """Return *func* wrapped to record the time spent in it as the one of
+    the filter *name*, when it's part of the filter being applied, like
+    the `~.macros.NodeFilter`:class: instances fused together, or
+    *func* itself if it isn't timed. The filter being applied is left
+    with the rest of the time, the one of the traversal."""
+    current = getattr(_state, 'filter', None)
+    if current is None:
+        return func
+
+    def timed(**kw):
+        start = time.perf_counter()
+        try:
+            return func(**kw)
+        finally:
+            current.add(name, time.perf_counter() - start)
+
+    return timed
+
+
+def invocation(func, tree):
+    """Return an object recording the statistics of an invocation of the
+    macro *func* on *tree*. It's a context
+    manager to be entered around each segment of the invocation, with
+    methods to record the time spent in a filter (again a context
+    manager), the output tree and the re-walks of its results.
+    """
+    if not enabled:
+        return _null_invocation
+    return _Invocation(macro_stats.get(func), tree)
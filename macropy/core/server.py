@@ -0,0 +1,316 @@
+# -*- coding: utf-8 -*-
+"""A long-lived process expanding modules on behalf of others, for the
+short-lived ones like command line tools, which would otherwise import
+the macro modules and expand the same modules at every run.
+
+The `ExpansionServer`:class: listens on a Unix domain socket, accepting
+only the connections of processes of the same user, and keeps the
+macro modules imported and the expansions in memory. The
+`ExpansionClient`:class: asks it for the code of a module, falling back
+to the local expansion when the server isn't running or is of another
+version. Each message is a marshalled value prefixed by its length.
+"""
+
+import collections
+import importlib.util
+import logging
+import marshal
+import os
+import socket
+import socketserver
+import struct
+import sys
+import threading
+
+from . import compat
+from .exporters import _pack_uint32, dependencies_changed
+
+
+logger = logging.getLogger(__name__)
+
+
+# The version of the protocol between the client and the server.
+PROTOCOL = 1
+
+
+def version():
+    """Return what must match between a client and the server: the
+    protocol, the magic number of the bytecode, the version of MacroPy
+    and the interpreter flags, as ``-O`` changes the code compiled."""
+    import macropy
+    return (PROTOCOL, importlib.util.MAGIC_NUMBER, macropy.__version__,
+            tuple(sys.flags))
+
+
+def server_path():
+    """Return the path of the socket of the server configured with the
+    ``MACROPY_EXPANSION_SERVER`` environment variable, or ``None``."""
+    return os.environ.get('MACROPY_EXPANSION_SERVER') or None
+
+
+def send(sock, value):
+    """Send *value* through the socket *sock*."""
+    data = marshal.dumps(value)
+    sock.sendall(_pack_uint32(len(data)) + data)
+
+
+def receive(sock):
+    """Receive a value sent by `send`:func: through the socket *sock*,
+    or ``None`` if the connection is closed."""
+    header = _receive_exactly(sock, 4)
+    if header is None:
+        return None
+    data = _receive_exactly(sock, int.from_bytes(header, 'little'))
+    if data is None:
+        return None
+    return marshal.loads(data)
+
+
+def _receive_exactly(sock, size):
+    """Internal; receive *size* bytes, or ``None`` if the connection is
+    closed before."""
+    chunks = []
+    while size:
+        chunk = sock.recv(min(size, 1024 * 1024))
+        if not chunk:
+            return None
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+
+def _peer_uid(sock):
+    """Internal; return the user id of the process at the other end of
+    the Unix socket *sock*, or ``None`` if it can't be known."""
+    peercred = getattr(socket, 'SO_PEERCRED', None)
+    if peercred is None:
+        return None
+    creds = sock.getsockopt(socket.SOL_SOCKET, peercred,
+                            struct.calcsize('3i'))
+    pid, uid, gid = struct.unpack('3i', creds)
+    return uid
+
+
+class _Handler(socketserver.BaseRequestHandler):
+    """Internal; serves the requests of a connection."""
+
+    def handle(self):
+        uid = _peer_uid(self.request)
+        if uid is not None and uid != os.getuid():
+            logger.warning('Refused a connection from user %d', uid)
+            return
+        while True:
+            request = receive(self.request)
+            if request is None:
+                return
+            server = self.server.expansion_server
+            send(self.request, server.handle(request))
+            if server.stopping:
+                threading.Thread(target=server.shutdown).start()
+                return
+
+
+class _UnixServer(socketserver.ThreadingMixIn,
+                  socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class ExpansionServer(object):
+    """Expands the modules asked by the clients, keeping the latest
+    *max_entries* expansions in memory. The expansion itself is the one
+    of the import hook, see
+    `~.import_hooks.MacroFinder.find_or_expand`:meth:, so it uses the
+    caches configured in this process too.
+
+    :param path: the path of the socket
+    :param max_entries: the maximum number of expansions kept
+    :ivar stats: the counts of the requests served from memory
+      (``hits``), expanded (``misses``) and refused (``errors``)
+    """
+
+    def __init__(self, path, max_entries=4096):
+        self.path = path
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()
+        self.stats = {'hits': 0, 'misses': 0, 'errors': 0}
+        self.stopping = False
+        self._lock = threading.Lock()
+        self._expand_lock = threading.Lock()
+        self._server = None
+
+    def handle(self, request):
+        """Return the response to *request*, a tuple of ``(version,
+        command, *arguments)``. The responses are a tuple whose first
+        item is ``'ok'``, ``'none'`` (the module doesn't use macros),
+        ``'version'`` (the version of the server doesn't match) or
+        ``'error'``. The commands are ``'expand'``, see
+        `expand`:meth:, ``'stats'`` and ``'stop'``."""
+        try:
+            client_version, command = request[:2]
+        except (TypeError, ValueError):
+            return ('error', 'invalid request')
+        if client_version != version():
+            self._count('errors')
+            return ('version', version())
+        try:
+            if command == 'expand':
+                return self.expand(*request[2:])
+            elif command == 'stats':
+                with self._lock:
+                    stats = dict(self.stats, entries=len(self.entries))
+                return ('ok', stats)
+            elif command == 'stop':
+                # once the response is sent
+                self.stopping = True
+                return ('ok', None)
+            return ('error', 'unknown command {!r}'.format(command))
+        except Exception as e:
+            self._count('errors')
+            logger.debug('Request %r failed', command, exc_info=True)
+            return ('error', '{}: {}'.format(type(e).__name__, e))
+
+    def expand(self, module_name, file_name, source, path=()):
+        """Serve the request to expand *source*, the source of the module
+        *module_name* at *file_name*, in a process whose ``sys.path``
+        is *path*. The entries of *path* are added to the one of the
+        server during the expansion only, and the expansions are kept
+        by path, since the macro modules found depend on it."""
+        path = tuple(path)
+        key = (module_name, file_name,
+               compat.source_hash(source.encode('utf-8')), path)
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+        if entry is not None and not dependencies_changed(entry[1]):
+            self._count('hits')
+            return ('ok',) + entry
+        self._count('misses')
+        from .import_hooks import MacroFinder
+        spec = importlib.util.spec_from_file_location(module_name,
+                                                      file_name)
+        # sys.path is shared by the threads serving the requests
+        with self._expand_lock:
+            server_path = list(sys.path)
+            sys.path.extend(entry for entry in path
+                            if entry not in server_path)
+            try:
+                code, tree, dependencies = MacroFinder.find_or_expand(
+                    module_name, file_name, source, spec,
+                    ask_server=False)
+            finally:
+                sys.path[:] = server_path
+        if code is None:
+            return ('none',)
+        entry = (marshal.dumps(code), dependencies)
+        with self._lock:
+            self.entries[key] = entry
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return ('ok',) + entry
+
+    def _count(self, name):
+        with self._lock:
+            self.stats[name] += 1
+
+    def bind(self):
+        """Create the socket, readable only by this user, replacing the
+        one of a server that isn't running anymore."""
+        if os.path.exists(self.path):
+            if ExpansionClient(self.path).ping():
+                raise OSError('A server is already listening on {!r}'
+                              .format(self.path))
+            os.unlink(self.path)
+        umask = os.umask(0o177)
+        try:
+            self._server = _UnixServer(self.path, _Handler)
+        finally:
+            os.umask(umask)
+        self._server.expansion_server = self
+
+    def serve_forever(self):
+        """Serve the requests until `shutdown`:meth: is called, then
+        remove the socket."""
+        if self._server is None:
+            self.bind()
+        try:
+            self._server.serve_forever()
+        finally:
+            self._server.server_close()
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+
+    def shutdown(self):
+        """Stop `serve_forever`:meth:, from another thread."""
+        if self._server is not None:
+            self._server.shutdown()
+
+
+class ExpansionClient(object):
+    """Asks the `ExpansionServer`:class: listening at *path* for the
+    expansion of the modules. It gives up, for the rest of the life of
+    the process, as soon as the server can't be reached or is of
+    another version.
+
+    :param path: the path of the socket
+    :param timeout: the time to wait for a response, in seconds
+    :ivar available: false once the client has given up
+    """
+
+    def __init__(self, path, timeout=60.0):
+        self.path = path
+        self.timeout = timeout
+        self.available = True
+        self.version = version()
+
+    def request(self, command, *arguments):
+        """Send a request and return the response, or ``None`` if the
+        server isn't available."""
+        if not self.available:
+            return None
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                sock.settimeout(self.timeout)
+                sock.connect(self.path)
+                send(sock, (self.version, command) + arguments)
+                response = receive(sock)
+        except (OSError, EOFError, ValueError, TypeError):
+            logger.debug('Expansion server %r unavailable', self.path,
+                         exc_info=True)
+            self.available = False
+            return None
+        if response is None:
+            logger.warning('Expansion server %r closed the connection',
+                           self.path)
+            self.available = False
+        elif response[0] == 'version':
+            logger.warning('Expansion server %r has version %r, not %r',
+                           self.path, response[1], self.version)
+            self.available = False
+            return None
+        return response
+
+    def ping(self):
+        """Tell if the server is running."""
+        response = self.request('stats')
+        return response is not None and response[0] == 'ok'
+
+    def find(self, module_name, file_name, source):
+        """Return a tuple of ``(code, dependencies)`` with the expansion of
+        *source*, or ``None`` if it doesn't use macros, the expansion
+        failed or the server isn't available."""
+        # the relative entries are relative to the current directory
+        # of this process
+        path = [os.path.abspath(entry) for entry in sys.path
+                if isinstance(entry, str)]
+        response = self.request('expand', module_name, file_name, source,
+                                path)
+        if response is None or response[0] != 'ok':
+            if response is not None and response[0] == 'error':
+                logger.debug('Expansion server failed on %s: %s',
+                             module_name, response[1])
+            return None
+        code, dependencies = response[1:]
+        return marshal.loads(code), dependencies
@@ -61,6 +61,12 @@ from . import macros
 from . import hquotes
 from . import exporters
 from . import analysis
+from . import cache
+from . import import_hooks
+from . import profiling
+from . import memo
+from . import prefetch
+from . import server
 Tests = test_suite(cases = [
     quotes,
     unparse,
@@ -68,6 +74,12 @@ Tests = test_suite(cases = [
     macros,
     Cases,
     hquotes,
-#    exporters,
-    analysis
+    exporters,
+    analysis,
+    cache,
+    import_hooks,
+    profiling,
+    memo,
+    prefetch,
+    server
 ])
@@ -5,7 +5,8 @@ import unittest
 import macropy.core
 
 from macropy.core.walkers import Walker
-from macropy.core.analysis import Scoped, extract_arg_names
+from macropy.core.analysis import (AnalysisIndex, Scoped, extract_arg_names,
+                                    find_assignments)
 
 
 @Scoped
@@ -188,3 +189,47 @@ class C:
     C
 C
         """)
+
+    def test_analysis_index(self):
+        tree = macropy.core.parse_stmt("""
+a, b = 1, c
+def f(x):
+    y = x.z
+    return y
+class C:
+    d = 2
+        """)
+        index = AnalysisIndex(tree)
+
+        # the symbol tables are the same found by find_assignments
+        for scope in (tree, tree[1].body, tree[2].body):
+            self.assertEqual(index.symbols(scope),
+                             dict(find_assignments.collect(scope)))
+        self.assertEqual(set(index.symbols(tree)), {'a', 'b', 'f', 'C'})
+        self.assertEqual(set(index.symbols(tree[1].body)), {'y'})
+
+        for name in ('a', 'b', 'c', 'f', 'x', 'y', 'C', 'd'):
+            self.assertIn(name, index)
+        # an attribute isn't a name
+        self.assertNotIn('z', index)
+
+        ret = tree[1].body[1]
+        self.assertIs(index.parent(ret), tree[1])
+        self.assertIs(index.parent(ret.value), ret)
+        self.assertIsNone(index.parent(tree[0]))
+        self.assertEqual(index.sorted_positions()[:3],
+                         [(2, 0), (2, 3), (2, 7)])
+
+        # replacing a subtree updates the names, the bindings and the
+        # positions
+        new = macropy.core.parse_stmt("w = y")[0]
+        new.lineno, new.col_offset = 9, 4
+        new.targets[0].lineno = new.value.lineno = 9
+        index.replace_subtree(ret, new)
+        tree[1].body[1] = new
+        self.assertIn('w', index)
+        self.assertEqual(set(index.symbols(tree[1].body)), {'y', 'w'})
+        self.assertIs(index.parent(new.value), new)
+        self.assertIsNone(index.parent(ret))
+        self.assertIn((9, 4), index.sorted_positions())
+        self.assertNotIn((5, 4), index.sorted_positions())
@@ -0,0 +1,390 @@
+# -*- coding: utf-8 -*-
+import contextlib
+import importlib.machinery
+import importlib.util
+import io
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+from macropy.core.cache import ExpansionCache, UsageIndex, fcntl
+from macropy.core.import_hooks import MacroFinder
+
+
+class Tests(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def write(self, name, content):
+        path = os.path.join(self.tmp, name)
+        with open(path, 'w') as f:
+            f.write(content)
+        return path
+
+    def test_usage_index(self):
+        plain = self.write('plain.py', 'x = 1\n')
+        index_path = os.path.join(self.tmp, 'cache', 'usage.index')
+        index = UsageIndex(index_path)
+        assert index.lookup(plain) is None
+        index.record(plain, False)
+        assert index.lookup(plain) is False
+        index.save()
+
+        # another process sees the recorded entries
+        index = UsageIndex(index_path)
+        assert index.lookup(plain) is False
+        # until the file changes
+        with open(plain, 'a') as f:
+            f.write('y = 2\n')
+        assert index.lookup(plain) is None
+
+    def test_usage_index_merges_on_save(self):
+        first = self.write('first.py', 'x = 1\n')
+        second = self.write('second.py', 'x = 2\n')
+        index_path = os.path.join(self.tmp, 'usage.index')
+        index1 = UsageIndex(index_path)
+        index2 = UsageIndex(index_path)
+        index1.record(first, False)
+        index2.record(second, True)
+        index1.save()
+        index2.save()
+        index = UsageIndex(index_path)
+        assert index.lookup(first) is False
+        assert index.lookup(second) is True
+
+    def test_usage_index_modules(self):
+        # the index and the modules that come and go are outside of
+        # the directories looked into
+        first, lib, last = (os.path.join(self.tmp, name)
+                            for name in ('first', 'lib', 'last'))
+        for dir_name in (first, lib, last):
+            os.mkdir(dir_name)
+        plain = self.write(os.path.join('lib', 'plain.py'), 'x = 1\n')
+        index_path = os.path.join(self.tmp, 'usage.index')
+        index = UsageIndex(index_path)
+        index.record_module('plain', [lib], plain)
+        assert index.lookup_module('plain', [lib]) is None
+        index.record(plain, False)
+        assert index.lookup_module('plain', [lib]) is False
+        # looked for elsewhere it may be another module
+        assert index.lookup_module('plain', [lib, 'other']) is None
+        assert index.lookup_module('plain') is None
+
+        # the entries of the files removed are dropped on save
+        gone = self.write('gone.py', 'x = 2\n')
+        index.record_module('gone', [self.tmp], gone)
+        index.record(gone, False)
+        os.unlink(gone)
+        index.save()
+        index = UsageIndex(index_path)
+        assert index.lookup_module('plain', [lib]) is False
+        assert gone not in index.entries
+        assert len(index.entries) == 2
+
+        # a module with the same name added before it hides it
+        search_path = [first, lib, last]
+        index.record_module('plain', search_path, plain)
+        assert index.lookup_module('plain', search_path) is False
+        self.write(os.path.join('last', 'plain.py'), 'x = 3\n')
+        assert index.lookup_module('plain', search_path) is False
+        self.write(os.path.join('first', 'plain.py'), 'x = 3\n')
+        assert index.lookup_module('plain', search_path) is None
+
+    def test_finder_skips_indexed_modules(self):
+        from macropy.core.test.macros import basic_expr
+        name = basic_expr.__name__
+        path = [os.path.dirname(basic_expr.__file__)]
+        index = UsageIndex(os.path.join(self.tmp, 'usage.index'))
+        old_index = MacroFinder.usage_index
+        MacroFinder.usage_index = index
+        try:
+            spec = MacroFinder.find_spec(name, path)
+            assert spec is not None
+            # the source is looked into when the module is loaded
+            spec.loader.get_code(name)
+            assert index.lookup(basic_expr.__file__) is True
+            # an entry saying that the file doesn't use macros makes
+            # the finder skip it
+            index.record(basic_expr.__file__, False)
+            assert MacroFinder.find_spec(name, path) is None
+
+            # without even looking for the module
+            def find_spec_nomacro(*args):
+                raise AssertionError('looked for')
+
+            MacroFinder._find_spec_nomacro = find_spec_nomacro
+            assert MacroFinder.find_spec(name, path) is None
+        finally:
+            MacroFinder.__dict__.pop('_find_spec_nomacro', None)
+            MacroFinder.usage_index = old_index
+
+    def test_finder_indexes_cached_modules(self):
+        # a module whose expansion comes from a cache, with a loader
+        # that isn't replaced
+        class Loader(importlib.machinery.SourceFileLoader):
+            pass
+
+        path = self.write('macropy_test_cached.py',
+                          'from macropy.core.test.macros.basic_expr_macro '
+                          'import macros, f\n')
+        index = UsageIndex(os.path.join(self.tmp, 'usage.index'))
+        old_index = MacroFinder.usage_index
+        MacroFinder.usage_index = index
+        MacroFinder._find_spec_nomacro = lambda *args: (
+            importlib.util.spec_from_file_location(
+                'macropy_test_cached', path,
+                loader=Loader('macropy_test_cached', path)))
+        MacroFinder.find_or_expand = lambda *args: (
+            compile('', path, 'exec'), None, {})
+        try:
+            assert MacroFinder.find_spec('macropy_test_cached',
+                                         None) is not None
+            assert index.lookup(path) is True
+        finally:
+            MacroFinder.__dict__.pop('_find_spec_nomacro', None)
+            MacroFinder.__dict__.pop('find_or_expand', None)
+            MacroFinder.usage_index = old_index
+
+    def expand(self, cache, name, content):
+        """Expand the module *name* with *content*, storing it in
+        *cache*, and return the path of the module."""
+        path = self.write(name.replace('.', os.sep) + '.py', content)
+        old_cache = MacroFinder.expansion_cache
+        MacroFinder.expansion_cache = cache
+        try:
+            spec = importlib.util.spec_from_file_location(name, path)
+            MacroFinder.expand_macros(content, path, spec)
+        finally:
+            MacroFinder.expansion_cache = old_cache
+        return path
+
+    def test_expansion_cache(self):
+        source = ("from macropy.core.test.macros.basic_expr_macro "
+                  "import macros, f\n"
+                  "x = f[1 * max(1, 2, 3)]\n")
+        cache = ExpansionCache(os.path.join(self.tmp, 'cache'))
+        self.expand(cache, 'first', source)
+        # the same module elsewhere
+        other = os.path.join(self.tmp, 'other', 'first.py')
+        code, dependencies = cache.find('first', other, source)
+        assert code.co_filename == other
+        namespace = {}
+        exec(code, namespace)
+        assert namespace['x'] == 10
+        assert 'macropy.core.test.macros.basic_expr_macro' in dependencies
+        assert cache.find('first', other, source + '\n') is None
+        assert cache.stats == {'hits': 1, 'misses': 1, 'evictions': 0}
+
+        # an expansion made with another version of a macro module
+        # isn't used
+        stale = ExpansionCache(os.path.join(self.tmp, 'stale'))
+        stale.store(code, 'first', other, source, {
+            name: (file_name, b'whatever')
+            for name, (file_name, digest) in dependencies.items()})
+        assert stale.find('first', other, source) is None
+
+        cache.save_stats()
+        cache.find('first', other, source)
+        cache.save_stats()
+        assert ExpansionCache(cache.path).load_stats() == {
+            'hits': 2, 'misses': 1, 'evictions': 0}
+
+    def test_expansion_cache_loaded_dependencies(self):
+        # the macro module imported is the one the expansion depends
+        # on, even if its file has changed since
+        self.write('macropy_test_mac.py', (
+            "import ast\n"
+            "from macropy.core.macros import Macros\n"
+            "macros = Macros()\n"
+            "@macros.expr\n"
+            "def m(tree, **kw):\n"
+            "    return ast.Num(n=1)\n"))
+        source = "from macropy_test_mac import macros, m\nx = m[0]\n"
+        cache = ExpansionCache(os.path.join(self.tmp, 'cache'))
+        sys.path.insert(0, self.tmp)
+        try:
+            path = self.expand(cache, 'macropy_test_app', source)
+            self.write('macropy_test_mac.py', '# changed\n')
+            assert cache.find('macropy_test_app', path, source) is not None
+            # but not in an environment where it isn't imported yet
+            del sys.modules['macropy_test_mac']
+            assert cache.find('macropy_test_app', path, source) is None
+        finally:
+            sys.path.remove(self.tmp)
+            sys.modules.pop('macropy_test_mac', None)
+
+    def test_expansion_cache_packages(self):
+        # the same source importing the macros of its own package
+        source = "from .mac import macros, m\nx = m[0]\n"
+        for package, value in (('macropy_test_pkga', 1),
+                               ('macropy_test_pkgb', 2)):
+            os.mkdir(os.path.join(self.tmp, package))
+            self.write(os.path.join(package, '__init__.py'), '')
+            self.write(os.path.join(package, 'mac.py'), (
+                "import ast\n"
+                "from macropy.core.macros import Macros\n"
+                "macros = Macros()\n"
+                "@macros.expr\n"
+                "def m(tree, **kw):\n"
+                "    return ast.Num(n=%d)\n") % value)
+        cache = ExpansionCache(os.path.join(self.tmp, 'cache'))
+        sys.path.insert(0, self.tmp)
+        try:
+            self.expand(cache, 'macropy_test_pkga.mod', source)
+            first = os.path.join(self.tmp, 'macropy_test_pkga', 'mod.py')
+            assert cache.find('macropy_test_pkga.mod', first,
+                              source) is not None
+            second = os.path.join(self.tmp, 'macropy_test_pkgb', 'mod.py')
+            assert cache.find('macropy_test_pkgb.mod', second,
+                              source) is None
+        finally:
+            sys.path.remove(self.tmp)
+            for name in list(sys.modules):
+                if name.startswith(('macropy_test_pkga',
+                                    'macropy_test_pkgb')):
+                    del sys.modules[name]
+
+    def test_module_file(self):
+        from macropy.core.cache import _module_file
+        os.mkdir(os.path.join(self.tmp, 'macropy_test_pkg'))
+        self.write(os.path.join('macropy_test_pkg', '__init__.py'),
+                   'raise ImportError\n')
+        mod = self.write(os.path.join('macropy_test_pkg', 'mod.py'), '')
+        sys.path.insert(0, self.tmp)
+        try:
+            # found without importing the package
+            assert _module_file('macropy_test_pkg.mod') == mod
+            assert 'macropy_test_pkg' not in sys.modules
+            assert _module_file('macropy_test_pkg.missing') is None
+        finally:
+            sys.path.remove(self.tmp)
+
+    def test_expansion_cache_eviction(self):
+        cache = ExpansionCache(os.path.join(self.tmp, 'cache'),
+                               max_size=1000)
+        code = compile('x = 1', 'plain.py', 'exec')
+        for n in range(20):
+            cache.store(code, 'plain', 'plain.py', 'x = %d' % n, {})
+        files, size = cache.size()
+        assert size <= 1000
+        assert cache._size == size
+        assert cache.stats['evictions'] > 0
+        # the most recent expansions are kept
+        assert cache.find('plain', 'plain.py', 'x = 19') is not None
+        assert cache.find('plain', 'plain.py', 'x = 0') is None
+
+    def test_expansion_cache_remote(self):
+        remote = os.path.join(self.tmp, 'remote')
+        first = ExpansionCache(os.path.join(self.tmp, 'first'),
+                               remote=remote)
+        second = ExpansionCache(os.path.join(self.tmp, 'second'),
+                                remote=remote)
+        code = compile('x = 1', 'plain.py', 'exec')
+        first.store(code, 'plain', 'plain.py', 'x = 1', {})
+        assert second.size() == (0, 0)
+        assert second.find('plain', 'plain.py', 'x = 1') is not None
+        # it's copied locally
+        assert second.size()[0] == 2
+
+    def test_expansion_cache_cli(self):
+        from macropy.cache import main
+        path = os.path.join(self.tmp, 'cache')
+        cache = ExpansionCache(path)
+        cache.store(compile('x = 1', 'plain.py', 'exec'), 'plain',
+                    'plain.py', 'x = 1', {})
+        cache.find('plain', 'plain.py', 'x = 1')
+        cache.save_stats()
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            main(['-d', path, 'stats'])
+        assert 'files: 2' in out.getvalue()
+        assert 'hit rate: 100.0%' in out.getvalue()
+        with contextlib.redirect_stdout(out):
+            main(['-d', path, 'prune', '-s', '0'])
+        assert cache.size() == (0, 0)
+
+    @unittest.skipIf(fcntl is None, 'no fcntl')
+    def test_expansion_lock(self):
+        source = 'x = 1'
+        cache = ExpansionCache(os.path.join(self.tmp, 'cache'))
+        other = ExpansionCache(cache.path, lock_timeout=0.2)
+        first = cache.lock('plain', source)
+        assert first.acquired and not first.waited
+        # held by another process, or another open file here
+        second = other.lock('plain', source)
+        assert second.waited and not second.acquired
+        assert other.stats['timeouts'] == 1
+        # a lock file older than the timeout is stale
+        with open(first.file_name, 'w') as f:
+            f.write('1 %r' % (time.time() - 10))
+        third = other.lock('plain', source)
+        assert third.waited and third.acquired
+        first.release()
+        assert os.path.exists(third.file_name)
+        third.release()
+        assert not os.path.exists(third.file_name)
+
+    def test_expansion_cache_size(self):
+        cache = ExpansionCache(os.path.join(self.tmp, 'cache'))
+        code = compile('x = 1', 'plain.py', 'exec')
+        cache.store(code, 'plain', 'plain.py', 'x = 1', {})
+        assert cache._size == cache.size()[1]
+        cache.store(code, 'plain', 'plain.py', 'x = 2', {})
+        assert cache._size == cache.size()[1]
+
+    @unittest.skipIf(fcntl is None, 'no fcntl')
+    def test_save_stats_lock(self):
+        from macropy.core.cache import ExpansionLock
+        cache = ExpansionCache(os.path.join(self.tmp, 'cache'),
+                               lock_timeout=0.2)
+        cache.find('plain', 'plain.py', 'x = 1')
+        # another process saving its counts
+        with ExpansionLock(os.path.join(cache.path, 'stats.lock'), 1):
+            cache.save_stats()
+            assert cache.load_stats() == {}
+        # they are kept for the next time
+        assert cache.stats['misses'] == 1
+        cache.save_stats()
+        assert cache.load_stats()['misses'] == 1
+
+    @unittest.skipIf(fcntl is None, 'no fcntl')
+    def test_expansion_cache_stampede(self):
+        log = os.path.join(self.tmp, 'expansions.log')
+        self.write('slow_macro.py', (
+            "import os, time\n"
+            "from macropy.core.macros import Macros\n"
+            "macros = Macros()\n"
+            "@macros.expr\n"
+            "def slow(tree, **kw):\n"
+            "    with open(%r, 'a') as f:\n"
+            "        f.write('%%d\\n' %% os.getpid())\n"
+            "    time.sleep(0.5)\n"
+            "    return tree\n") % log)
+        self.write('app.py', 'from slow_macro import macros, slow\n'
+                   'x = slow[42]\n')
+        root = os.path.dirname(os.path.dirname(os.path.dirname(
+            os.path.dirname(os.path.abspath(__file__)))))
+        env = dict(os.environ, PYTHONPATH=root,
+                   MACROPY_EXPANSION_CACHE=os.path.join(self.tmp, 'cache'))
+        # the workers of a server starting together on an empty cache
+        workers = [subprocess.Popen(
+            [sys.executable, '-c', 'import macropy.activate, app; '
+             'print(app.x)'], cwd=self.tmp, env=env,
+            stdout=subprocess.PIPE) for n in range(4)]
+        outputs = [worker.communicate()[0] for worker in workers]
+        assert outputs == [b'42\n'] * 4
+        assert [worker.returncode for worker in workers] == [0] * 4
+        # only one of them expanded the module
+        with open(log) as f:
+            assert len(f.readlines()) == 1
+        # each source was missed once, by the worker that expanded it,
+        # the lookups made before waiting for it aren't misses
+        stats = ExpansionCache(os.path.join(self.tmp, 'cache')).load_stats()
+        assert stats['hits'] == 3 * stats['misses']
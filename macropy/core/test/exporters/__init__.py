@@ -1,70 +1,245 @@
-import unittest
-import sys
+import importlib
 import os
+import re
+import shutil
+import sys
+import tempfile
+import unittest
+
 pyc_cache_count = 0
 pyc_cache_macro_count = 0
-from macropy.core.exporters import NullExporter, PycExporter, SaveExporter
+deps_macro_count = 0
+from macropy.core.exporters import (ArchiveExporter, ExpansionArchive,
+                                    NullExporter, PycExporter, SaveExporter,
+                                    load_archive)
+from macropy.core.import_hooks import ArchiveLoader, MacroFinder
 
 THIS_FOLDER = os.path.dirname(__file__)
 
+
 class Tests(unittest.TestCase):
     def test_null_exporter(self):
-        import pyc_cache
+        from . import pyc_cache
         # every load and reload should re-run both macro and file
-        assert (pyc_cache_count, pyc_cache_macro_count) == (1, 1)
-        reload(pyc_cache)
-        assert (pyc_cache_count, pyc_cache_macro_count) == (2, 2)
-        reload(pyc_cache)
-        assert (pyc_cache_count, pyc_cache_macro_count) == (3, 3)
+        count, macro_count = pyc_cache_count, pyc_cache_macro_count
+        importlib.reload(pyc_cache)
+        assert (pyc_cache_count, pyc_cache_macro_count) == (count + 1,
+                                                            macro_count + 1)
+        importlib.reload(pyc_cache)
+        assert (pyc_cache_count, pyc_cache_macro_count) == (count + 2,
+                                                            macro_count + 2)
+
+    def copy_fixtures(self, *names):
+        """Copy the modules *names* of this package to a temporary
+        directory on ``sys.path``, as top-level modules prefixed with
+        ``macropy_test_``, so that they can be changed. Return the
+        directory."""
+        directory = tempfile.mkdtemp()
+        sys.path.insert(0, directory)
+        for name in names:
+            with open(os.path.join(THIS_FOLDER, name + ".py")) as f:
+                source = f.read()
+            for other in names:
+                source = re.sub(r"\b%s\.%s\b" % (re.escape(__name__), other),
+                                "macropy_test_" + other, source)
+            with open(os.path.join(directory,
+                                   "macropy_test_" + name + ".py"), "w") as f:
+                f.write(source)
+
+        def cleanup():
+            sys.path.remove(directory)
+            for name in names:
+                sys.modules.pop("macropy_test_" + name, None)
+            shutil.rmtree(directory)
+
+        self.addCleanup(cleanup)
+        return directory
 
     def test_pyc_exporter(self):
         import macropy
 
-        macropy.exporter = PycExporter()
-        import pyc_cache
-        assert (pyc_cache_count, pyc_cache_macro_count) == (3, 3)
+        directory = self.copy_fixtures("pyc_cache")
+        cache_file = os.path.join(directory, "macropy_test_pyc_cache.py")
+        exporter = PycExporter()
+        pyc_file = exporter.cache_path(cache_file)
 
-        # reloading the file should re-run file but not macro
-        reload(pyc_cache)
-        assert (pyc_cache_count, pyc_cache_macro_count) == (4, 3)
-        reload(pyc_cache)
-        assert (pyc_cache_count, pyc_cache_macro_count) == (5, 3)
+        macropy.exporter = exporter
+        dont_write_bytecode = sys.dont_write_bytecode
+        sys.dont_write_bytecode = False
+        try:
+            count, macro_count = pyc_cache_count, pyc_cache_macro_count
+            # the first load expands the macro and caches the result
+            pyc_cache = importlib.import_module("macropy_test_pyc_cache")
+            assert (pyc_cache_count, pyc_cache_macro_count) == (
+                count + 1, macro_count + 1)
+            assert os.path.exists(pyc_file)
 
-        
-        cache_file = os.path.join(THIS_FOLDER, "pyc_cache.py")
-        # unless you touch the file to bring its mtime up to that of the
-        # stored .pyc, in which case the macro gets re-run too
-        f = open(cache_file, "a")
-        f.write(" ")
-        f.close()
+            # reloading the file should re-run file but not macro
+            importlib.reload(pyc_cache)
+            assert (pyc_cache_count, pyc_cache_macro_count) == (
+                count + 2, macro_count + 1)
+            importlib.reload(pyc_cache)
+            assert (pyc_cache_count, pyc_cache_macro_count) == (
+                count + 3, macro_count + 1)
 
-        reload(pyc_cache)
-        assert (pyc_cache_count, pyc_cache_macro_count) == (6, 4)
+            # unless you change the source, in which case its hash
+            # doesn't match the cached one anymore and the macro gets
+            # re-run too
+            with open(cache_file, "a") as f:
+                f.write("# changed\n")
 
-        reload(pyc_cache)
-        assert (pyc_cache_count, pyc_cache_macro_count) == (7, 4)
+            importlib.reload(pyc_cache)
+            assert (pyc_cache_count, pyc_cache_macro_count) == (
+                count + 4, macro_count + 2)
 
-        f = open(cache_file, "a")
-        f.write(" ")
-        f.close()
+            importlib.reload(pyc_cache)
+            assert (pyc_cache_count, pyc_cache_macro_count) == (
+                count + 5, macro_count + 2)
+        finally:
+            macropy.exporter = NullExporter()
+            sys.dont_write_bytecode = dont_write_bytecode
+
+    def test_pyc_exporter_dependencies(self):
+        import macropy
 
-        reload(pyc_cache)
-        assert (pyc_cache_count, pyc_cache_macro_count) == (8, 5), (pyc_cache_count, pyc_cache_macro_count)
+        directory = self.copy_fixtures("deps", "deps_macro")
+        exporter = PycExporter(directory)
+        macro_file = os.path.join(directory, "macropy_test_deps_macro.py")
+
+        macropy.exporter = exporter
+        dont_write_bytecode = sys.dont_write_bytecode
+        sys.dont_write_bytecode = False
+        try:
+            deps = importlib.import_module("macropy_test_deps")
+            assert deps.run() == 6
+            macro_count = deps_macro_count
+            importlib.reload(deps)
+            assert deps_macro_count == macro_count
+
+            # the manifest records the macro modules used directly and
+            # the ones used to expand them
+            name = "macropy_test_deps"
+            assert name in exporter.dependents("macropy_test_deps_macro")
+            assert name in exporter.dependents("macropy.core.hquotes")
+            assert name in exporter.dependents("macropy.core.quotes")
+            assert name not in exporter.dependents(
+                "macropy.core.test.exporters.pyc_cache_macro")
+
+            # changing the macro module invalidates the cached expansion,
+            # but the one made with the old macro still loaded isn't
+            # cached for the new one
+            with open(macro_file, "a") as f:
+                f.write("# changed\n")
+            importlib.reload(deps)
+            assert deps_macro_count == macro_count + 1
+            importlib.reload(deps)
+            assert deps_macro_count == macro_count + 2
+            # until the macro module is reloaded too
+            importlib.reload(sys.modules["macropy_test_deps_macro"])
+            importlib.reload(deps)
+            assert deps_macro_count == macro_count + 3
+            importlib.reload(deps)
+            assert deps_macro_count == macro_count + 3
+            assert deps.run() == 6
+        finally:
+            macropy.exporter = NullExporter()
+            sys.dont_write_bytecode = dont_write_bytecode
 
     def test_save_exporter(self):
         import macropy
 
         exported = os.path.join(THIS_FOLDER, "exported")
         macropy.exporter = SaveExporter(exported, THIS_FOLDER)
+        try:
+            # the original code should work
+            from . import save
+            assert save.run() == 14
+        finally:
+            macropy.exporter = NullExporter()
+
+        # the copy of the code saved in the ./exported folder should work too
+        try:
+            import macropy.core.test.exporters.exported.save as save_exported
+            assert save_exported.run() == 14
+        finally:
+            shutil.rmtree(exported)
 
-        # the original code should work
-        import save
-        assert save.run() == 14
+    def test_archive_exporter(self):
+        import macropy
 
-        macropy.exporter = NullExporter()
+        directory = self.copy_fixtures("pyc_cache", "deps", "deps_macro")
+        path = os.path.join(directory, "app.mpar")
+        cache_file = os.path.join(directory, "macropy_test_pyc_cache.py")
+        # the macro module of deps uses macros too
+        names = ["macropy_test_pyc_cache", "macropy_test_deps_macro",
+                 "macropy_test_deps"]
+        exporter = ArchiveExporter(path)
+        macropy.exporter = exporter
+        archive = None
+        try:
+            pyc_cache = importlib.import_module(names[0])
+            deps = importlib.import_module(names[2])
+            assert exporter.save() == 3
 
-        # the copy of the code saved in the ./exported folder should work too
-        import macropy.core.test.exporters.exported.save as save_exported
-        assert save_exported.run() == 14
-        import shutil
-        shutil.rmtree(exported)
\ No newline at end of file
+            # the modules are served from the archive, in import order,
+            # without expanding them again
+            archive = ExpansionArchive(path)
+            assert list(archive.entries) == names
+            MacroFinder.archive = archive
+            count, macro_count = pyc_cache_count, pyc_cache_macro_count
+            importlib.reload(pyc_cache)
+            assert isinstance(pyc_cache.__spec__.loader, ArchiveLoader)
+            assert pyc_cache.__file__ == cache_file
+            assert (pyc_cache_count, pyc_cache_macro_count) == (
+                count + 1, macro_count)
+            importlib.reload(deps)
+            assert isinstance(deps.__spec__.loader, ArchiveLoader)
+            assert deps.run() == 6
+
+            # with check, a changed source isn't served
+            checked = ExpansionArchive(path, check=True)
+            assert checked.lookup(names[0]) is not None
+            with open(cache_file, "a") as f:
+                f.write("# changed\n")
+            assert checked.lookup(names[0]) is None
+            assert checked.lookup(names[2]) is not None
+            checked.close()
+        finally:
+            macropy.exporter = NullExporter()
+            MacroFinder.archive = None
+            if archive is not None:
+                archive.close()
+
+    def test_archive_package(self):
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, "app.mpar")
+        # the sources don't need to exist
+        package = os.path.join(directory, "archived", "__init__.py")
+        module = os.path.join(directory, "archived", "mod.py")
+        exporter = ArchiveExporter(path)
+        exporter.export_transformed(
+            compile("from . import mod", package, "exec"), None,
+            "archived", package)
+        exporter.export_transformed(
+            compile("value = 42", module, "exec"), None,
+            "archived.mod", module)
+        exporter.save()
+        archive = load_archive(path)
+        MacroFinder.archive = archive
+        try:
+            import archived
+            assert archived.__path__ == [os.path.dirname(package)]
+            assert archived.__file__ == package
+            assert archived.mod.value == 42
+        finally:
+            MacroFinder.archive = None
+            sys.modules.pop("archived", None)
+            sys.modules.pop("archived.mod", None)
+            archive.close()
+
+        # missing or invalid archives are ignored
+        assert load_archive(os.path.join(directory, "missing")) is None
+        with open(path, "wb") as f:
+            f.write(b"garbage")
+        assert load_archive(path) is None
+        shutil.rmtree(directory)
@@ -0,0 +1,5 @@
+from macropy.core.test.exporters.deps_macro import macros, g
+
+
+def run():
+    return g[1 + 1]
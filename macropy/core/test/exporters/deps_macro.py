@@ -0,0 +1,11 @@
+import macropy.core.macros
+
+from macropy.core.test import exporters
+from macropy.core.hquotes import macros, hq
+macros = macropy.core.macros.Macros()
+
+
+@macros.expr
+def g(tree, **kw):
+    exporters.deps_macro_count += 1
+    return hq[ast_literal[tree] * 3]
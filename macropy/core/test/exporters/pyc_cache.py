@@ -2,4 +2,4 @@ from macropy.core.test.exporters.pyc_cache_macro import macros, f
 from macropy.core.test import exporters
 
 exporters.pyc_cache_count += 1
-f[1]                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                    
\ No newline at end of file
+f[1]
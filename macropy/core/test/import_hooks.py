@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+import importlib.util
+import os
+import py_compile
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from macropy.core import compat
+from macropy.core.import_hooks import (ImportFilter, MacroFinder,
+                                       MacroSourceLoader, macro_dependencies)
+
+THIS_FOLDER = os.path.dirname(__file__)
+
+
+class Tests(unittest.TestCase):
+    def test_import_filter_names(self):
+        f = ImportFilter(include=['myapp'], exclude=['myapp.vendor'])
+        assert f.match_name('myapp') is True
+        assert f.match_name('myapp.models') is True
+        assert f.match_name('myapp.vendor') is False
+        assert f.match_name('myapp.vendor.six') is False
+        assert f.match_name('json') is False
+        assert f.match_name('macropy.core.hquotes') is True
+
+        f = ImportFilter(exclude=['json', 'macropy'])
+        assert f.match_name('json.decoder') is False
+        assert f.match_name('myapp') is True
+        assert f.match_name('macropy.peg') is False
+
+    def test_import_filter_paths(self):
+        root = os.path.join(THIS_FOLDER, 'macros')
+        f = ImportFilter(include=[root])
+        # undecided until the path of the module is known
+        assert f.match_name('macropy.core.test.macros') is None
+        assert f.match_name('foo') is None
+        assert f.match_path('foo', os.path.join(root, 'basic_expr.py'))
+        assert not f.match_path('foo', os.path.join(THIS_FOLDER, 'gen_sym.py'))
+        assert f.match_path('macropy.core.test.gen_sym',
+                            os.path.join(THIS_FOLDER, 'gen_sym.py'))
+
+        f = ImportFilter(exclude=[root])
+        assert not f.match_path('foo', os.path.join(root, 'basic_expr.py'))
+        assert f.match_path('foo', os.path.join(THIS_FOLDER, 'gen_sym.py'))
+
+    def test_finder_skips_excluded_modules(self):
+        from macropy.core.test.macros import basic_expr
+        name = basic_expr.__name__
+        path = [os.path.dirname(basic_expr.__file__)]
+        old_filter = MacroFinder.import_filter
+        try:
+            MacroFinder.import_filter = ImportFilter(
+                exclude=['macropy.core.test'])
+            assert MacroFinder.find_spec(name, path) is None
+            MacroFinder.import_filter = ImportFilter(exclude=path)
+            assert MacroFinder.find_spec(name, path) is None
+            MacroFinder.import_filter = ImportFilter(
+                include=['macropy.core.test.macros.basic_expr'])
+            assert MacroFinder.find_spec(name, path) is not None
+        finally:
+            MacroFinder.import_filter = old_filter
+
+    def load(self, tmp, name):
+        """Load the module *name* from *tmp*, returning it together with
+        the paths read by its loader."""
+        spec = MacroFinder.find_spec(name, [tmp])
+        assert isinstance(spec.loader, MacroSourceLoader)
+        read = []
+        get_data = spec.loader.get_data
+
+        def recording_get_data(path):
+            read.append(path)
+            return get_data(path)
+
+        spec.loader.get_data = recording_get_data
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        return module, read
+
+    def test_source_loader(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            plain = os.path.join(tmp, 'macropy_test_plain.py')
+            with open(plain, 'w') as f:
+                f.write("x = 1\n")
+            expanded = os.path.join(tmp, 'macropy_test_expanded.py')
+            with open(expanded, 'w') as f:
+                f.write("from macropy.core.test.macros.basic_expr_macro "
+                        "import macros, f\n"
+                        "x = f[1 * max(1, 2, 3)]\n")
+
+            module, read = self.load(tmp, 'macropy_test_plain')
+            assert module.x == 1
+            assert read.count(plain) == 1
+            module, read = self.load(tmp, 'macropy_test_expanded')
+            assert module.x == 10
+            assert read.count(expanded) == 1
+            if sys.dont_write_bytecode:
+                return
+            # the bytecode of the plain module is cached and used
+            # without reading the source again
+            assert os.path.exists(importlib.util.cache_from_source(plain))
+            module, read = self.load(tmp, 'macropy_test_plain')
+            assert module.x == 1 and plain not in read
+            # but not the expanded code
+            cache = importlib.util.cache_from_source(expanded)
+            assert not os.path.exists(cache)
+            # a .pyc of the unexpanded source is ignored
+            py_compile.compile(expanded, cache)
+            module, read = self.load(tmp, 'macropy_test_expanded')
+            assert module.x == 10 and expanded in read
+        finally:
+            shutil.rmtree(tmp)
+
+    def test_release_expansions(self):
+        tmp = tempfile.mkdtemp()
+        old_keep = MacroFinder.keep_expansions
+        try:
+            with open(os.path.join(tmp, 'macropy_test_release.py'),
+                      'w') as f:
+                f.write("from macropy.core.test.macros.basic_expr_macro "
+                        "import macros, f\n"
+                        "x = f[1 * max(1, 2, 3)]\n")
+            module, _ = self.load(tmp, 'macropy_test_release')
+            loader = module.__spec__.loader
+            assert module.x == 10
+            assert loader.code is loader.tree is loader.source is None
+            assert 'macropy.core.test.macros.basic_expr_macro' in \
+                loader.dependencies
+
+            MacroFinder.keep_expansions = True
+            module, _ = self.load(tmp, 'macropy_test_release')
+            loader = module.__spec__.loader
+            assert loader.code is not None and loader.tree is not None
+            assert 'f[' in loader.source
+        finally:
+            MacroFinder.keep_expansions = old_keep
+            shutil.rmtree(tmp)
+
+    def test_activate(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            with open(os.path.join(tmp, 'app.py'), 'w') as f:
+                f.write("from macropy.quick_lambda import macros, f, _\n"
+                        "x = f[_ * 10](1)\n")
+            cache_dir = os.path.join(tmp, 'cache')
+            root = os.path.dirname(os.path.dirname(os.path.dirname(
+                os.path.dirname(os.path.abspath(__file__)))))
+            env = dict(os.environ, PYTHONPATH=root)
+            env.pop('MACROPY_CACHE_DIR', None)
+            # the hook configured in a fresh process
+            output = subprocess.check_output(
+                [sys.executable, '-c', 'import macropy; '
+                 'macropy.activate(cache_dir=%r); macropy.activate(); '
+                 'import app, sys; print(app.x); '
+                 'print(sys.meta_path.count(sys.meta_path[0]))' % cache_dir],
+                cwd=tmp, env=env)
+            assert output == b'10\n1\n'
+            assert os.path.exists(os.path.join(cache_dir, 'usage.index'))
+        finally:
+            shutil.rmtree(tmp)
+
+    def test_dependencies_of_loaded_code(self):
+        tmp = tempfile.mkdtemp()
+        macro_file = os.path.join(tmp, 'macropy_test_dep_macro.py')
+        source = (b"from macropy.core.macros import Macros\n"
+                  b"macros = Macros()\n"
+                  b"@macros.expr\n"
+                  b"def m(tree, **kw):\n"
+                  b"    return tree\n")
+        sys.path.insert(0, tmp)
+        try:
+            with open(macro_file, 'wb') as f:
+                f.write(source)
+            with open(os.path.join(tmp, 'macropy_test_dep.py'), 'w') as f:
+                f.write("from macropy_test_dep_macro import macros, m\n"
+                        "x = m[1]\n")
+            module, _ = self.load(tmp, 'macropy_test_dep')
+            deps = module.__spec__.loader.dependencies
+            assert deps['macropy_test_dep_macro'] == (
+                macro_file, compat.source_hash(source))
+            # the macro module is changed on disk but not reloaded, the
+            # expansions still use the old one
+            with open(macro_file, 'ab') as f:
+                f.write(b"# changed\n")
+            deps = macro_dependencies(['macropy_test_dep_macro'])
+            assert deps['macropy_test_dep_macro'] == (
+                macro_file, compat.source_hash(source))
+        finally:
+            sys.path.remove(tmp)
+            sys.modules.pop('macropy_test_dep_macro', None)
+            shutil.rmtree(tmp)
@@ -1,8 +1,14 @@
 # -*- coding: utf-8 -*-
+import ast
 import unittest
 import sys
+import threading
 
-from macropy.core import compat
+from macropy.core import compat, profiling, unparse
+from macropy.core.macros import (has_macro_imports, filter_stages,
+                                  get_current_context, InjectedVars,
+                                  Macros, ModuleExpansionContext,
+                                  NodeFilter)
 
 
 class Tests(unittest.TestCase):
@@ -87,3 +93,276 @@ class Tests(unittest.TestCase):
     def test_macro_expand_single(self):
         from . import macro_expand_single as mes
         assert mes.run() == 10
+
+    def test_has_macro_imports(self):
+        assert has_macro_imports("from foo import macros, bar\n")
+        assert has_macro_imports("x = 1\nfrom .foo.bar import macros\n")
+        assert has_macro_imports("from foo import (macros,\n  bar)\n")
+        assert has_macro_imports("from foo import (  # hey\n  macros, bar)")
+        assert has_macro_imports("from foo \\\n  import macros, bar\n")
+        assert has_macro_imports("import os; from foo import macros, bar")
+        assert has_macro_imports("from foo import(macros, bar)\n")
+        assert has_macro_imports("from.foo import macros, bar\n")
+        assert has_macro_imports("from . foo . bar import macros\n")
+        assert has_macro_imports('x = "#"; from foo import macros, bar\n')
+        # only the top-level imports are taken into account
+        assert not has_macro_imports("if x:\n    from foo import macros\n")
+        assert not has_macro_imports("# from foo import macros\n")
+        assert not has_macro_imports("macros = 'macros'\n")
+        assert not has_macro_imports("from foo import bar, macros\n")
+        assert not has_macro_imports("")
+
+    def test_candidate_macro_types(self):
+        from . import basic_expr_macro
+        tree = ast.parse("x = f[1 * max(1, 2, 3)]\n")
+        ctx = ModuleExpansionContext(tree, "", [(basic_expr_macro,
+                                                 [('f', 'f')])])
+        expr_type, block_type, decorator_type = ctx.macro_types
+        assert ctx.candidate_macro_types(ast.Subscript) == (expr_type,)
+        # the block and decorator types have no registered macro
+        assert ctx.candidate_macro_types(ast.With) == ()
+        assert ctx.candidate_macro_types(ast.FunctionDef) == ()
+        assert ctx.candidate_macro_types(ast.Name) == ()
+        tree = ctx.expand_macros()
+        assert isinstance(tree.body[-1].value, ast.Num)
+
+    def test_cold_subtrees(self):
+        from . import basic_expr_macro
+        tree = ast.parse("def plain(a):\n"
+                         "    return a + 1\n"
+                         "def hot(a):\n"
+                         "    a = 2\n"
+                         "    return f[1 * max(1, 2, 3)]\n")
+        plain, hot = tree.body
+        ctx = ModuleExpansionContext(tree, "", [(basic_expr_macro,
+                                                 [('f', 'f')])])
+        cold = ctx.cold_subtrees
+        assert cold[id(plain)] is plain
+        assert cold[id(hot.body[0])] is hot.body[0]
+        assert id(hot) not in cold and id(hot.body[1]) not in cold
+        tree = ctx.expand_macros()
+        assert isinstance(tree.body[-1].body[-1].value, ast.Num)
+
+    def test_deep_tree(self):
+        from . import basic_expr_macro
+        # deeper than the recursion limit
+        depth = sys.getrecursionlimit() * 2
+        source = ("if x == 0:\n    pass\n" +
+                  "elif x == 1:\n    y = 1 + 1\n" * depth +
+                  "else:\n    y = f[1 * max(1, 2, 3)]\n")
+        tree = ast.parse(source)
+        ctx = ModuleExpansionContext(tree, source, [(basic_expr_macro,
+                                                     [('f', 'f')])])
+        tree = ctx.expand_macros()
+        node = tree.body[-1]
+        for _ in range(depth):
+            node = node.orelse[0]
+        assert isinstance(node.orelse[0].value, ast.Num)
+        assert node.orelse[0].value.n == 10
+
+    def test_expansion_order(self):
+        from . import order_macro
+        del order_macro.received[:]
+        source = "x = outer[inner[2] + 3]\ny = same[(a + b) * c]\n"
+        tree = ast.parse(source)
+        ctx = ModuleExpansionContext(tree, source, [(order_macro, [
+            ('outer', 'outer'), ('inner', 'inner'), ('same', 'same')])])
+        profiling.reset()
+        profiling.enable()
+        try:
+            tree = ctx.expand_macros()
+        finally:
+            profiling.disable()
+        # the nested invocation is expanded after the outside-in macro
+        assert order_macro.received == ['(inner[2] + 3)', '2']
+        assert unparse(tree.body[-2].value) == '(1 + 3)'
+        assert unparse(tree.body[-1].value) == '((a + b) * c)'
+        # the expanded body returned unchanged by the macro isn't walked
+        # again
+        assert profiling.macro_stats.get(order_macro.outer).rewalked > 0
+        assert profiling.macro_stats.get(order_macro.same).rewalked == 0
+
+        with self.assertRaises(ValueError):
+            order_macro.macros.expr(order='sideways')
+
+    def test_changed_body_is_rewalked(self):
+        import macropy.quick_lambda
+        from . import order_macro
+        source = ("with wrapall:\n"
+                  "    def g():\n"
+                  "        if True:\n"
+                  "            return [10]\n")
+        tree = ast.parse(source)
+        ctx = ModuleExpansionContext(tree, source, [
+            (order_macro, [('wrapall', 'wrapall')]),
+            (macropy.quick_lambda, [('f', 'f'), ('_', '_')])])
+        tree = ctx.expand_macros()
+        # the invocation added deep in the body by the macro is expanded
+        namespace = {}
+        exec(compile(tree, '<test>', 'exec'), namespace)
+        assert namespace['g']()[0](1) == 11
+
+    def test_pure_macros(self):
+        from macropy.core.memo import expansion_memo
+        from . import pure_macro
+        del pure_macro.calls[:]
+        expansion_memo.clear()
+        source = ("x = twice[a + 1]\n"
+                  "y = twice[a + 2]\n"
+                  "\n"
+                  "z = twice[a + 1]\n")
+        tree = ast.parse(source)
+        ctx = ModuleExpansionContext(tree, source, [(pure_macro, [
+            ('twice', 'twice')])])
+        profiling.reset()
+        profiling.enable()
+        try:
+            tree = ctx.expand_macros()
+        finally:
+            profiling.disable()
+        # the third invocation reuses the output of the first one
+        assert len(pure_macro.calls) == 2
+        x, y, z = (stmt.value for stmt in tree.body[-3:])
+        assert unparse(z) == unparse(x) == '((a + 1) * 2)'
+        assert unparse(y) == '((a + 2) * 2)'
+        assert z is not x and z.left is not x.left
+        assert z.lineno == z.left.lineno == 4
+        stats = profiling.macro_stats.get(pure_macro.twice)
+        assert (stats.hits, stats.misses) == (1, 2)
+        assert profiling.macro_stats.hit_rate() == 1 / 3
+        profiling.reset()
+        expansion_memo.clear()
+
+        with self.assertRaises(ValueError):
+            @pure_macro.macros.expr(pure=True)
+            def gen(tree, **kw):
+                yield tree
+
+    def test_concurrent_expansions(self):
+        from . import context_macro
+        context_macro.seen.clear()
+        contexts = {}
+
+        def expand():
+            tree = ast.parse("x = current[1]\n")
+            ctx = ModuleExpansionContext(tree, "", [(context_macro, [
+                ('current', 'current')])])
+            contexts[threading.get_ident()] = ctx
+            ctx.expand_macros()
+
+        threads = [threading.Thread(target=expand) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # each thread sees the context of the module it expands
+        assert len(contexts) == 2
+        assert context_macro.seen == contexts
+        assert get_current_context() is None
+
+    def test_concurrent_registration(self):
+        macros = Macros()
+
+        def register(n):
+            for i in range(100):
+                macros.expr(lambda tree, **kw: tree,
+                            name='m_{}_{}'.format(n, i))
+
+        threads = [threading.Thread(target=register, args=(n,))
+                   for n in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert len(macros.expr.registry) == 400
+
+    def test_node_filters(self):
+        seen = []
+
+        @NodeFilter
+        def depth(tree, state, set_state, set_state_for, **kw):
+            seen.append(('depth', type(tree).__name__, state))
+            set_state(state + 1)
+            if type(tree) is ast.BinOp:
+                set_state_for(tree.right, 100)
+
+        @depth.initial_state
+        def depth_state(start, **kw):
+            return start
+
+        @NodeFilter
+        def negate(tree, state, **kw):
+            seen.append(('negate', type(tree).__name__, state))
+            if type(tree) is ast.Num:
+                return ast.Num(-tree.n)
+
+        def plain(tree, **kw):
+            return tree
+
+        # filters are applied in reverse order of registration
+        stages = filter_stages([negate, depth, plain])
+        assert [f.__name__ for f in stages] == ['plain', 'depth+negate']
+        tree = ast.parse("1 + 2", mode='eval').body
+        for stage in stages:
+            tree = stage(tree, start=0)
+        assert (tree.left.n, tree.right.n) == (-1, -2)
+        # a single traversal, calling each filter on a node before
+        # visiting its children
+        assert seen == [
+            ('depth', 'BinOp', 0), ('negate', 'BinOp', None),
+            ('depth', 'Num', 1), ('negate', 'Num', None),
+            ('depth', 'Add', 1), ('negate', 'Add', None),
+            ('depth', 'Num', 100), ('negate', 'Num', None),
+        ]
+        # they can be called on their own too
+        tree = negate(ast.parse("[3]", mode='eval').body)
+        assert tree.elts[0].n == -3
+
+    def test_fill_line_numbers(self):
+        from macropy.core.cleanup import fill_line_numbers
+        tree = ast.parse("x = 1\ny = 2\n").body
+        new_nodes = [ast.Pass(), ast.Pass(), ast.Pass()]
+        tree = [new_nodes[0], tree[0], new_nodes[1], tree[1], new_nodes[2]]
+        fill_line_numbers(tree, lineno=1, col_offset=4)
+        assert [(n.lineno, n.col_offset) for n in new_nodes] == [
+            (1, 4), (1, 4), (2, 0)]
+
+    def test_injected_vars(self):
+        calls = []
+
+        def first(**kw):
+            calls.append('first')
+            return 1
+
+        def second(tree, src, first):
+            calls.append('second')
+            return first + 1
+
+        def third(tree, src):
+            calls.append('third')
+            return 3
+
+        file_vars = InjectedVars([first, second, third], tree=None, src='')
+        assert 'second' in file_vars and calls == []
+        assert file_vars['second'] == 2
+        assert calls == ['first', 'second']
+        assert dict(file_vars) == {'first': 1, 'second': 2, 'third': 3}
+        assert calls == ['first', 'second', 'third']
+
+        # the functions get only the keywords they ask for
+        calls[:] = []
+        ctx = ModuleExpansionContext(ast.parse(""), "", [])
+        ctx.file_vars = InjectedVars([first, second, third], tree=None,
+                                     src='')
+
+        def macro(tree, second, target):
+            pass
+
+        def macro_kw(tree, **kw):
+            pass
+
+        assert ctx.keywords_for(macro, {'target': 0}) == {'second': 2,
+                                                          'target': 0}
+        assert calls == ['first', 'second']
+        assert ctx.keywords_for(macro_kw, {'target': 0}) == {
+            'target': 0, 'first': 1, 'second': 2, 'third': 3}
@@ -0,0 +1,19 @@
+import threading
+
+import macropy.core.macros
+
+macros = macropy.core.macros.Macros()
+
+barrier = threading.Barrier(2)
+seen = {}
+
+
+@macros.expr
+def current(tree, **kw):
+    # look at the context while the other thread is expanding its own
+    # module
+    barrier.wait(timeout=10)
+    ctx = macropy.core.macros.get_current_context()
+    barrier.wait(timeout=10)
+    seen[threading.get_ident()] = ctx
+    return tree
@@ -0,0 +1,38 @@
+import ast
+
+import macropy.core
+import macropy.core.macros
+
+macros = macropy.core.macros.Macros()
+
+received = []
+
+
+@macros.expr(order=macropy.core.macros.OUTSIDE_IN)
+def outer(tree, **kw):
+    received.append(macropy.core.unparse(tree))
+    return tree
+
+
+@macros.expr
+def inner(tree, **kw):
+    received.append(macropy.core.unparse(tree))
+    return ast.Num(n=1)
+
+
+@macros.expr
+def same(tree, **kw):
+    return tree
+
+
+@macros.block
+def wrapall(tree, **kw):
+    # rewrite the numbers deep in the body in place, with a new invocation
+    for node in ast.walk(ast.Module(body=tree)):
+        for field, value in ast.iter_fields(node):
+            if isinstance(value, list):
+                for i, item in enumerate(value):
+                    if isinstance(item, ast.Num):
+                        value[i] = ast.parse(
+                            'f[_ + %r]' % item.n).body[0].value
+    return tree
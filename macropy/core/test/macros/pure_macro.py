@@ -0,0 +1,13 @@
+import ast
+
+import macropy.core.macros
+
+macros = macropy.core.macros.Macros()
+
+calls = []
+
+
+@macros.expr(pure=True)
+def twice(tree, **kw):
+    calls.append(tree)
+    return ast.BinOp(left=tree, op=ast.Mult(), right=ast.Num(n=2))
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+import ast
+import unittest
+
+from macropy.core import Captured
+from macropy.core.memo import ExpansionMemo, clone, structural_hash
+
+
+class Tests(unittest.TestCase):
+
+    def test_structural_hash(self):
+        first = ast.parse("x = f(a + 1)\n").body[0]
+        second = ast.parse("if y:\n\n    x = f(a + 1)\n").body[0].body[0]
+        assert first.lineno != second.lineno
+        assert structural_hash(first) == structural_hash(second)
+        assert structural_hash(first) != structural_hash(
+            ast.parse("x = f(a + 2)\n").body[0])
+        assert structural_hash(first) != structural_hash(
+            ast.parse("x = f(a + '1')\n").body[0])
+        assert structural_hash([first], {}) != structural_hash([first])
+        assert structural_hash({'a': first}) != structural_hash({'b': first})
+        # the captured values aren't compared
+        assert structural_hash(ast.Expr(Captured(1, 'one'))) is None
+
+    def test_clone(self):
+        tree = ast.parse("def f(a):\n    return [a, 'b']\n")
+        new = clone(tree, 2)
+        assert ast.dump(new) == ast.dump(tree)
+        assert new.body[0] is not tree.body[0]
+        assert new.body[0].body is not tree.body[0].body
+        assert new.body[0].body[0].lineno == tree.body[0].body[0].lineno + 2
+        assert new.body[0].col_offset == tree.body[0].col_offset
+        new.body[0].name = 'g'
+        assert tree.body[0].name == 'f'
+
+    def test_expansion_memo(self):
+        memo = ExpansionMemo(maxsize=2)
+        trees = [ast.parse("x = %d\n" % n).body[0] for n in range(3)]
+        keys = [memo.key(len, tree, [], {}, {}) for tree in trees]
+        assert memo.get(keys[0]) is None
+        for key, tree in zip(keys, trees):
+            memo.put(key, tree, 1)
+        # the least recently used one is evicted
+        assert len(memo) == 2
+        assert memo.get(keys[0]) is None
+        hit = memo.get(keys[1], 5)
+        assert ast.dump(hit) == ast.dump(trees[1])
+        assert hit is not trees[1] and hit.lineno == 5
+        assert (memo.hits, memo.misses) == (1, 2)
+        assert memo.hit_rate == 1 / 3
+        memo.clear()
+        assert len(memo) == 0 and memo.hit_rate == 0.0
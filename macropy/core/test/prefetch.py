@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+import importlib
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+
+from macropy.core.import_hooks import MacroFinder
+from macropy.core.prefetch import Prefetcher
+
+
+MACRO = """\
+import os
+from macropy.core.macros import Macros
+macros = Macros()
+
+@macros.expr
+def expanded(tree, **kw):
+    with open(os.path.join(os.path.dirname(__file__), 'log'), 'a') as f:
+        f.write('%d\\n' % os.getpid())
+    return tree
+"""
+
+
+class Tests(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.package = os.path.join(self.tmp, 'prefetched')
+        os.makedirs(os.path.join(self.package, 'sub'))
+        self.write('__init__.py', '')
+        self.write('macro.py', MACRO)
+        self.write('plain.py', 'x = 0\n')
+        for name in ('first.py', 'second.py', os.path.join('sub',
+                                                           '__init__.py')):
+            self.write(name, 'from prefetched.macro import macros, '
+                       'expanded\nx = expanded[1 + 1]\n')
+        sys.path.insert(0, self.tmp)
+
+    def tearDown(self):
+        MacroFinder.prefetcher = None
+        sys.path.remove(self.tmp)
+        for name in list(sys.modules):
+            if name.split('.')[0] == 'prefetched':
+                del sys.modules[name]
+        shutil.rmtree(self.tmp)
+
+    def write(self, name, content):
+        with open(os.path.join(self.package, name), 'w') as f:
+            f.write(content)
+
+    def expansions(self):
+        with open(os.path.join(self.package, 'log')) as f:
+            return [int(pid) for pid in f.read().split()]
+
+    def test_candidates(self):
+        prefetcher = Prefetcher(['prefetched'])
+        assert sorted(prefetcher.candidates('prefetched', [self.package])) == [
+            ('prefetched.first', os.path.join(self.package, 'first.py')),
+            ('prefetched.second', os.path.join(self.package, 'second.py')),
+            ('prefetched.sub', os.path.join(self.package, 'sub',
+                                            '__init__.py'))]
+
+    def test_prefetch(self):
+        prefetcher = Prefetcher(['prefetched'], workers=2)
+        prefetcher.start()
+        MacroFinder.prefetcher = prefetcher
+        import prefetched
+        for scan in list(prefetcher._scans.values()):
+            scan.join()
+        futures = dict(prefetcher._futures)
+        assert sorted(futures) == ['prefetched.first', 'prefetched.second',
+                                   'prefetched.sub']
+        for file_name, future in futures.values():
+            future.result()
+        # a module changed meanwhile is expanded again
+        self.write('second.py', 'from prefetched.macro import macros, '
+                   'expanded\nx = expanded[2 + 2]\n')
+        importlib.import_module('prefetched.first')
+        importlib.import_module('prefetched.second')
+        importlib.import_module('prefetched.sub')
+        assert prefetched.first.x == prefetched.sub.x == 2
+        assert prefetched.second.x == 4
+        pids = self.expansions()
+        assert len(pids) == 4
+        assert pids.count(os.getpid()) == 1
+        # all taken, the workers are stopped
+        assert prefetcher._executor is None
+
+    def test_prefetch_in_background(self):
+        prefetcher = Prefetcher(['prefetched'], workers=1)
+        prefetcher.start()
+        listed = threading.Event()
+        candidates = prefetcher.candidates
+
+        def slow_candidates(*args):
+            listed.wait()
+            return candidates(*args)
+
+        prefetcher.candidates = slow_candidates
+        MacroFinder.prefetcher = prefetcher
+        try:
+            # the package is imported without waiting for its modules
+            # to be listed
+            import prefetched  # noqa: F401
+            importlib.import_module('prefetched.first')
+            scan = prefetcher._scans['prefetched']
+            listed.set()
+            scan.join()
+            # the module imported meanwhile isn't prefetched
+            futures = dict(prefetcher._futures)
+            assert sorted(futures) == ['prefetched.second',
+                                       'prefetched.sub']
+            for file_name, future in futures.values():
+                future.result()
+            pids = self.expansions()
+            assert len(pids) == 3
+            assert pids.count(os.getpid()) == 1
+        finally:
+            listed.set()
+            prefetcher.shutdown()
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+import importlib
+import io
+import unittest
+
+from macropy.core import profiling
+
+
+class Tests(unittest.TestCase):
+    def test_import_phases(self):
+        from .macros import basic_block
+        profiling.reset()
+        profiling.enable()
+        try:
+            importlib.reload(basic_block)
+        finally:
+            profiling.disable()
+        times = profiling.import_times()[basic_block.__name__]
+        for name in ('find', 'read', 'parse', 'detect', 'import', 'expand',
+                     'post-process', 'compile', 'export', 'exec'):
+            assert name in times, name
+            assert times[name] >= 0
+
+        out = io.StringIO()
+        profiling.report(out)
+        lines = out.getvalue().splitlines()
+        assert lines[0].startswith('macropy import time')
+        assert any(line.endswith('| ' + basic_block.__name__)
+                   for line in lines[2:])
+        profiling.reset()
+        assert profiling.import_times() == {}
+
+    def test_nested_phases(self):
+        profiling.reset()
+        profiling.enable()
+        try:
+            with profiling.phase('detect', 'a'):
+                with profiling.phase('import'):
+                    with profiling.phase('find', 'b'):
+                        pass
+        finally:
+            profiling.disable()
+        times = profiling.import_times()
+        assert set(times) == {'a', 'b'}
+        assert set(times['a']) == {'detect', 'import'}
+        assert times['a']['import'] >= times['b']['find']
+        profiling.reset()
+
+    def test_disabled(self):
+        profiling.reset()
+        with profiling.phase('parse', 'a'):
+            pass
+        assert profiling.import_times() == {}
+
+    def test_macro_stats(self):
+        import pstats
+        import macropy
+        from .macros import basic_expr, basic_expr_macro
+        profiling.reset()
+        profiling.enable()
+        try:
+            importlib.reload(basic_expr)
+        finally:
+            profiling.disable()
+        stats = macropy.stats()
+        key = (basic_expr_macro.__name__, 'f')
+        assert key in stats
+        f_stats = stats[key]
+        assert f_stats.calls == 1
+        assert f_stats.cumulative >= f_stats.self_time >= 0
+        # ``1 * max(1, 2, 3)`` in, ``10`` out
+        assert f_stats.nodes_in > f_stats.nodes_out == 1
+        assert f_stats.rewalks == 1
+        assert f_stats.rewalked >= 1
+        # the node filters are applied together, and timed separately
+        assert set(f_stats.filters) >= {
+            'clear_errors', 'hygienate', 'fill_line_numbers', 'fix_ctx',
+            'hygienate+fill_line_numbers+fix_ctx'}
+        assert stats.walked > 0
+
+        out = io.StringIO()
+        stats.report(out)
+        assert out.getvalue().splitlines()[2].endswith('| ' + '.'.join(key))
+        # it can be used with the standard profiling tools
+        out = io.StringIO()
+        pstats.Stats(stats, stream=out).print_stats()
+        assert '.'.join(key) in out.getvalue()
+        profiling.reset()
+        assert len(stats) == 0
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import socket
+import stat
+import sys
+import tempfile
+import threading
+import unittest
+
+from macropy.core.import_hooks import MacroFinder
+from macropy.core.server import ExpansionClient, ExpansionServer, version
+
+
+SOURCE = ("from macropy.core.test.macros.basic_expr_macro "
+          "import macros, f\n"
+          "x = f[1 * max(1, 2, 3)]\n")
+
+
+@unittest.skipUnless(hasattr(socket, 'AF_UNIX'), 'no Unix sockets')
+class Tests(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, 'server.sock')
+        self.server = ExpansionServer(self.path)
+        self.server.bind()
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.thread.join()
+        shutil.rmtree(self.tmp)
+
+    def test_expansion_server(self):
+        assert stat.S_IMODE(os.stat(self.path).st_mode) & 0o077 == 0
+        client = ExpansionClient(self.path)
+        file_name = os.path.join(self.tmp, 'mod.py')
+        for n in range(2):
+            code, dependencies = client.find('mod', file_name, SOURCE)
+            assert code.co_filename == file_name
+            namespace = {}
+            exec(code, namespace)
+            assert namespace['x'] == 10
+            assert 'macropy.core.test.macros.basic_expr_macro' in \
+                dependencies
+        assert client.find('plain', file_name, 'x = 1\n') is None
+        assert self.server.stats == {'hits': 1, 'misses': 2, 'errors': 0}
+        assert client.available
+
+    def test_expansion_server_path(self):
+        file_name = os.path.join(self.tmp, 'mod.py')
+        other = os.path.join(self.tmp, 'lib')
+        old_path = list(sys.path)
+        response = self.server.expand('mod', file_name, SOURCE, [other])
+        assert response[0] == 'ok'
+        # the path of a client is used for its request only
+        assert sys.path == old_path
+        # and the expansions found with another path aren't reused
+        self.server.expand('mod', file_name, SOURCE, [])
+        assert self.server.stats['misses'] == 2
+        self.server.expand('mod', file_name, SOURCE, [other])
+        assert self.server.stats['hits'] == 1
+
+    def test_version(self):
+        # the flags change the code compiled
+        assert version()[-1] == tuple(sys.flags)
+
+    def test_expansion_server_fallback(self):
+        # another version
+        client = ExpansionClient(self.path)
+        client.version = (0,) + client.version[1:]
+        assert client.find('mod', 'mod.py', SOURCE) is None
+        assert not client.available
+        assert self.server.stats['errors'] == 1
+        # no server
+        client = ExpansionClient(os.path.join(self.tmp, 'missing.sock'))
+        assert client.find('mod', 'mod.py', SOURCE) is None
+        assert not client.available
+        # the import hook expands locally
+        old_server = MacroFinder.expansion_server
+        MacroFinder.expansion_server = client
+        try:
+            assert MacroFinder.find_expansion('mod', 'mod.py', SOURCE) is None
+        finally:
+            MacroFinder.expansion_server = old_server
+
+    def test_finder_asks_server(self):
+        old_server = MacroFinder.expansion_server
+        MacroFinder.expansion_server = ExpansionClient(self.path)
+        try:
+            code, dependencies = MacroFinder.find_expansion(
+                'mod', os.path.join(self.tmp, 'mod.py'), SOURCE)
+        finally:
+            MacroFinder.expansion_server = old_server
+        assert code is not None
+        assert self.server.stats['misses'] == 1
@@ -1,4 +1,5 @@
 import ast
+import sys
 import unittest
 
 import macropy.core
@@ -68,3 +69,50 @@ class Tests(unittest.TestCase):
 
         new_tree = stopper.recurse(tree)
         assert macropy.core.unparse(goal) == macropy.core.unparse(new_tree)
+
+    def test_set_ctx_for(self):
+        tree = macropy.core.parse_expr('(1 + 2) * (3 + 4)')
+        goal = macropy.core.parse_expr('(1 + 2) * (103 + 104)')
+
+        @macropy.core.walkers.Walker
+        def add_to_right(tree, set_ctx_for, offset=0, **kw):
+            if type(tree) is ast.Num:
+                tree.n = tree.n + offset
+            elif type(tree) is ast.BinOp and type(tree.op) is ast.Mult:
+                set_ctx_for(tree.right, offset=100)
+
+        new_tree = add_to_right.recurse(tree)
+        assert macropy.core.unparse(goal) == macropy.core.unparse(new_tree)
+
+    def test_splice(self):
+        tree = macropy.core.parse_stmt('a = 1\nb = 2\nc = 3')
+
+        @macropy.core.walkers.Walker
+        def duplicate(tree, collect, stop, **kw):
+            if type(tree) is ast.Assign:
+                collect(tree.targets[0].id)
+                if tree.targets[0].id == 'b':
+                    stop()
+                    return [tree, macropy.core.parse_stmt('d = 4')[0]]
+
+        new_tree, collected = duplicate.recurse_collect(tree)
+        assert new_tree is tree
+        self.assertEqual([t.targets[0].id for t in tree],
+                         ['a', 'b', 'd', 'c'])
+        self.assertEqual(collected, ['a', 'b', 'c'])
+
+    def test_deep_tree(self):
+        # deeper than the recursion limit
+        depth = sys.getrecursionlimit() * 2
+        tree = ast.parse(' + '.join(['1'] * depth), mode='eval')
+
+        @macropy.core.walkers.Walker
+        def increment(tree, collect, **kw):
+            if type(tree) is ast.Num:
+                collect(tree.n)
+                tree.n = tree.n + 1
+
+        new_tree, collected = increment.recurse_collect(tree)
+        self.assertEqual(collected, [1] * depth)
+        self.assertEqual([node.n for node in ast.walk(new_tree)
+                          if type(node) is ast.Num], [2] * depth)
@@ -3,6 +3,8 @@
 std lib.
 """
 
+import threading
+
 
 def flatten(xs):
     """Recursively flattens a list of lists of lists (arbitrarily,
@@ -57,11 +59,15 @@ def distinct(l):
     return s
 
 
+_register_lock = threading.Lock()
+
+
 def register(array):
     """A decorator to add things to lists without stomping over its
-    value."""
+    value. It can be used from concurrent imports."""
     def x(val):
-        array.append(val)
+        with _register_lock:
+            array.append(val)
         return val
     return x
 
@@ -60,43 +60,9 @@ class Walker(object):
         self.func = func
 
     def walk_children(self, tree, sub_kw=[], **kw):
-        if isinstance(tree, ast.AST):
-            aggregates = []
-
-            for field, old_value in ast.iter_fields(tree):
-
-                old_value = getattr(tree, field, None)
-                specific_sub_kw = [
-                    (k, v)
-                    for item, kws in sub_kw
-                    if item is old_value
-                    for k, v in kws.items()
-                ]
-                new_value, new_aggregate = self.recurse_collect(
-                    old_value, sub_kw,
-                    **dict(list(kw.items()) + specific_sub_kw))
-                aggregates.extend(new_aggregate)
-                setattr(tree, field, new_value)
-
-            return aggregates
-
-        elif isinstance(tree, list) and len(tree) > 0:
-            aggregates = []
-            new_tree = []
-
-            for t in tree:
-                new_t, new_a = self.recurse_collect(t, sub_kw, **kw)
-                if type(new_t) is list:
-                    new_tree.extend(new_t)
-                else:
-                    new_tree.append(new_t)
-                aggregates.extend(new_a)
-
-            tree[:] = new_tree
-            return aggregates
-
-        else:
-            return []
+        """Traverse the children of the given AST, or the items of the
+        given list, and return the values collected along the way."""
+        return self._walk(tree, sub_kw, kw, False)[1]
 
     def recurse(self, tree, **kw):
         """Traverse the given AST and return the transformed tree."""
@@ -109,43 +75,141 @@ class Walker(object):
     def recurse_collect(self, tree, sub_kw=[], **kw):
         """Traverse the given AST and return the transformed tree together
         with any values which were collected along with way."""
-
-        if (isinstance(tree, ast.AST) or type(tree) is Literal or
-            type(tree) is Captured):  # noqa: #E129
-            aggregates = []
-            stop_now = [False]
-
-            def stop():
-                stop_now[0] = True
-
-            new_ctx = dict(**kw)
-            new_ctx_for = sub_kw[:]
-
-            def set_ctx(**new_kw):
-                new_ctx.update(new_kw)
-
-            def set_ctx_for(tree, **kw):
-                new_ctx_for.append((tree, kw))
-
-            # Provide the function with a bunch of controls, in addition to
-            # the tree itself.
-            new_tree = self.func(
-                tree=tree,
-                collect=aggregates.append,
-                set_ctx=set_ctx,
-                set_ctx_for=set_ctx_for,
-                stop=stop,
-                **kw
-            )
-
-            if new_tree is not None:
-                tree = new_tree
-
-            if not stop_now[0]:
-                aggregates.extend(self.walk_children(tree, new_ctx_for,
-                                                     **new_ctx))
-
+        return self._walk(tree, sub_kw, kw, True)
+
+    def _walk(self, tree, sub_kw, kw, visit_root):
+        """Internal; the traversal, which uses an explicit stack instead
+        of recursion, so that it isn't limited by the depth of the tree.
+
+        Each entry in the stack is a tuple whose first item tells what
+        to do with the rest:
+
+        - ``_VISIT``: call the function on a node and schedule the walk
+          of its children, or only the latter when it isn't a node;
+        - ``_FIELD``: walk the field of a node at the given index and
+          schedule the following one;
+        - ``_ITEM``: the same for the item of a list, whose results are
+          spliced into another list;
+        - ``_PLACE``: put the new value of a child in its parent, now
+          that its children are walked.
+
+        The values collected are gathered in a single list, as they are
+        in the same order the nodes are visited.
+        """
+        aggregates = []
+        result = [tree]
+        stack = []
+        push = stack.append
+        pop = stack.pop
+        func = self.func
+        if visit_root:
+            push((_VISIT, tree, sub_kw, kw, result, 0))
         else:
-            aggregates = self.walk_children(tree, sub_kw, **kw)
-
-        return tree, aggregates
+            push((_PLACE, tree, result, 0))
+            self._push_children(push, tree, sub_kw, kw)
+        while stack:
+            entry = pop()
+            action = entry[0]
+            if action is _VISIT:
+                _, tree, sub_kw, kw, parent, key = entry
+                if (isinstance(tree, ast.AST) or type(tree) is Literal or
+                    type(tree) is Captured):  # noqa: E129
+                    stop_now = [False]
+
+                    def stop():
+                        stop_now[0] = True
+
+                    new_ctx = dict(**kw)
+                    new_ctx_for = sub_kw[:]
+
+                    def set_ctx(**new_kw):
+                        new_ctx.update(new_kw)
+
+                    def set_ctx_for(tree, **kw):
+                        new_ctx_for.append((tree, kw))
+
+                    # Provide the function with a bunch of controls, in
+                    # addition to the tree itself.
+                    new_tree = func(
+                        tree=tree,
+                        collect=aggregates.append,
+                        set_ctx=set_ctx,
+                        set_ctx_for=set_ctx_for,
+                        stop=stop,
+                        **kw
+                    )
+
+                    if new_tree is not None:
+                        tree = new_tree
+
+                    push((_PLACE, tree, parent, key))
+                    if not stop_now[0]:
+                        self._push_children(push, tree, new_ctx_for,
+                                            new_ctx)
+                else:
+                    push((_PLACE, tree, parent, key))
+                    self._push_children(push, tree, sub_kw, kw)
+            elif action is _FIELD:
+                _, tree, fields, ix, sub_kw, kw = entry
+                if ix + 1 < len(fields):
+                    push((_FIELD, tree, fields, ix + 1, sub_kw, kw))
+                field = fields[ix]
+                try:
+                    old_value = getattr(tree, field)
+                except AttributeError:
+                    continue
+                specific_sub_kw = [
+                    (k, v)
+                    for item, kws in sub_kw
+                    if item is old_value
+                    for k, v in kws.items()
+                ]
+                if specific_sub_kw:
+                    kw = dict(list(kw.items()) + specific_sub_kw)
+                push((_VISIT, old_value, sub_kw, kw, tree, field))
+            elif action is _ITEM:
+                _, tree, ix, new_tree, sub_kw, kw = entry
+                if ix + 1 < len(tree):
+                    push((_ITEM, tree, ix + 1, new_tree, sub_kw, kw))
+                else:
+                    push((_PLACE, new_tree, tree, _SPLICED))
+                push((_VISIT, tree[ix], sub_kw, kw, new_tree, _SPLICE))
+            else:
+                _place(*entry[1:])
+        return result[0], aggregates
+
+    @staticmethod
+    def _push_children(push, tree, sub_kw, kw):
+        if isinstance(tree, ast.AST):
+            if tree._fields:
+                push((_FIELD, tree, tree._fields, 0, sub_kw, kw))
+        elif isinstance(tree, list) and len(tree) > 0:
+            push((_ITEM, tree, 0, [], sub_kw, kw))
+
+
+# the actions of `Walker._walk`:meth:
+_VISIT = 'visit'
+_FIELD = 'field'
+_ITEM = 'item'
+_PLACE = 'place'
+# the keys telling `_place`:func: how to put a new value in a list
+_SPLICE = object()
+_SPLICED = object()
+
+
+def _place(tree, parent, key):
+    """Put the new value *tree* of a child of *parent*, which is either
+    the field named *key* of a node, an index of a list, an item to
+    splice into a new list (*key* is ``_SPLICE``) or the new content of
+    the list itself (*key* is ``_SPLICED``)."""
+    if key is _SPLICE:
+        if type(tree) is list:
+            parent.extend(tree)
+        else:
+            parent.append(tree)
+    elif key is _SPLICED:
+        parent[:] = tree
+    elif type(key) is str:
+        setattr(parent, key, tree)
+    else:
+        parent[key] = tree
@@ -36,7 +36,7 @@ def f(tree, gen_sym, **kw):
     return new_tree
 
 
-@macros.expr
+@macros.expr(pure=True)
 def lazy(tree, **kw):
     """Macro to wrap an expression in a lazy memoizing thunk. This can be
     called via `thing()` to extract the value. The wrapped expression is
@@ -58,7 +58,8 @@ def interned_count(**kw):
 
 @register(injected_vars)  # noqa: F811
 def interned_name(gen_sym, **kw):
-    return gen_sym()
+    # a thunk, to generate the name only if `interned` is used
+    return Lazy(gen_sym)
 
 
 @register(post_processing)  # noqa: F811
@@ -66,7 +67,7 @@ def interned_processing(tree, gen_sym, interned_count, interned_name, **kw):
 
     if interned_count[0] != 0:
         with q as code:
-            name[interned_name] = [None for x in range(u[interned_count[0]])]
+            name[interned_name()] = [None for x in range(u[interned_count[0]])]
 
         code = ast_ctx_fixer.recurse(code)
         code = list(map(ast.fix_missing_locations, code))
@@ -81,6 +82,6 @@ def interned(tree, interned_name, interned_count, **kw):
     """Macro to intern the wrapped expression on a per-module basis"""
     interned_count[0] += 1
 
-    hq[name[interned_name]]
+    hq[name[interned_name()]]
 
-    return hq[get_interned(name[interned_name], interned_count[0] - 1, lambda: ast_literal[tree])]
+    return hq[get_interned(name[interned_name()], interned_count[0] - 1, lambda: ast_literal[tree])]
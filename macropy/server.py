@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""Run and control an expansion server, see
+`~.core.server.ExpansionServer`:class:. Use it like::
+
+    python -m macropy.server [-s SOCKET] serve
+    python -m macropy.server [-s SOCKET] stats
+    python -m macropy.server [-s SOCKET] stop
+
+The socket defaults to the value of the ``MACROPY_EXPANSION_SERVER``
+environment variable. The processes started with that variable set ask
+the server for the expansion of their modules, and expand them
+themselves when it isn't running.
+"""
+
+import argparse
+import logging
+import signal
+import sys
+
+from .core.server import ExpansionClient, ExpansionServer, server_path
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m macropy.server',
+        description='Run and control an expansion server.')
+    parser.add_argument('-s', '--socket', default=None,
+                        help='the path of the socket (default: '
+                        '$MACROPY_EXPANSION_SERVER)')
+    commands = parser.add_subparsers(dest='command')
+    serve = commands.add_parser('serve', help='run the server')
+    serve.add_argument('-n', '--max-entries', type=int, default=4096,
+                       help='the number of expansions kept in memory')
+    commands.add_parser('stats', help='show the statistics of the server')
+    commands.add_parser('stop', help='stop the server')
+    args = parser.parse_args(argv)
+
+    path = args.socket or server_path()
+    if path is None:
+        parser.error('no socket given')
+    if args.command == 'serve':
+        import macropy.activate  # noqa: F401
+        from .core.import_hooks import MacroFinder
+        # don't ask ourselves
+        MacroFinder.expansion_server = None
+        logging.basicConfig()
+        server = ExpansionServer(path, args.max_entries)
+        server.bind()
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        print('serving on {}'.format(path))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        return 0
+    client = ExpansionClient(path)
+    if args.command == 'stop':
+        response = client.request('stop')
+    else:
+        response = client.request('stats')
+    if response is None or response[0] != 'ok':
+        print('no server listening on {}'.format(path), file=sys.stderr)
+        return 1
+    if args.command != 'stop':
+        for name, count in sorted(response[1].items()):
+            print('{}: {}'.format(name, count))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
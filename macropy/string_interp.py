@@ -10,7 +10,7 @@ from macropy.core import ast_repr, Captured
 
 macros = macropy.core.macros.Macros()
 
-@macros.expr
+@macros.expr(pure=True)
 def s(tree, **kw):
     """Macro to easily interpolate values into string literals."""
     captured = []
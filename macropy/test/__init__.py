@@ -16,6 +16,8 @@ from . import quick_lambda
 from . import string_interp
 from . import tracing
 from . import peg
+from . import compileall
+from . import watch
 import macropy.experimental.test
 import macropy.core.test
 
@@ -25,7 +27,9 @@ Tests = test_suite(cases=[
     quick_lambda,
     string_interp,
     tracing,
-    peg
+    peg,
+    compileall,
+    watch
 ], suites=[
     macropy.experimental.test,
     macropy.core.test
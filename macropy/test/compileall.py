@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import unittest
+
+from macropy import compileall
+from macropy.core.exporters import PycExporter
+
+
+class Tests(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.package = os.path.join(self.tmp, 'mpcompiletest')
+        os.mkdir(self.package)
+        self.files = {}
+        for name, content in [
+                ('__init__.py', ''),
+                ('plain.py', 'macros = 1\n'),
+                ('uses_macros.py',
+                 'from macropy.quick_lambda import macros, f\n'
+                 'add_one = f[_ + 1]\n'),
+                ('broken.py', 'from macropy.quick_lambda import macros, f\n'
+                 'add_one = f[_ + \n')]:
+            self.files[name] = path = os.path.join(self.package, name)
+            with open(path, 'w') as f:
+                f.write(content)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_module_name_for(self):
+        assert compileall.module_name_for(self.files['plain.py']) == (
+            'mpcompiletest.plain', self.tmp)
+        assert compileall.module_name_for(self.files['__init__.py']) == (
+            'mpcompiletest', self.tmp)
+
+    def test_compile_paths(self):
+        results = compileall.compile_paths([self.tmp], workers=2)
+        outcomes = {os.path.basename(file_name): outcome
+                    for file_name, outcome, _, _ in results}
+        assert outcomes == {'uses_macros.py': compileall.EXPANDED,
+                            'broken.py': compileall.FAILED}
+
+        exporter = PycExporter()
+        file_name = self.files['uses_macros.py']
+        with open(file_name) as f:
+            source = f.read()
+        code, _ = exporter.find('mpcompiletest.uses_macros', file_name, source)
+        namespace = {}
+        exec(code, namespace)
+        assert namespace['add_one'](1) == 2
+
+        results = compileall.compile_paths([file_name], workers=1)
+        assert [r[1] for r in results] == [compileall.UP_TO_DATE]
+        results = compileall.compile_paths([file_name], workers=1,
+                                           force=True)
+        assert [r[1] for r in results] == [compileall.EXPANDED]
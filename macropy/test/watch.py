@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import unittest
+
+from macropy import compileall, watch
+from macropy.core.exporters import PycExporter
+
+
+MACRO = """\
+import ast
+from macropy.core.macros import Macros
+macros = Macros()
+
+@macros.expr
+def value(tree, **kw):
+    return ast.Num(n={})
+"""
+
+
+class Tests(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.package = os.path.join(self.tmp, 'mpwatchtest')
+        os.mkdir(self.package)
+        self.files = {}
+        for name, content in [
+                ('__init__.py', ''),
+                ('macro.py', MACRO.format(1)),
+                ('plain.py', 'x = 1\n'),
+                ('uses_macro.py',
+                 'from mpwatchtest.macro import macros, value\n'
+                 'x = value[0]\n')]:
+            self.files[name] = self.write(name, content)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def write(self, name, content):
+        path = os.path.join(self.package, name)
+        with open(path, 'w') as f:
+            f.write(content)
+        return path
+
+    def cached_constants(self):
+        file_name = self.files['uses_macro.py']
+        with open(file_name) as f:
+            source = f.read()
+        cached = PycExporter().find('mpwatchtest.uses_macro', file_name,
+                                    source)
+        return cached and cached[0].co_consts
+
+    def test_watcher(self):
+        watcher = watch.Watcher([self.tmp], workers=1)
+        results = watcher.start()
+        assert [(r[0], r[1]) for r in results] == [
+            (self.files['uses_macro.py'], compileall.EXPANDED)]
+        assert 1 in self.cached_constants()
+        # the macro module is watched through the manifest
+        assert self.files['macro.py'] in watcher.watched()
+        assert watcher.poll() == []
+
+        # editing a module without macros expands nothing
+        self.write('plain.py', 'x = 10\n')
+        assert watcher.poll() == [self.files['plain.py']]
+        assert watcher.update([self.files['plain.py']]) == []
+
+        # editing the macro module expands its dependents again
+        self.write('macro.py', MACRO.format(100))
+        assert self.cached_constants() is None
+        changed = watcher.poll()
+        assert changed == [self.files['macro.py']]
+        results = watcher.update(changed)
+        assert [(r[0], r[1]) for r in results] == [
+            (self.files['uses_macro.py'], compileall.EXPANDED)]
+        assert 100 in self.cached_constants()
+
+    def test_affected(self):
+        compileall.compile_paths([self.tmp], workers=1)
+        assert watch.affected([self.files['macro.py']], [self.tmp]) == [
+            self.files['uses_macro.py']]
+        assert watch.affected([self.files['uses_macro.py']],
+                              [self.tmp]) == [self.files['uses_macro.py']]
+        assert watch.affected([self.files['plain.py']], [self.tmp]) == []
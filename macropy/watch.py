@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+"""Keep the expansions of the modules under development up to date, so
+that the next test run or server reload finds them in the cache.
+
+Polls the source files under the given directories, and the macro
+modules used to expand them, for changes. The modules using macros
+that changed, and the ones whose expansion used a macro module that
+changed, as recorded in the manifests of the cache of
+`~.core.exporters.PycExporter`:class:, are expanded again in a pool of
+processes like `~.compileall`:mod: does. Use it like::
+
+    python -m macropy.watch [-j WORKERS] [-i INTERVAL] [-q] PATH...
+"""
+
+import argparse
+import os
+import sys
+import time
+
+from . import compileall
+from .core.exporters import PycExporter
+
+
+def source_files(paths):
+    """Return the set of the source files under *paths* (files or
+    directories)."""
+    file_names = set()
+    for path in paths:
+        if os.path.isdir(path):
+            file_names.update(
+                os.path.abspath(os.path.join(dirpath, fname))
+                for dirpath, dirnames, filenames in os.walk(path)
+                for fname in filenames if fname.endswith('.py'))
+        else:
+            file_names.add(os.path.abspath(path))
+    return file_names
+
+
+def snapshot(file_names):
+    """Return a mapping between each of *file_names* that exists and a
+    tuple of its ``mtime`` and size."""
+    stamps = {}
+    for file_name in file_names:
+        try:
+            st = os.stat(file_name)
+        except OSError:
+            continue
+        stamps[file_name] = (st.st_mtime_ns, st.st_size)
+    return stamps
+
+
+def affected(changed, roots, exporter=None):
+    """Return the sorted paths of the modules under *roots* to expand
+    again when the files *changed* have changed: those among them that
+    use macros and those whose cached expansion used any of them,
+    according to the manifests recorded by *exporter* (a
+    `~.core.exporters.PycExporter`:class:)."""
+    exporter = exporter or PycExporter()
+    changed = {os.path.abspath(file_name) for file_name in changed}
+    result = set(compileall.find_macro_modules(
+        sorted(f for f in changed if os.path.exists(f))))
+    for module_name, file_name, dependencies in exporter.cached(roots):
+        if any(os.path.abspath(dep_file) in changed
+               for dep_file, digest in dependencies.values()):
+            result.add(os.path.abspath(file_name))
+    return sorted(f for f in result if os.path.exists(f))
+
+
+class Watcher(object):
+    """Watches the source files under *roots* and the macro modules used
+    by the modules there.
+
+    :param roots: the directories to watch
+    :param workers: the number of worker processes, defaults to one per
+      CPU
+    :param report: an optional function called with the result of
+      `~.compileall.compile_module`:func: for each module expanded
+    """
+
+    def __init__(self, roots, workers=None, report=None):
+        self.roots = [os.path.abspath(root) for root in roots]
+        self.workers = workers
+        self.report = report
+        self.exporter = PycExporter()
+        self.stamps = {}
+
+    def watched(self):
+        """Return the set of the files to watch."""
+        return source_files(self.roots) | self.dependencies()
+
+    def dependencies(self):
+        """Return the set of the macro modules used by the cached
+        expansions of the modules under `roots`."""
+        return {os.path.abspath(dep_file)
+                for module_name, file_name, dependencies
+                in self.exporter.cached(self.roots)
+                for dep_file, digest in dependencies.values()}
+
+    def start(self):
+        """Take the first snapshot of the watched files and expand the
+        modules whose cached expansion is missing or stale. Return the
+        results of `~.compileall.compile_paths`:func:."""
+        self.stamps = snapshot(self.watched())
+        return compileall.compile_paths(self.roots, self.workers,
+                                        report=self.report)
+
+    def poll(self):
+        """Return the sorted paths of the watched files changed since the
+        last call, and of the source files added under `roots`. The
+        macro modules newly used are only watched from now on."""
+        sources = source_files(self.roots)
+        stamps = snapshot(sources | self.dependencies())
+        changed = sorted(
+            file_name for file_name, stamp in stamps.items()
+            if self.stamps.get(file_name, stamp) != stamp or
+            (file_name not in self.stamps and file_name in sources))
+        self.stamps = stamps
+        return changed
+
+    def update(self, changed):
+        """Expand again the modules affected by the *changed* files, in new
+        worker processes, which import the changed macro modules
+        afresh. Return the results of
+        `~.compileall.compile_paths`:func:."""
+        file_names = affected(changed, self.roots, self.exporter)
+        if not file_names:
+            return []
+        return compileall.compile_paths(file_names, self.workers,
+                                        report=self.report)
+
+    def run(self, interval=1.0):
+        """Call `start`:meth: and then `update`:meth: with the changes
+        found every *interval* seconds, forever."""
+        self.start()
+        while True:
+            time.sleep(interval)
+            changed = self.poll()
+            if changed:
+                self.update(changed)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m macropy.watch',
+        description='Expand again the modules under the given paths when '
+        'they or the macro modules they use change.')
+    parser.add_argument('paths', nargs='+', metavar='PATH',
+                        help='a directory to watch')
+    parser.add_argument('-j', '--workers', type=int, default=None,
+                        help='number of worker processes (default: one '
+                        'per CPU)')
+    parser.add_argument('-i', '--interval', type=float, default=1.0,
+                        help='seconds between two polls (default: 1)')
+    parser.add_argument('-q', '--quiet', action='store_true',
+                        help='only report the failures')
+    args = parser.parse_args(argv)
+
+    def report(result):
+        compileall.print_result(result, args.quiet)
+
+    watcher = Watcher(args.paths, args.workers, report)
+    try:
+        watcher.run(args.interval)
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())